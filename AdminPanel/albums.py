@@ -0,0 +1,60 @@
+# albums.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List
+
+from aiogram.types import Message
+
+logger = logging.getLogger("albums")
+
+
+class AlbumCollector:
+    """
+    آیتم‌های یک آلبوم (media_group_id یکسان) هر کدام یک آپدیت جدا هستند.
+    این کلاس آن‌ها را برای مدت کوتاهی جمع می‌کند و بعد از آخرین آیتم،
+    کل آلبوم را (به ترتیب message_id) یک‌جا به callback می‌دهد.
+    """
+
+    def __init__(self, delay: float = 0.8):
+        self.delay = delay
+        self.buffers: Dict[str, List[Message]] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        """
+        قفل هر چت برای read-modify-write روی media_list؛ flush آلبوم خارج از قفل سراسری
+        هندلرها اجرا می‌شود و بدون این قفل می‌تواند نوشتن یک آیتم تکی را بازنویسی کند.
+        """
+        return self.locks.setdefault(chat_id, asyncio.Lock())
+
+    def add(self, message: Message, on_complete: Callable[[List[Message]], Awaitable]):
+        key = f"{message.chat.id}:{message.media_group_id}"
+        self.buffers.setdefault(key, []).append(message)
+
+        # هر آیتم جدید زمان انتظار را از نو شروع می‌کند (debounce)
+        task = self.tasks.get(key)
+        if task:
+            task.cancel()
+        self.tasks[key] = asyncio.create_task(self._flush_later(key, on_complete))
+
+    async def _flush_later(self, key: str, on_complete):
+        await asyncio.sleep(self.delay)
+        self.tasks.pop(key, None)
+        messages = sorted(self.buffers.pop(key, []), key=lambda m: m.message_id)
+        if not messages:
+            return
+        try:
+            await on_complete(messages)
+        except Exception as e:
+            logger.error(f"album flush error: {e}")
+
+    async def drain(self, chat_id: int):
+        """منتظر می‌ماند تا آلبوم‌های در حال جمع‌آوری این چت ذخیره شوند."""
+        prefix = f"{chat_id}:"
+        pending = [task for key, task in self.tasks.items() if key.startswith(prefix)]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+album_collector = AlbumCollector()
@@ -0,0 +1,28 @@
+# audience.py
+from array import array
+from typing import Iterable
+
+# هر شناسه کاربر به صورت int64 ذخیره می‌شود (۸ بایت به ازای هر گیرنده)
+ID_TYPECODE = "q"
+
+# حداکثر تعداد شناسه در هر چانک (۸ مگابایت، زیر سقف ۱۶ مگابایتی داکیومنت مونگو)
+SNAPSHOT_CHUNK_SIZE = 1_000_000
+
+
+def new_id_array(ids: Iterable[int] = ()) -> array:
+    return array(ID_TYPECODE, ids)
+
+
+def pack_ids(ids: array) -> bytes:
+    return ids.tobytes()
+
+
+def unpack_ids(data: bytes, into: array = None) -> array:
+    ids = into if into is not None else new_id_array()
+    ids.frombytes(data)
+    return ids
+
+
+def iter_chunks(ids: array, size: int = SNAPSHOT_CHUNK_SIZE):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
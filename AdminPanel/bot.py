@@ -26,6 +26,7 @@ from config import CONF
 from upload_content import router as upload_router
 from broadcast import router as broadcast_router
 from survey import survey_router  # <--- این خط را اضافه کنید
+from database import db
 # Setup Logging
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -58,6 +59,8 @@ async def main():
         default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
     )
 
+    await db.ensure_indexes()
+
     dp = Dispatcher()
 
     dp.update.outer_middleware(GlobalLockMiddleware())
@@ -1,9 +1,10 @@
 # broadcast.py
-import asyncio
 import datetime
 import time
 import uuid  # Imported for random ID
+from bson import ObjectId
 from aiogram import Router, F, Bot
+from aiogram.filters import Command, CommandObject
 # Added Inline imports
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton,
@@ -16,13 +17,22 @@ import logging
 from config import is_admin
 from database import db
 from date_picker import DateCallback, get_years_kb, get_months_kb, get_days_kb, get_hours_kb
-from main_bot import main_bot, kb_dynamic_casts
+from main_bot import main_bot, kb_dynamic_casts, kb_survey_options
 from config import CONF
 from upload_content import kb_main_menu
+from sender import call_api, run_concurrent, run_batch, CopyPayload, TextPayload
+from audience import new_id_array
+from segments import (
+    SegmentCallback, compile_segment, kb_segment_kinds, kb_segment_casts,
+    kb_segment_surveys, kb_segment_options, SEGMENT_CASTS_PAGE
+)
 
 router = Router()
 logger = logging.getLogger("broadcast")
 
+# Telegram accepts at most 100 message ids per deleteMessages call
+DELETE_CHUNK_SIZE = 100
+
 # --- States ---
 # --- States ---
 
@@ -41,6 +51,7 @@ def kb_filter_start():
         keyboard=[
             [KeyboardButton(text="⚡️ همه کاربران")],
             [KeyboardButton(text="📅 فیلتر پیشرفته (تاریخ دقیق)")],
+            [KeyboardButton(text="🎯 فیلتر رفتاری (سگمنت)")],
             [KeyboardButton(text="🗑 حذف پیام ارسال شده با شناسه")],
             [KeyboardButton(text="👤 انتخاب دستی"),
              KeyboardButton(text="🧪 ارسال تستی")],
@@ -65,43 +76,81 @@ def kb_broadcast_actions():
 async def execute_batch_deletion(batch_id: str, status_message: Message):
     """
     Shared function to delete messages for a given batch_id.
-    Updates the status_message with progress.
+    Messages are grouped per chat and removed with bulk `delete_messages` calls
+    on the shared rate-limited sender. Logs older than the deletion window are
+    skipped, and deleted logs are marked so a repeated run does not redo them.
     """
+    since = datetime.datetime.now() - datetime.timedelta(
+        hours=CONF["DELETE_WINDOW_HOURS"])
+
     # 1. Get logs from DB
-    logs = await db.get_broadcast_logs(batch_id)
+    logs = await db.get_broadcast_logs(batch_id, since)
+    expired = await db.count_expired_broadcast_logs(batch_id, since)
 
     if not logs:
-        await status_message.edit_text(f"❌ پیامی برای شناسه `{batch_id}` در دیتابیس یافت نشد.")
+        if expired:
+            await status_message.edit_text(
+                f"⌛️ {expired} پیام از شناسه `{batch_id}` قدیمی‌تر از "
+                f"{CONF['DELETE_WINDOW_HOURS']} ساعت است و قابل حذف نیست.")
+        else:
+            await status_message.edit_text(f"❌ پیامی برای شناسه `{batch_id}` در دیتابیس یافت نشد.")
         return
 
+    # 2. Group by chat, at most 100 messages per API call
+    chats = {}
+    for log in logs:
+        chats.setdefault(log['user_id'], []).append(log)
+
+    chunks = []
+    for chat_id, chat_logs in chats.items():
+        for i in range(0, len(chat_logs), DELETE_CHUNK_SIZE):
+            chunks.append((chat_id, chat_logs[i:i + DELETE_CHUNK_SIZE]))
+
     total = len(logs)
     await status_message.edit_text(f"🗑 پیدا شد: {total} پیام.\n⏳ شروع عملیات حذف برای Batch ID: `{batch_id}`...")
 
-    deleted_count = 0
-    errors = 0
+    stats = {"deleted": 0, "errors": 0, "done_chunks": 0}
+    pending_marks = []
 
-    for i, log in enumerate(logs):
+    async def delete_chunk(chunk):
+        chat_id, chat_logs = chunk
         try:
-            await main_bot.delete_message(chat_id=log['user_id'], message_id=log['message_id'])
-            deleted_count += 1
-        except Exception as e:
-            errors += 1
-
-        if i % 100 == 0:
-            await status_message.edit_text(
-                f"⏳ در حال حذف... ({i+1}/{total})\n"
-                f"🗑 حذف شده: {deleted_count}\n"
-                f"⚠️ خطا: {errors}"
+            await call_api(
+                main_bot.delete_messages,
+                chat_id=chat_id,
+                message_ids=[log['message_id'] for log in chat_logs]
             )
+            stats["deleted"] += len(chat_logs)
+            pending_marks.extend(log['_id'] for log in chat_logs)
+        except Exception:
+            stats["errors"] += len(chat_logs)
+
+        stats["done_chunks"] += 1
+        if len(pending_marks) >= 500:
+            marks = pending_marks[:]
+            pending_marks.clear()
+            await db.mark_broadcast_logs_deleted(marks)
+
+        if stats["done_chunks"] % 100 == 0:
+            try:
+                await status_message.edit_text(
+                    f"⏳ در حال حذف... ({stats['deleted'] + stats['errors']}/{total})\n"
+                    f"🗑 حذف شده: {stats['deleted']}\n"
+                    f"⚠️ خطا: {stats['errors']}"
+                )
+            except Exception:
+                pass
 
-        await asyncio.sleep(0.035)
+    await run_concurrent(chunks, delete_chunk)
+    await db.mark_broadcast_logs_deleted(pending_marks)
 
     await status_message.edit_text(
         f"✅ **عملیات حذف پایان یافت.**\n\n"
         f"🆔 Batch ID: `{batch_id}`\n"
         f"🔢 کل پیام‌ها: {total}\n"
-        f"🗑 موفق: {deleted_count}\n"
-        f"⚠️ ناموفق/پاک شده: {errors}"
+        f"🗑 موفق: {stats['deleted']}\n"
+        f"⚠️ ناموفق/پاک شده: {stats['errors']}\n"
+        f"⌛️ قدیمی‌تر از {CONF['DELETE_WINDOW_HOURS']} ساعت (رد شده): {expired}"
     )
 
 
@@ -119,7 +168,7 @@ async def start_broadcast(message: Message, state: FSMContext):
 
 @router.message(F.text == "⚡️ همه کاربران")
 async def filter_all(message: Message, state: FSMContext):
-    await state.update_data(start_ts=0, end_ts=time.time())
+    await state.update_data(start_ts=0, end_ts=time.time(), mode="all")
     await message.answer("✅ همه کاربران انتخاب شدند.\nپیام‌های خود را ارسال کنید:", reply_markup=kb_broadcast_actions(), resize_keyboard=True,
                          one_time_keyboard=False,
                          selective=False)
@@ -130,8 +179,10 @@ async def filter_all(message: Message, state: FSMContext):
 
 @router.message(F.text == "📅 فیلتر پیشرفته (تاریخ دقیق)")
 async def filter_custom_start(message: Message, state: FSMContext):
-    await message.answer("📅 لطفاً **سال شروع** (Start Date) را انتخاب کنید:", reply_markup=get_years_kb("start"))
-    await state.update_data(temp_sel={})
+    counts = await db.get_signup_counts()
+    await message.answer("📅 لطفاً **سال شروع** (Start Date) را انتخاب کنید:\n_(عدد داخل پرانتز: تعداد عضویت‌ها)_",
+                         reply_markup=get_years_kb("start", counts))
+    await state.update_data(temp_sel={}, mode="range")
     await state.set_state(BroadcastFlow.choosing_daterange)
 
 # --- Handling Callbacks ---
@@ -149,26 +200,30 @@ async def process_date_selection(callback: CallbackQuery, callback_data: DateCal
     if action == "year":
         temp[f"{stage}_year"] = value
         await state.update_data(temp_sel=temp)
+        counts = await db.get_signup_counts(year=value)
         await callback.message.edit_text(
             f"سال {value} انتخاب شد.\nحالا **ماه** را انتخاب کنید:",
-            reply_markup=get_months_kb(value, stage)
+            reply_markup=get_months_kb(value, stage, counts)
         )
 
     elif action == "month":
         temp[f"{stage}_month"] = value
         year = temp[f"{stage}_year"]
         await state.update_data(temp_sel=temp)
+        counts = await db.get_signup_counts(year=year, month=value)
         await callback.message.edit_text(
             f"ماه {value} انتخاب شد.\nحالا **روز** را انتخاب کنید:",
-            reply_markup=get_days_kb(year, value, stage)
+            reply_markup=get_days_kb(year, value, stage, counts)
         )
 
     elif action == "day":
         temp[f"{stage}_day"] = value
         await state.update_data(temp_sel=temp)
+        counts = await db.get_signup_counts(
+            year=temp[f"{stage}_year"], month=temp[f"{stage}_month"], day=value)
         await callback.message.edit_text(
             f"روز {value} انتخاب شد.\nحالا **ساعت** را انتخاب کنید:",
-            reply_markup=get_hours_kb(stage)
+            reply_markup=get_hours_kb(stage, counts)
         )
 
     elif action == "hour":
@@ -183,16 +238,16 @@ async def process_date_selection(callback: CallbackQuery, callback_data: DateCal
 
         if stage == "start":
             await state.update_data(start_ts=ts)
+            counts = await db.get_signup_counts()
             await callback.message.edit_text(
                 "✅ تاریخ شروع ثبت شد.\n\n🏁 حالا **سال پایان** (End Date) را انتخاب کنید:",
-                reply_markup=get_years_kb("end")
+                reply_markup=get_years_kb("end", counts)
             )
         else:
             await state.update_data(end_ts=ts)
             start_ts = data.get("start_ts")
             end_ts = ts
-            users = await db.get_users_in_range(start_ts, end_ts)
-            count = len(users)
+            count = await db.count_signups(start_ts, end_ts)
 
             await callback.message.delete()
             await callback.message.answer(
@@ -211,9 +266,173 @@ async def process_date_selection(callback: CallbackQuery, callback_data: DateCal
 
     await callback.answer()
 
+# --- Segment Filter Flow ---
+
+
+@router.message(F.text == "🎯 فیلتر رفتاری (سگمنت)")
+async def filter_segment_start(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    await message.answer("🎯 نوع سگمنت را انتخاب کنید:", reply_markup=kb_segment_kinds())
+
+
+@router.callback_query(SegmentCallback.filter())
+async def process_segment_selection(callback: CallbackQuery, callback_data: SegmentCallback, state: FSMContext):
+    kind = callback_data.kind
+    ref = callback_data.ref
+    opt = callback_data.opt
+
+    # مرحله انتخاب کست (صفحه‌بندی cursor-based مثل لیست کست‌ها) یا نظرسنجی
+    if kind in ("opened", "not_opened") and (not ref or callback_data.page):
+        cursor = {}
+        if callback_data.page == "n":
+            cursor = {"after": ref}
+        elif callback_data.page == "p":
+            cursor = {"before": ref}
+        casts, has_prev, has_next = await db.get_list_page("c", limit=SEGMENT_CASTS_PAGE, **cursor)
+        if not casts and cursor:
+            casts, has_prev, has_next = await db.get_list_page("c", limit=SEGMENT_CASTS_PAGE)
+        if not casts:
+            await callback.answer("📭 هیچ کستی وجود ندارد.", show_alert=True)
+            return
+        try:
+            await callback.message.edit_text("👇 کست مورد نظر را انتخاب کنید:",
+                                             reply_markup=kb_segment_casts(kind, casts, has_prev, has_next))
+        except Exception:
+            # محتوا تغییری نکرده است
+            pass
+        await callback.answer()
+        return
+
+    if kind == "voted" and not ref:
+        surveys = await db.get_recent_surveys()
+        if not surveys:
+            await callback.answer("📭 هیچ نظرسنجی‌ای وجود ندارد.", show_alert=True)
+            return
+        await callback.message.edit_text("👇 نظرسنجی مورد نظر را انتخاب کنید:",
+                                         reply_markup=kb_segment_surveys(surveys))
+        await callback.answer()
+        return
+
+    if kind == "voted" and not opt:
+        survey = await db.db["surveys"].find_one({"_id": ObjectId(ref)}, {"options": 1})
+        if not survey:
+            await callback.answer("❌ نظرسنجی یافت نشد.", show_alert=True)
+            return
+        await callback.message.edit_text("👇 گزینه مورد نظر را انتخاب کنید:",
+                                         reply_markup=kb_segment_options(survey))
+        await callback.answer()
+        return
+
+    # سگمنت کامل شد: پیش‌نمایش تعداد با count_documents
+    segment = {"kind": kind, "ref": ref, "opt": opt}
+    source, query, description = await compile_segment(segment)
+    if query is None:
+        await callback.answer("❌ آیتم انتخاب شده دیگر وجود ندارد.", show_alert=True)
+        return
+
+    count = await db.count_users(query, source)
+
+    await callback.message.delete()
+    await callback.message.answer(
+        f"✅ سگمنت انتخاب شد.\n"
+        f"🎯 {description}\n\n"
+        f"👥 تعداد تقریبی گیرندگان: **{count}** نفر\n\n"
+        "👇 حالا پیام‌های خود را ارسال کنید:",
+        reply_markup=kb_broadcast_actions()
+    )
+    await state.update_data(mode="segment", segment=segment, messages=[])
+    await state.set_state(BroadcastFlow.collecting_messages)
+    await callback.answer()
+
 # --- Message Collection & Sending ---
 
 
+async def start_batch(message: Message, batch_id: str, audience, payload, label: str, **batch_fields):
+    """
+    Shared entry point for broadcasts and surveys: saves the batch record and its
+    audience snapshot, then sends through the unified sending engine.
+    """
+    await message.answer(f"🚀 در حال ارسال برای {len(audience)} نفر ({label})...\n🆔 شناسه ارسال: `{batch_id}`")
+
+    await db.save_broadcast_batch(batch_id, total_users=len(audience), **batch_fields)
+    await db.save_audience_snapshot(batch_id, audience)
+
+    await run_broadcast(message, batch_id, payload, audience)
+
+
+async def run_broadcast(message: Message, batch_id: str, payload, audience,
+                        position: int = 0, stats: dict = None):
+    """
+    Runs the batch on the shared sender and reports the result to the admin.
+    """
+    stats = await run_batch(main_bot, batch_id, audience, payload,
+                            position=position, stats=stats)
+
+    # Create Delete Button
+    delete_kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text="🗑 حذف پیام‌های این ارسال (Delete All)", callback_data=f"del_batch:{batch_id}")]
+    ])
+
+    await message.answer(
+        f"✅ تمام شد.\n"
+        f"🆔 Batch ID: `{batch_id}`\n"
+        f"👥 مخاطبین: {len(audience)}\n"
+        f"🟢 موفق: {stats['success']}\n"
+        f"🔴 بلاک شده: {stats['blocked']}\n"
+        f"⚠️ خطا: {stats['failed']}\n\n"
+        f"⚠️ اگر اشتباهی رخ داده، با دکمه زیر می‌توانید پیام‌های ارسال شده را حذف کنید:",
+        reply_markup=delete_kb
+    )
+
+
+async def payload_from_batch(batch: dict):
+    """بازسازی محتوای ارسال از روی رکورد Batch (برای ادامه ارسال)"""
+    if batch.get("kind") == "survey":
+        survey = await db.get_survey(batch.get("survey_id"))
+        if not survey:
+            return None
+        return TextPayload(batch.get("text"), kb_survey_options(survey["survey_id"], survey.get("options", [])))
+
+    return CopyPayload(batch.get("messages_data", []), await kb_dynamic_casts(db))
+
+
+@router.message(Command("resume_batch"))
+async def resume_broadcast(message: Message, command: CommandObject):
+    """
+    ادامه ارسال یک Batch نیمه‌تمام از روی snapshot ذخیره شده.
+    Usage: /resume_batch <batch_id>
+    """
+    if not is_admin(message.from_user.id):
+        return
+
+    batch_id = (command.args or "").strip()
+    batch = await db.get_broadcast_batch(batch_id) if batch_id else None
+    if not batch:
+        await message.answer("❌ Batch یافت نشد.\nUsage: `/resume_batch <batch_id>`")
+        return
+
+    if batch.get("status") == "completed":
+        await message.answer("✅ این Batch قبلاً کامل ارسال شده است.")
+        return
+
+    audience = await db.load_audience_snapshot(batch_id)
+    payload = await payload_from_batch(batch)
+    position = batch.get("position", 0)
+    if not audience or payload is None:
+        await message.answer("❌ snapshot مخاطبین یا محتوای این Batch موجود نیست.")
+        return
+
+    await message.answer(f"🔁 ادامه ارسال از {position}/{len(audience)}...\n🆔 `{batch_id}`")
+    stats = {
+        "success": batch.get("sent_count", 0),
+        "blocked": batch.get("blocked_count", 0),
+        "failed": batch.get("failed_count", 0)
+    }
+    await run_broadcast(message, batch_id, payload, audience, position=position, stats=stats)
+
+
 @router.message(BroadcastFlow.collecting_messages)
 async def collect_broadcast_msgs(message: Message, state: FSMContext, bot: Bot):
     if message.text == "❌ انصراف":
@@ -226,11 +445,14 @@ async def collect_broadcast_msgs(message: Message, state: FSMContext, bot: Bot):
         msgs = data.get("messages", [])
 
         # Check Mode
-        mode = data.get("mode", "range")  # range, test, manual, all
-        target_users_list = data.get("target_users", [])
+        mode = data.get("mode", "range")  # range, test, manual, all, segment
+
+        if not msgs:
+            await message.answer("هیچ پیامی ارسال نکردید!")
+            return
 
-        # Logic to determine recipients
-        users = []
+        # Logic to determine recipients (materialized once into a packed snapshot)
+        audience = new_id_array()
         start_ts = 0
         end_ts = 0
 
@@ -238,74 +460,29 @@ async def collect_broadcast_msgs(message: Message, state: FSMContext, bot: Bot):
             # Existing Logic
             start_ts = data.get("start_ts", 0)
             end_ts = data.get("end_ts", time.time())
-            users = await db.get_users_in_range(start_ts, end_ts)
+            audience = await db.collect_user_ids(db.range_query(start_ts, end_ts))
+
+        elif mode == "segment":
+            source, query, _ = await compile_segment(data.get("segment", {}))
+            if query is not None:
+                audience = await db.collect_user_ids(query, source)
 
         elif mode in ["test", "manual"]:
             # New Logic for Test/Manual
-            users = target_users_list
-            # Set fake timestamps for logging purposes
-            start_ts = 0
-            end_ts = 0
-
-        if not msgs:
-            await message.answer("هیچ پیامی ارسال نکردید!")
-            return
+            audience = new_id_array(data.get("target_ids", []))
 
-        if not users:
+        if not audience:
             await message.answer("کاربری برای ارسال پیدا نشد.")
             return
 
         # 1. Create a random batch ID
         batch_id = str(uuid.uuid4())
-
-        await message.answer(f"🚀 در حال ارسال برای {len(users)} نفر ({mode})...\n🆔 شناسه ارسال: `{batch_id}`")
-
-        # Save batch info
-        await db.save_broadcast_batch(batch_id, start_ts, end_ts, len(users), msgs)
-
-        success = 0
-        blocked = 0
-
-        # --- LOOP SENDING ---
-        for u in users:
-            try:
-                for m in msgs:
-                    start_time = time.perf_counter()
-
-                    keyboards = await kb_dynamic_casts(db)
-                    sent_msg = await main_bot.copy_message(u['user_id'], m['chat_id'], m['message_id'], reply_markup=keyboards)
-                    await db.save_broadcast_log(batch_id, u['user_id'], sent_msg.message_id)
-
-                    elapsed = time.perf_counter() - start_time
-                    if elapsed < 0.05:
-                        await asyncio.sleep(max(0, 0.05 - elapsed))
-
-                success += 1
-            except Exception as e:
-                logger.error(f"single send error: {e}")
-                blocked += 1
-
-        await asyncio.sleep(0.1)
-
-        await db.update_broadcast_batch_stats(batch_id, success, blocked)
-
-        # Create Delete Button
-        delete_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text="🗑 حذف پیام‌های این ارسال (Delete All)", callback_data=f"del_batch:{batch_id}")]
-        ])
-
-        await message.answer(
-            f"✅ تمام شد.\n"
-            f"🆔 Batch ID: `{batch_id}`\n"
-            f"🟢 موفق: {success}\n"
-            f"🔴 ناموفق: {blocked}\n\n"
-            f"⚠️ اگر اشتباهی رخ داده، با دکمه زیر می‌توانید پیام‌های ارسال شده را حذف کنید:",
-            reply_markup=delete_kb
-        )
-        await asyncio.sleep(0.1)
-
         await state.clear()
+
+        payload = CopyPayload(msgs, await kb_dynamic_casts(db))
+        await start_batch(message, batch_id, audience, payload, mode,
+                          start_ts=start_ts, end_ts=end_ts, messages=msgs,
+                          segment=data.get("segment"))
         await message.answer("🏠 بازگشت به منوی اصلی:", reply_markup=kb_main_menu())
         return
 
@@ -337,8 +514,8 @@ async def filter_test_users(message: Message, state: FSMContext):
         await message.answer("❌ هیچ کاربر تستی (test: true) در دیتابیس یافت نشد.")
         return
 
-    # Store the specific list of users in state
-    await state.update_data(target_users=test_users, mode="test")
+    # Store only the plain ids in state
+    await state.update_data(target_ids=[u['user_id'] for u in test_users], mode="test")
 
     await message.answer(
         f"🧪 حالت تست فعال شد.\n👥 تعداد گیرندگان: {len(test_users)} نفر\n\n👇 پیام خود را ارسال کنید:",
@@ -375,8 +552,8 @@ async def filter_manual_process(message: Message, state: FSMContext):
     try:
         for item in raw_text.split():
             if item.isdigit():
-                # specific structure for your loop: {'user_id': 123}
-                id_list.append({'user_id': int(item)})
+                id_list.append(int(item))
+        id_list = list(dict.fromkeys(id_list))
     except Exception:
         await message.answer("❌ فرمت اشتباه است. فقط عدد ارسال کنید.")
         return
@@ -385,7 +562,7 @@ async def filter_manual_process(message: Message, state: FSMContext):
         await message.answer("❌ هیچ ID معتبری یافت نشد. دوباره تلاش کنید.")
         return
 
-    await state.update_data(target_users=id_list, mode="manual")
+    await state.update_data(target_ids=id_list, mode="manual")
     await message.answer(
         f"✅ {len(id_list)} کاربر انتخاب شدند.\n👇 پیام خود را ارسال کنید:",
         reply_markup=kb_broadcast_actions()
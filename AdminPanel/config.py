@@ -9,7 +9,14 @@ CONF = {
     "MONGO_URL": os.getenv("MONGODB_URL", "mongodb://localhost:27017"),
     "DB_NAME": os.getenv("DB_NAME", "act_cast_db"),
     "ADMIN_IDS": [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x],
-    "STORAGE_CHANNEL_ID": int(os.getenv("STORAGE_CHANNEL_ID", "0"))
+    "STORAGE_CHANNEL_ID": int(os.getenv("STORAGE_CHANNEL_ID", "0")),
+    # محدودیت سراسری ارسال به API تلگرام (درخواست در ثانیه) و تعداد ورکرها
+    "SEND_RATE": float(os.getenv("SEND_RATE", "25")),
+    "SEND_CONCURRENCY": int(os.getenv("SEND_CONCURRENCY", "8")),
+    # تلگرام پیام‌های قدیمی‌تر از ۴۸ ساعت را حذف نمی‌کند
+    "DELETE_WINDOW_HOURS": int(os.getenv("DELETE_WINDOW_HOURS", "48")),
+    # مدت اعتبار پیش‌فرض نظرسنجی‌ها به ساعت (0 یعنی بدون انقضا)
+    "SURVEY_TTL_HOURS": int(os.getenv("SURVEY_TTL_HOURS", "0")),
 }
 
 # چک کردن مقادیر حیاتی
@@ -1,7 +1,25 @@
 import asyncio
+import re
+from array import array
+from typing import Optional
+from bson import ObjectId
+from bson.binary import Binary
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from config import CONF
-from datetime import datetime
+from datetime import datetime, timedelta
+from audience import new_id_array, pack_ids, unpack_ids, iter_chunks
+
+
+# باید با OPENED_BITS_PER_WORD ربات اصلی یکسان باشد
+OPENED_BITS_PER_WORD = 63
+
+
+def opened_bit_index(ordinal: int):
+    """ordinal کست -> (فیلد word در users.opened, شماره بیت)  مثال: 65 -> ("opened.1", 2)
+    (برای $bitsAllClear؛ نسخه ربات اصلی opened_mask ماسک 1 << bit را برمی‌گرداند)"""
+    word, bit = divmod(ordinal, OPENED_BITS_PER_WORD)
+    return f"opened.{word}", bit
 
 
 class DatabaseService:
@@ -12,6 +30,28 @@ class DatabaseService:
         self.users = self.db["users"]
         self.broadcast_logs = self.db["broadcast_logs"]
         self.keyword_replies = self.db["keyword_replies"]
+        self.broadcast_audiences = self.db["broadcast_audiences"]
+        self.signup_rollup = self.db["signup_rollup"]
+        self.survey_votes = self.db["survey_votes"]
+
+    async def ensure_indexes(self):
+        """Creates the indexes the admin queries rely on (idempotent)."""
+        await self.broadcast_logs.create_index([("batch_id", 1), ("sent_at", 1)])
+        # فیلترهای مخاطبین (تاریخ عضویت و سگمنت‌های رفتاری)
+        await self.users.create_index("user_id")
+        await self.users.create_index("created_at")
+        await self.users.create_index("history.value")
+        # index: tested_at؛ کوئری tested_at = null (تست نداده‌اند) با بازه [null, null] ایندکس اجرا می‌شود
+        await self.users.create_index("tested_at")
+        await self.broadcast_audiences.create_index([("batch_id", 1), ("seq", 1)])
+        await self.signup_rollup.create_index("hour")
+        await self.signup_rollup.create_index([("year", 1), ("month", 1), ("day", 1)])
+        await self.survey_votes.create_index(
+            [("survey_id", 1), ("user_id", 1)], unique=True)
+        await self.survey_votes.create_index([("survey_id", 1), ("option_id", 1)])
+        # جستجوی پیشوندی در لیست‌های ادمین
+        await self.casts.create_index("name")
+        await self.keyword_replies.create_index("keyword")
 
     async def add_new_cast(self, name: str, chat_id: int, message_id: int):
         new_cast = {
@@ -20,81 +60,303 @@ class DatabaseService:
             "source_message_id": message_id,
             "created_at": asyncio.get_event_loop().time()
         }
+        existing = await self.casts.find_one({"name": name}, {"ordinal": 1})
+        if not existing or "ordinal" not in existing:
+            # ordinal ثابت کست (شماره بیت در بیت‌مپ users.opened)؛ هرگز دوباره استفاده نمی‌شود
+            new_cast["ordinal"] = await self.next_cast_ordinal()
+
         await self.casts.update_one(
             {"name": name},
             {"$set": new_cast},
             upsert=True
         )
 
+    async def next_cast_ordinal(self) -> int:
+        counter = await self.db["counters"].find_one_and_update(
+            {"_id": "cast_ordinal"},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"] - 1
+
     async def delete_cast(self, name: str):
         result = await self.casts.delete_one({"name": name})
         return result.deleted_count > 0
 
+    def _list_source(self, kind: str):
+        """kind: c = casts, k = keyword replies -> (collection, name field)"""
+        if kind == "k":
+            return self.keyword_replies, "keyword"
+        return self.casts, "name"
+
+    async def get_list_page(self, kind: str, prefix: str = None, after: str = None,
+                            before: str = None, start: str = None, limit: int = 10):
+        """
+        صفحه‌بندی cursor-based روی _id (هزینه هر صفحه مستقل از اندازه کل لیست است).
+        after: صفحه بعد از این _id | before: صفحه قبل از این _id | start: صفحه از این _id به بعد
+        Returns (docs, has_prev, has_next)
+        """
+        collection, field = self._list_source(kind)
+        query = {}
+        if prefix:
+            # regex پیشوندی (^) از ایندکس فیلد نام استفاده می‌کند
+            query[field] = {"$regex": f"^{re.escape(prefix)}"}
+
+        direction = 1
+        if after:
+            query["_id"] = {"$gt": ObjectId(after)}
+        elif before:
+            query["_id"] = {"$lt": ObjectId(before)}
+            direction = -1
+        elif start:
+            query["_id"] = {"$gte": ObjectId(start)}
+
+        cursor = collection.find(query, {field: 1}).sort(
+            "_id", direction).limit(limit + 1)
+        docs = await cursor.to_list(length=limit + 1)
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+
+        if before:
+            docs.reverse()
+            return docs, has_more, True
+
+        has_prev = False
+        if docs and (after or start):
+            prev_query = {k: v for k, v in query.items() if k != "_id"}
+            prev_query["_id"] = {"$lt": docs[0]["_id"]}
+            has_prev = await collection.find_one(prev_query, {"_id": 1}) is not None
+        return docs, has_prev, has_more
+
+    async def delete_list_item(self, kind: str, item_id: str):
+        """حذف یک آیتم لیست با _id؛ نام آیتم حذف شده (یا None) برگردانده می‌شود."""
+        collection, field = self._list_source(kind)
+        doc = await collection.find_one_and_delete({"_id": ObjectId(item_id)}, {field: 1})
+        return doc.get(field) if doc else None
+
     async def get_all_cast_names(self):
         cursor = self.casts.find({}, {"name": 1})
         return await cursor.to_list(length=None)
 
-    async def get_users_in_range(self, start_ts: float, end_ts: float):
+    def range_query(self, start_ts: float, end_ts: float) -> dict:
         """
-        دریافت کاربران با تبدیل Timestamp ورودی به DateTime قابل فهم برای مونگو
+        ساخت کوئری بازه عضویت با تبدیل Timestamp ورودی به DateTime قابل فهم برای مونگو
         """
-
-        start_date = datetime.fromtimestamp(start_ts)
-        end_date = datetime.fromtimestamp(end_ts)
-
-        query = {
+        return {
             "created_at": {
-                "$gte": start_date,
-                "$lte": end_date
+                "$gte": datetime.fromtimestamp(start_ts),
+                "$lte": datetime.fromtimestamp(end_ts)
             }
         }
 
-        cursor = self.users.find(query, {"user_id": 1})
+    async def count_signups(self, start_ts: float, end_ts: float) -> int:
+        """
+        تعداد عضویت‌های یک بازه از روی شمارنده ساعتی signup_rollup (بدون خواندن کاربران)
+        """
+        pipeline = [
+            {"$match": {"hour": {
+                "$gte": datetime.fromtimestamp(start_ts),
+                "$lt": datetime.fromtimestamp(end_ts)
+            }}},
+            {"$group": {"_id": None, "count": {"$sum": "$count"}}}
+        ]
+        result = await self.signup_rollup.aggregate(pipeline).to_list(length=1)
+        return result[0]["count"] if result else 0
+
+    async def get_signup_counts(self, year: int = None, month: int = None, day: int = None) -> dict:
+        """
+        تعداد عضویت‌ها به تفکیک سال، یا ماه‌های یک سال، یا روزهای یک ماه، یا ساعت‌های یک روز.
+        خروجی: {value: count}
+        """
+        match = {}
+        group_field = "$year"
+        if year is not None:
+            match["year"] = year
+            group_field = "$month"
+        if month is not None:
+            match["month"] = month
+            group_field = "$day"
+        if day is not None:
+            match["day"] = day
+            group_field = "$h"
+
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": group_field, "count": {"$sum": "$count"}}}
+        ]
+        result = await self.signup_rollup.aggregate(pipeline).to_list(length=None)
+        return {item["_id"]: item["count"] for item in result}
+
+    async def collect_user_ids(self, query: dict, collection=None) -> array:
+        """
+        Streams matching user_ids into a packed int64 array instead of a list of dicts.
+        collection: any collection whose documents carry user_id (default: users).
+        """
+        ids = new_id_array()
+        collection = self.users if collection is None else collection
+        cursor = collection.find(
+            query, {"user_id": 1, "_id": 0}).batch_size(5000)
+        async for user in cursor:
+            if "user_id" in user:
+                ids.append(user["user_id"])
+        return ids
+
+    async def save_audience_snapshot(self, batch_id: str, ids: array):
+        """
+        Stores the materialized audience of a batch as chunked binary documents.
+        """
+        docs = [
+            {
+                "batch_id": batch_id,
+                "seq": seq,
+                "count": len(chunk),
+                "ids": Binary(pack_ids(chunk))
+            }
+            for seq, chunk in enumerate(iter_chunks(ids))
+        ]
+        if docs:
+            await self.broadcast_audiences.insert_many(docs)
+
+    async def load_audience_snapshot(self, batch_id: str) -> array:
+        ids = new_id_array()
+        cursor = self.broadcast_audiences.find(
+            {"batch_id": batch_id}).sort("seq", 1)
+        async for doc in cursor:
+            unpack_ids(doc["ids"], into=ids)
+        return ids
+
+    async def count_users(self, query: dict, collection=None) -> int:
+        """Estimated audience size of a filter, without fetching documents."""
+        collection = self.users if collection is None else collection
+        return await collection.count_documents(query)
+
+    async def get_recent_surveys(self, limit: int = 20):
+        cursor = self.db["surveys"].find(
+            {}, {"question": 1, "options": 1, "status": 1}).sort("created_at", -1).limit(limit)
         return await cursor.to_list(length=None)
 
-    async def save_broadcast_log(self, batch_id: str, user_id: int, message_id: int):
+    async def get_survey_results(self, survey_oid):
+        """سوال، گزینه‌ها و شمارنده‌های آرای یک نظرسنجی (بدون اسکن آرا)"""
+        return await self.db["surveys"].find_one(
+            {"_id": survey_oid},
+            {"survey_id": 1, "question": 1, "options": 1, "option_counts": 1,
+             "total_votes": 1, "status": 1, "closes_at": 1, "batch_ids": 1}
+        )
+
+    async def save_broadcast_logs(self, logs: list):
         """
-        Saves a record of a sent message to allow future deletion.
+        Saves records of sent messages (one bulk insert) to allow future deletion.
         """
-        log_entry = {
-            "batch_id": batch_id,
-            "user_id": user_id,
-            "message_id": message_id,
-            "sent_at": datetime.now()
-        }
-        await self.broadcast_logs.insert_one(log_entry)
+        if logs:
+            await self.broadcast_logs.insert_many(logs, ordered=False)
 
-    async def get_broadcast_logs(self, batch_id: str):
+    async def get_broadcast_logs(self, batch_id: str, since: datetime):
         """
-        Retrieves all message IDs associated with a specific broadcast batch.
+        Retrieves the message IDs of a batch that are still deletable:
+        sent after `since` and not already deleted by a previous run.
         """
         cursor = self.broadcast_logs.find(
-            {"batch_id": batch_id}, {"user_id": 1, "message_id": 1})
+            {
+                "batch_id": batch_id,
+                "sent_at": {"$gte": since},
+                "deleted_at": {"$exists": False}
+            },
+            {"user_id": 1, "message_id": 1}
+        )
         return await cursor.to_list(length=None)
 
+    async def count_expired_broadcast_logs(self, batch_id: str, since: datetime):
+        """Counts logs of a batch that are too old for Telegram to delete."""
+        return await self.broadcast_logs.count_documents({
+            "batch_id": batch_id,
+            "sent_at": {"$lt": since},
+            "deleted_at": {"$exists": False}
+        })
+
+    async def mark_broadcast_logs_deleted(self, log_ids: list):
+        """Marks logs as deleted so repeated runs skip them."""
+        if not log_ids:
+            return
+        await self.broadcast_logs.update_many(
+            {"_id": {"$in": log_ids}},
+            {"$set": {"deleted_at": datetime.now()}}
+        )
+
     async def get_all_casts(self):
-        """Fetches all casts to generate buttons."""
-        cursor = self.casts.find()
+        """Fetches the name and category of all casts (in creation order) to generate buttons."""
+        cursor = self.casts.find({}, {"name": 1, "category": 1}).sort("_id", 1)
         return await cursor.to_list(length=None)
 
-    async def save_broadcast_batch(self, batch_id: str, start_ts: float, end_ts: float, total_users: int, messages: list):
+    async def set_cast_category(self, name: str, category: str) -> bool:
+        """دسته‌بندی کست در منوی کاربران (category خالی = بدون دسته)"""
+        if category:
+            update = {"$set": {"category": category}}
+        else:
+            update = {"$unset": {"category": ""}}
+        result = await self.casts.update_one({"name": name}, update)
+        return result.matched_count > 0
+
+    async def set_cast_drip(self, name: str, hours: Optional[float], after: Optional[str] = None) -> bool:
+        """
+        زمان‌بندی باز شدن تدریجی کست: hours ساعت بعد از عضویت کاربر (after خالی)
+        یا بعد از باز کردن کست after. hours=None زمان‌بندی را حذف می‌کند.
+        (صف ارسال drip_queue توسط ربات اصلی پر و خالی می‌شود.)
+        """
+        if hours is None:
+            update = {"$unset": {"unlock_hours": "", "unlock_after": ""}}
+        elif after:
+            update = {"$set": {"unlock_hours": hours, "unlock_after": after}}
+        else:
+            update = {"$set": {"unlock_hours": hours}, "$unset": {"unlock_after": ""}}
+        result = await self.casts.update_one({"name": name}, update)
+        return result.matched_count > 0
+
+    async def save_broadcast_batch(self, batch_id: str, start_ts: float, end_ts: float, total_users: int, messages: list,
+                                   segment: dict = None, kind: str = "broadcast", survey_id: str = None, text: str = None):
         """
         Creates the batch record with initial status 'processing'.
+        kind: broadcast (copy of stored messages) or survey (text + survey buttons)
         """
         batch_data = {
             "batch_id": batch_id,
+            "kind": kind,
+            "survey_id": survey_id,
+            "text": text,
             "filter_start_ts": start_ts,
             "filter_end_ts": end_ts,
+            "segment": segment,
             "total_users_target": total_users,
             "messages_data": messages,  # Optional: save what messages were sent
+            "position": 0,  # تعداد گیرندگان پردازش شده از snapshot
             "created_at": datetime.now(),
             "status": "processing",  # 🟡 Initial status
             "sent_count": 0,
-            "blocked_count": 0
+            "blocked_count": 0,
+            "failed_count": 0
         }
         await self.db["broadcast_batches"].insert_one(batch_data)
 
-    async def update_broadcast_batch_stats(self, batch_id: str, success: int, blocked: int):
+    async def update_broadcast_progress(self, batch_id: str, position: int, stats: dict):
+        """
+        Saves how far into the audience snapshot the sender has got, for resuming.
+        """
+        await self.db["broadcast_batches"].update_one(
+            {"batch_id": batch_id},
+            {
+                "$set": {
+                    "position": position,
+                    "sent_count": stats["success"],
+                    "blocked_count": stats["blocked"],
+                    "failed_count": stats["failed"]
+                }
+            }
+        )
+
+    async def get_broadcast_batch(self, batch_id: str):
+        return await self.db["broadcast_batches"].find_one({"batch_id": batch_id})
+
+    async def update_broadcast_batch_stats(self, batch_id: str, stats: dict):
         """
         Updates the batch status to 'completed' with final counts.
         """
@@ -103,8 +365,9 @@ class DatabaseService:
             {
                 "$set": {
                     "status": "completed",      # 🟢 Final status
-                    "sent_count": success,
-                    "blocked_count": blocked,
+                    "sent_count": stats["success"],
+                    "blocked_count": stats["blocked"],
+                    "failed_count": stats["failed"],
                     "finished_at": datetime.now()
                 }
             }
@@ -168,18 +431,72 @@ class DatabaseService:
         ساخت یک نظرسنجی جدید.
         options ساختاری مثل این دارد: [{'id': 'opt1', 'text': 'گزینه ۱', 'reply': 'پاسخ مخفی'}]
         """
+        now = datetime.now()
+        ttl = CONF["SURVEY_TTL_HOURS"]
         survey_data = {
             "survey_id": survey_id,
             "question": question,
             "options": options,
-            "created_at": datetime.now(),
-            "votes": {}  # user_id: option_id
+            "created_at": now,
+            # open / closed ؛ بعد از closes_at هم نظرسنجی بسته حساب می‌شود
+            "status": "open",
+            "closes_at": now + timedelta(hours=ttl) if ttl else None,
+            "batch_ids": [],
+            # شمارنده‌های زنده آرا (توسط ربات اصلی با $inc به‌روز می‌شوند)
+            "option_counts": {opt['id']: 0 for opt in options},
+            "total_votes": 0
         }
-        await self.db["surveys"].insert_one(survey_data)
+        # ارسال تستی و همگانی یک نظرسنجی نباید دو داکیومنت بسازد
+        await self.db["surveys"].update_one(
+            {"survey_id": survey_id},
+            {"$setOnInsert": survey_data},
+            upsert=True
+        )
+
+    async def attach_survey_batch(self, survey_id: str, batch_id: str):
+        """ثبت Batch ارسال روی نظرسنجی (برای پاک کردن دکمه‌ها بعد از بسته شدن)"""
+        await self.db["surveys"].update_one(
+            {"survey_id": survey_id},
+            {"$addToSet": {"batch_ids": batch_id}}
+        )
+
+    async def set_survey_status(self, survey_id: str, status: str):
+        """
+        بستن یا بازگشایی نظرسنجی. بازگشایی انقضای قبلی را هم حذف می‌کند.
+        """
+        update = {"status": status, "updated_at": datetime.now()}
+        if status == "closed":
+            update["closed_at"] = datetime.now()
+        else:
+            update["closes_at"] = None
+            update["final_reported"] = False
+        result = await self.db["surveys"].update_one(
+            {"survey_id": survey_id}, {"$set": update})
+        return result.matched_count > 0
+
+    async def get_unstripped_survey_logs(self, batch_ids: list):
+        """لاگ پیام‌های نظرسنجی که هنوز دکمه‌هایشان پاک نشده است"""
+        cursor = self.broadcast_logs.find(
+            {
+                "batch_id": {"$in": batch_ids},
+                "deleted_at": {"$exists": False},
+                "markup_stripped": {"$exists": False}
+            },
+            {"user_id": 1, "message_id": 1}
+        )
+        return await cursor.to_list(length=None)
+
+    async def mark_logs_markup_stripped(self, log_ids: list):
+        if not log_ids:
+            return
+        await self.broadcast_logs.update_many(
+            {"_id": {"$in": log_ids}},
+            {"$set": {"markup_stripped": True}}
+        )
 
     async def get_survey(self, survey_id: str):
-        """دریافت اطلاعات کامل یک نظرسنجی"""
-        return await self.db["surveys"].find_one({"survey_id": survey_id})
+        """دریافت اطلاعات یک نظرسنجی (آرا در کالکشن survey_votes هستند)"""
+        return await self.db["surveys"].find_one({"survey_id": survey_id}, {"votes": 0})
 
    
 
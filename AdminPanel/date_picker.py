@@ -10,20 +10,26 @@ class DateCallback(CallbackData, prefix="dt"):
     value: int
     stage: str   # start_date یا end_date
 
-def get_years_kb(stage: str):
+def _label(text: str, counts: dict, key: int):
+    # نمایش تعداد عضویت‌ها در کنار هر دکمه (در صورت وجود)
+    if counts is None:
+        return text
+    return f"{text} ({counts.get(key, 0)})"
+
+def get_years_kb(stage: str, counts: dict = None):
     current_year = datetime.datetime.now().year
     years = [current_year, current_year - 1, current_year - 2]
     
     buttons = []
     for y in years:
         buttons.append(InlineKeyboardButton(
-            text=str(y),
+            text=_label(str(y), counts, y),
             callback_data=DateCallback(action="year", value=y, stage=stage).pack()
         ))
     
     return InlineKeyboardMarkup(inline_keyboard=[buttons])
 
-def get_months_kb(year: int, stage: str):
+def get_months_kb(year: int, stage: str, counts: dict = None):
     # ماه‌ها را به صورت 3 ردیف 4 تایی می‌چینه
     months = list(range(1, 13))
     rows = []
@@ -31,7 +37,7 @@ def get_months_kb(year: int, stage: str):
     
     for m in months:
         temp_row.append(InlineKeyboardButton(
-            text=f"{m:02d}", # نمایش به صورت 01, 02
+            text=_label(f"{m:02d}", counts, m), # نمایش به صورت 01, 02
             callback_data=DateCallback(action="month", value=m, stage=stage).pack()
         ))
         if len(temp_row) == 4:
@@ -40,7 +46,7 @@ def get_months_kb(year: int, stage: str):
             
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def get_days_kb(year: int, month: int, stage: str):
+def get_days_kb(year: int, month: int, stage: str, counts: dict = None):
     # محاسبه تعداد روزهای آن ماه خاص
     days_count = monthrange(year, month)[1]
     
@@ -49,7 +55,7 @@ def get_days_kb(year: int, month: int, stage: str):
     
     for d in range(1, days_count + 1):
         temp_row.append(InlineKeyboardButton(
-            text=str(d),
+            text=_label(str(d), counts, d),
             callback_data=DateCallback(action="day", value=d, stage=stage).pack()
         ))
         if len(temp_row) == 7: # هفته‌ای 7 روز
@@ -61,13 +67,13 @@ def get_days_kb(year: int, month: int, stage: str):
         
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def get_hours_kb(stage: str):
+def get_hours_kb(stage: str, counts: dict = None):
     # ساعت‌ها 0 تا 23
     rows = []
     temp_row = []
     for h in range(0, 24):
         temp_row.append(InlineKeyboardButton(
-            text=f"{h:02d}:00",
+            text=_label(f"{h:02d}:00", counts, h),
             callback_data=DateCallback(action="hour", value=h, stage=stage).pack()
         ))
         if len(temp_row) == 4:
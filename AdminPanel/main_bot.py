@@ -6,6 +6,7 @@ from aiogram.enums import ParseMode
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 )
+from aiogram.utils.keyboard import InlineKeyboardBuilder
 from config import CONF
 
 main_bot = Bot(
@@ -14,14 +15,26 @@ main_bot = Bot(
 )
 
 
+# باید با دکمه‌ها و اندازه صفحه منوی ربات اصلی یکسان باشد
+BTN_NEXT_PAGE = "صفحه بعد ⬅️"
+MENU_PAGE_SIZE = 6
+
+
 async def kb_dynamic_casts(db_service):
     """
-    Dynamically creates a ReplyKeyboard based on 'casts' collection in DB.
+    Creates the first page of the users' casts menu (same layout as the main bot),
+    so broadcast messages carry a small keyboard instead of every cast.
     """
     casts = await db_service.get_all_casts()
 
+    # صفحه اول = اولین دسته (به ترتیب ساخت)، حداکثر MENU_PAGE_SIZE کست
+    first_category = (casts[0].get("category") or "") if casts else ""
+    same_category = [c for c in casts if (c.get("category") or "") == first_category]
+    page = same_category[:MENU_PAGE_SIZE]
+    has_next = len(casts) > len(page)
+
     buttons = []
-    for cast in casts:
+    for cast in page:
         buttons.append(KeyboardButton(text=cast.get("name", "Cast")))
 
     keyboard = []
@@ -34,9 +47,25 @@ async def kb_dynamic_casts(db_service):
     if row:
         keyboard.append(row)
 
+    if has_next:
+        keyboard.append([KeyboardButton(text=BTN_NEXT_PAGE)])
+
     # keyboard.append([KeyboardButton(text="🎧 پشتیبانی")])
 
     return ReplyKeyboardMarkup(keyboard=keyboard,
                                resize_keyboard=True,
                                one_time_keyboard=False,
                                selective=False)
+
+
+def kb_survey_options(survey_id: str, options: list):
+    """
+    کیبورد شیشه‌ای گزینه‌های نظرسنجی که برای کاربران ارسال می‌شود.
+    callback format: surv:{survey_id}:{option_id}
+    """
+    builder = InlineKeyboardBuilder()
+    for opt in options:
+        builder.button(text=opt['text'],
+                       callback_data=f"surv:{survey_id}:{opt['id']}")
+    builder.adjust(1)
+    return builder.as_markup()
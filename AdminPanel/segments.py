@@ -0,0 +1,115 @@
+# segments.py
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from bson import ObjectId
+
+from database import db, opened_bit_index
+
+# سگمنت‌های رفتاری قابل انتخاب برای ارسال همگانی
+SEGMENT_KINDS = {
+    "opened": "✅ کسانی که کست X را باز کرده‌اند",
+    "not_opened": "🚫 کسانی که کست X را باز نکرده‌اند",
+    "no_test": "📝 کسانی که تست انعطاف‌پذیری را انجام نداده‌اند",
+    "voted": "📊 کسانی که در نظرسنجی Z گزینه Y را زده‌اند",
+}
+# تعداد کست در هر صفحه انتخاب کست (زیر سقف دکمه‌های کیبورد تلگرام)
+SEGMENT_CASTS_PAGE = 20
+
+
+class SegmentCallback(CallbackData, prefix="seg"):
+    kind: str       # opened, not_opened, no_test, voted
+    ref: str = ""   # ObjectId کست یا نظرسنجی
+    opt: str = ""   # شناسه گزینه نظرسنجی
+    page: str = ""  # n = صفحه بعد از ref | p = صفحه قبل از ref (صفحه‌بندی cursor-based کست‌ها)
+
+
+def kb_segment_kinds() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for kind, title in SEGMENT_KINDS.items():
+        builder.button(text=title, callback_data=SegmentCallback(kind=kind).pack())
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def kb_segment_casts(kind: str, casts: list, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for cast in casts:
+        builder.button(text=cast.get("name", "Cast"),
+                       callback_data=SegmentCallback(kind=kind, ref=str(cast["_id"])).pack())
+    builder.adjust(2)
+
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(
+            text="⬅️ قبلی", callback_data=SegmentCallback(kind=kind, ref=str(casts[0]["_id"]), page="p").pack()))
+    if has_next:
+        nav.append(InlineKeyboardButton(
+            text="بعدی ➡️", callback_data=SegmentCallback(kind=kind, ref=str(casts[-1]["_id"]), page="n").pack()))
+    if nav:
+        builder.row(*nav)
+    return builder.as_markup()
+
+
+def kb_segment_surveys(surveys: list) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for survey in surveys:
+        question = survey.get("question", "")
+        short_q = (question[:40] + '...') if len(question) > 40 else question
+        builder.button(text=short_q,
+                       callback_data=SegmentCallback(kind="voted", ref=str(survey["_id"])).pack())
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def kb_segment_options(survey: dict) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for opt in survey.get("options", []):
+        builder.button(text=opt['text'],
+                       callback_data=SegmentCallback(kind="voted", ref=str(survey["_id"]), opt=opt['id']).pack())
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+async def compile_segment(segment: dict):
+    """
+    سگمنت انتخاب شده را به یک کوئری تبدیل می‌کند؛ هر سند نتیجه یک user_id دارد.
+    Returns (collection, query, description) or (None, None, None) if the referenced item is gone.
+    """
+    kind = segment["kind"]
+
+    if kind == "no_test":
+        # index: tested_at (با شروع تست در ربات اصلی ثبت می‌شود)
+        return db.users, {"tested_at": None}, SEGMENT_KINDS[kind]
+
+    if kind in ("opened", "not_opened"):
+        cast = await db.casts.find_one({"_id": ObjectId(segment["ref"])}, {"name": 1, "ordinal": 1})
+        if not cast:
+            return None, None, None
+        name = cast["name"]
+        # index: history.value
+        if kind == "opened":
+            return db.users, {"history.value": name}, f"✅ باز کرده‌اند: «{name}»"
+
+        if "ordinal" in cast:
+            # تست یک بیت در بیت‌مپ کاربر (به جای پیمایش آرایه history با $ne)
+            # بدون ایندکس: اسکن users، اما با یک مقایسه بیتی ارزان برای هر سند
+            field, bit = opened_bit_index(cast["ordinal"])
+            query = {"$or": [{field: {"$exists": False}}, {field: {"$bitsAllClear": [bit]}}]}
+        else:
+            query = {"history.value": {"$ne": name}}
+        return db.users, query, f"🚫 باز نکرده‌اند: «{name}»"
+
+    if kind == "voted":
+        survey = await db.db["surveys"].find_one(
+            {"_id": ObjectId(segment["ref"])}, {"survey_id": 1, "options": 1})
+        if not survey:
+            return None, None, None
+        option = next((o for o in survey.get("options", [])
+                       if o['id'] == segment["opt"]), None)
+        # مخاطبین مستقیماً از survey_votes خوانده می‌شوند | index: (survey_id, option_id)
+        return (db.survey_votes,
+                {"survey_id": survey["survey_id"], "option_id": segment["opt"]},
+                f"📊 گزینه «{option['text'] if option else '?'}» را انتخاب کرده‌اند")
+
+    return None, None, None
@@ -0,0 +1,171 @@
+# sender.py
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from config import CONF
+from database import db
+
+logger = logging.getLogger("sender")
+
+# بعد از هر پنجره از گیرندگان، لاگ‌ها و پیشرفت ارسال ذخیره می‌شوند
+PROGRESS_WINDOW = 200
+
+
+class RateLimiter:
+    """
+    Token bucket برای محدود کردن تعداد درخواست‌ها به API تلگرام.
+    همه ورکرها از یک نمونه مشترک استفاده می‌کنند تا مجموع درخواست‌ها از سقف عبور نکند.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Stops all workers after a flood-wait response from Telegram."""
+        self.blocked_until = max(self.blocked_until,
+                                 time.monotonic() + seconds)
+        self.tokens = 0
+
+
+global_limiter = RateLimiter(rate=CONF["SEND_RATE"],
+                             burst=max(1, int(CONF["SEND_RATE"])))
+
+
+async def call_api(method: Callable[..., Awaitable[Any]], *args, retries: int = 3, **kwargs):
+    """
+    Calls a Bot API method through the global limiter.
+    On RetryAfter the whole limiter is paused and the call is retried.
+    """
+    for attempt in range(retries + 1):
+        await global_limiter.acquire()
+        try:
+            return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"Flood wait {e.retry_after}s, pausing sender...")
+            global_limiter.pause(e.retry_after)
+
+
+async def run_concurrent(items: Iterable, worker: Callable[[Any], Awaitable[Any]],
+                         concurrency: Optional[int] = None):
+    """
+    Runs `worker(item)` for every item with a fixed number of concurrent workers.
+    Workers pull from one shared iterator, so items are never held twice in memory.
+    """
+    iterator = iter(items)
+
+    async def _runner():
+        for item in iterator:
+            try:
+                await worker(item)
+            except Exception as e:
+                logger.error(f"worker error: {e}")
+
+    await asyncio.gather(*(_runner() for _ in range(concurrency or CONF["SEND_CONCURRENCY"])))
+
+
+# ---------------------------------------------------------
+# PAYLOADS: محتوایی که برای هر گیرنده ارسال می‌شود
+# ---------------------------------------------------------
+
+
+class CopyPayload:
+    """کپی یک یا چند پیام از کانال ذخیره (ارسال همگانی)"""
+
+    def __init__(self, messages: list, reply_markup=None):
+        self.messages = messages
+        self.reply_markup = reply_markup
+
+    async def send(self, bot: Bot, chat_id: int, sent_ids: list):
+        for m in self.messages:
+            sent = await call_api(bot.copy_message, chat_id=chat_id,
+                                  from_chat_id=m['chat_id'], message_id=m['message_id'],
+                                  reply_markup=self.reply_markup)
+            sent_ids.append(sent.message_id)
+
+
+class TextPayload:
+    """ارسال یک پیام متنی همراه با کیبورد (مثلاً نظرسنجی)"""
+
+    def __init__(self, text: str, reply_markup=None):
+        self.text = text
+        self.reply_markup = reply_markup
+
+    async def send(self, bot: Bot, chat_id: int, sent_ids: list):
+        sent = await call_api(bot.send_message, chat_id=chat_id,
+                              text=self.text, reply_markup=self.reply_markup)
+        sent_ids.append(sent.message_id)
+
+
+# ---------------------------------------------------------
+# ENGINE: ارسال یک Batch به تمام مخاطبین snapshot
+# ---------------------------------------------------------
+
+
+async def run_batch(bot: Bot, batch_id: str, audience, payload,
+                    position: int = 0, stats: Optional[dict] = None,
+                    on_progress: Optional[Callable[[int, dict], Awaitable[Any]]] = None) -> dict:
+    """
+    Sends `payload` to every user of the audience snapshot, starting at `position`.
+    Users are processed in windows of PROGRESS_WINDOW; after each window the logs are
+    bulk-inserted and the position is saved, so a crashed batch resumes from there.
+    """
+    stats = stats or {"success": 0, "blocked": 0, "failed": 0}
+    logs = []
+
+    async def send_one(user_id: int):
+        sent_ids = []
+        try:
+            await payload.send(bot, user_id, sent_ids)
+            stats["success"] += 1
+        except TelegramForbiddenError:
+            # کاربر ربات را بلاک کرده یا حساب حذف شده است
+            stats["blocked"] += 1
+        except Exception as e:
+            logger.error(f"single send error ({user_id}): {e}")
+            stats["failed"] += 1
+
+        now = datetime.now()
+        logs.extend({"batch_id": batch_id, "user_id": user_id, "message_id": mid, "sent_at": now}
+                    for mid in sent_ids)
+
+    for start in range(position, len(audience), PROGRESS_WINDOW):
+        end = min(start + PROGRESS_WINDOW, len(audience))
+        await run_concurrent(audience[start:end], send_one)
+
+        window_logs, logs = logs, []
+        await db.save_broadcast_logs(window_logs)
+        await db.update_broadcast_progress(batch_id, end, stats)
+        if on_progress:
+            await on_progress(end, stats)
+
+    await db.update_broadcast_batch_stats(batch_id, stats)
+    return stats
@@ -1,16 +1,31 @@
 import uuid
 import asyncio
+import logging
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from main_bot import main_bot, kb_dynamic_casts
-import time
+from main_bot import main_bot, kb_survey_options
 from config import CONF, is_admin
 from database import db
 from upload_content import kb_main_menu
+from bson import ObjectId
+from datetime import datetime
+from sender import call_api, run_concurrent, TextPayload
+from broadcast import start_batch
 survey_router = Router()
+logger = logging.getLogger("survey")
+
+# event loop فقط ارجاع ضعیف به taskها نگه می‌دارد؛ taskهای پس‌زمینه تا پایان اینجا نگه داشته می‌شوند
+background_tasks = set()
+
+
+def _background_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Background task failed: {task.exception()!r}")
 
 # ---------------------------------------------------------
 # STATES (وضعیت‌های ساخت نظرسنجی)
@@ -161,19 +176,12 @@ async def finalize_survey_creation(message: Message, state: FSMContext):
     await state.update_data(survey_id=survey_id)
 
     # ساخت کیبورد شیشه‌ای برای پیش‌نمایش
-    builder = InlineKeyboardBuilder()
-    for opt in options:
-        # callback format: surv:{survey_id}:{option_id}
-        builder.button(text=opt['text'],
-                       callback_data=f"surv:{survey_id}:{opt['id']}")
-    builder.adjust(1)
-
     await message.answer(
         "📋 **پیش‌نمایش نظرسنجی:**\n\n"
         f"{question}\n\n"
         "------------------\n"
         "آیا مایل به ارسال همگانی این نظرسنجی هستید؟",
-        reply_markup=builder.as_markup()
+        reply_markup=kb_survey_options(survey_id, options)
     )
 
     # کیبورد تصمیم‌گیری ادمین
@@ -207,85 +215,212 @@ async def confirm_survey_send(message: Message, state: FSMContext, bot: Bot):
     await db.create_survey(survey_id, question, options)
 
     # تعیین گیرندگان بر اساس دکمه زده شده
-    target_users = []
     is_test_mode = False
 
     if text == "ارسال همگانی":
         await message.answer("⏳ در حال جمع‌آوری کاربران و شروع ارسال همگانی...")
-        target_users = await db.users.find({}, {"user_id": 1}).to_list(length=None)
+        audience = await db.collect_user_ids({})
 
     elif text == "ارسال تستی":
         await message.answer("🧪 در حال ارسال به کاربران تستی...")
-        target_users = await db.get_test_users()
+        audience = await db.collect_user_ids({"test": True})
         is_test_mode = True
 
     else:
         return  # دستور ناشناخته
 
-    if not target_users:
+    if not audience:
         await message.answer("⚠️ کاربری برای ارسال یافت نشد.")
         return
 
-    # ساخت دکمه‌های شیشه‌ای نظرسنجی
+    # تولید شناسه یکتا برای این نوبت ارسال (Batch ID)
+    batch_id = str(uuid.uuid4())
+    await db.attach_survey_batch(survey_id, batch_id)
+
+    # ارسال از طریق همان موتور ارسال همگانی (آمار، لاگ و قابلیت حذف مشترک)
+    payload = TextPayload(question, kb_survey_options(survey_id, options))
+    await start_batch(message, batch_id, audience, payload,
+                      "نظرسنجی تستی" if is_test_mode else "نظرسنجی همگانی",
+                      start_ts=0, end_ts=0, messages=[],
+                      kind="survey", survey_id=survey_id, text=question)
+
+    await message.answer("منو:", reply_markup=kb_main_menu())
+    await state.clear()
+
+
+# ---------------------------------------------------------
+# HANDLERS: نتایج زنده نظرسنجی (از روی شمارنده‌ها)
+# ---------------------------------------------------------
+
+
+def is_survey_open(survey: dict) -> bool:
+    if survey.get("status") == "closed":
+        return False
+    closes_at = survey.get("closes_at")
+    return closes_at is None or closes_at > datetime.now()
+
+
+def format_survey_results(survey: dict) -> str:
+    question = survey.get("question", "")
+    short_q = (question[:100] + '...') if len(question) > 100 else question
+    counts = survey.get("option_counts", {})
+    total = survey.get("total_votes", 0)
+
+    if is_survey_open(survey):
+        closes_at = survey.get("closes_at")
+        status = f"🟢 باز (تا {closes_at:%Y-%m-%d %H:%M})" if closes_at else "🟢 باز"
+    else:
+        status = "🔴 بسته"
+
+    text = (
+        f"📈 **نتایج زنده نظرسنجی**\n"
+        f"❓ {short_q}\n"
+        f"🆔 `{survey.get('survey_id')}`\n"
+        f"📌 وضعیت: {status}\n"
+        f"👥 **تعداد کل آرا:** `{total}`\n"
+        f"──────────────────\n"
+    )
+    for opt in survey.get("options", []):
+        count = counts.get(opt['id'], 0)
+        percent = (count / total * 100) if total > 0 else 0
+        text += f"🔹 **{opt['text']}**: {count} ({percent:.1f}%)\n"
+    return text
+
+
+def kb_survey_admin(survey: dict) -> InlineKeyboardMarkup:
+    oid = survey['_id']
+    rows = [[InlineKeyboardButton(text="🔄 بروزرسانی", callback_data=f"sres:{oid}")]]
+    if is_survey_open(survey):
+        rows.append([InlineKeyboardButton(text="🔒 بستن نظرسنجی", callback_data=f"sst:close:{oid}")])
+        rows.append([InlineKeyboardButton(text="🧹 بستن + حذف دکمه‌ها از پیام کاربران",
+                                          callback_data=f"sst:strip:{oid}")])
+    else:
+        rows.append([InlineKeyboardButton(text="🔓 بازگشایی نظرسنجی", callback_data=f"sst:open:{oid}")])
+        rows.append([InlineKeyboardButton(text="🧹 حذف دکمه‌ها از پیام کاربران",
+                                          callback_data=f"sst:strip:{oid}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@survey_router.message(F.text == "📈 نتایج نظرسنجی")
+@survey_router.message(Command("survey_results"))
+async def cmd_survey_results(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+
+    surveys = await db.get_recent_surveys()
+    if not surveys:
+        await message.answer("📭 هیچ نظرسنجی‌ای وجود ندارد.")
+        return
+
     builder = InlineKeyboardBuilder()
-    for opt in options:
-        builder.button(text=opt['text'],
-                       callback_data=f"surv:{survey_id}:{opt['id']}")
+    for survey in surveys:
+        question = survey.get("question", "")
+        short_q = (question[:40] + '...') if len(question) > 40 else question
+        icon = "🔴" if survey.get("status") == "closed" else "🟢"
+        builder.button(text=f"{icon} {short_q}", callback_data=f"sres:{survey['_id']}")
     builder.adjust(1)
-    markup = builder.as_markup()
 
-    # تولید شناسه یکتا برای این نوبت ارسال (Batch ID)
-    batch_id = str(uuid.uuid4())
+    await message.answer("👇 نظرسنجی مورد نظر را انتخاب کنید:", reply_markup=builder.as_markup())
 
-    count = 0
-    blocked = 0
 
-    # شروع لوپ ارسال
-    for u in target_users:
+@survey_router.callback_query(F.data.startswith("sres:"))
+async def show_survey_results(callback: CallbackQuery):
+    survey = await db.get_survey_results(ObjectId(callback.data.split(":")[1]))
+    if not survey:
+        await callback.answer("❌ نظرسنجی یافت نشد.", show_alert=True)
+        return
+
+    try:
+        await callback.message.edit_text(format_survey_results(survey), reply_markup=kb_survey_admin(survey))
+    except Exception:
+        # متن تغییری نکرده است
+        pass
+    await callback.answer()
+
+
+# ---------------------------------------------------------
+# HANDLERS: بستن / بازگشایی نظرسنجی و پاک کردن دکمه‌های قدیمی
+# ---------------------------------------------------------
+
+
+async def strip_survey_buttons(survey: dict, status_message: Message):
+    """
+    دکمه‌های شیشه‌ای نظرسنجی را از پیام‌های ارسال شده حذف می‌کند (در پس‌زمینه و با محدودیت نرخ).
+    پیام‌هایی که قبلاً پاک‌سازی شده‌اند دوباره پردازش نمی‌شوند.
+    """
+    logs = await db.get_unstripped_survey_logs(survey.get("batch_ids", []))
+    stats = {"done": 0, "errors": 0}
+    pending_marks = []
+
+    async def strip_one(log):
         try:
-            start_time = time.perf_counter()
-
-            # ارسال پیام
-            sent_msg = await main_bot.send_message(chat_id=u['user_id'], text=question, reply_markup=markup)
-
-            # --- ذخیره لاگ پیام برای قابلیت حذف ---
-            # متد save_broadcast_log باید در database.py باشد
-            await db.save_broadcast_log(
-                batch_id=batch_id,
-                user_id=u['user_id'],
-                message_id=sent_msg.message_id
-            )
-            # ---------------------------------------
-
-            count += 1
-
-            # تاخیر کوچک برای جلوگیری از فلود (فقط در حالت همگانی مهم‌تر است)
-            elapsed = time.perf_counter() - start_time
-            if elapsed < 0.05:
-                await asyncio.sleep(max(0, 0.05 - elapsed))
-
-        except Exception as e:
-            # logger.error(f"Failed to send: {e}")
-            blocked += 1
-
-    # پیام پایانی با دکمه حذف
-    summary = (
-        f"✅ **ارسال {'تستی' if is_test_mode else 'همگانی'} پایان یافت.**\n\n"
-        f"📤 موفق: {count}\n"
-        f"🚫 ناموفق: {blocked}\n"
-        f"🆔 شناسه بچ: `{batch_id}`"
+            await call_api(main_bot.edit_message_reply_markup,
+                           chat_id=log['user_id'], message_id=log['message_id'], reply_markup=None)
+            stats["done"] += 1
+        except Exception:
+            # پیام حذف شده یا کاربر ربات را بلاک کرده است
+            stats["errors"] += 1
+        pending_marks.append(log['_id'])
+        if len(pending_marks) >= 500:
+            marks = pending_marks[:]
+            pending_marks.clear()
+            await db.mark_logs_markup_stripped(marks)
+
+    await run_concurrent(logs, strip_one)
+    await db.mark_logs_markup_stripped(pending_marks)
+
+    await status_message.answer(
+        f"🧹 **پاک‌سازی دکمه‌های نظرسنجی پایان یافت.**\n"
+        f"🆔 `{survey.get('survey_id')}`\n"
+        f"✅ موفق: {stats['done']}\n"
+        f"⚠️ ناموفق: {stats['errors']}"
     )
 
-    # ساخت دکمه حذف برای همین بچ
-    del_markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🗑 حذف پیام‌های این ارسال",
-                              callback_data=f"del_batch:{batch_id}")]
-    ])
 
-    await message.answer(summary, reply_markup=del_markup)
+@survey_router.callback_query(F.data.startswith("sst:"))
+async def change_survey_status(callback: CallbackQuery):
+    _, action, oid = callback.data.split(":")
+    survey = await db.get_survey_results(ObjectId(oid))
+    if not survey:
+        await callback.answer("❌ نظرسنجی یافت نشد.", show_alert=True)
+        return
 
-    await message.answer("منو:", reply_markup=kb_main_menu())
-    await state.clear()
+    if action == "open":
+        await db.set_survey_status(survey["survey_id"], "open")
+        await callback.answer("🔓 نظرسنجی باز شد.")
+    else:
+        if is_survey_open(survey):
+            await db.set_survey_status(survey["survey_id"], "closed")
+        await callback.answer("🔒 نظرسنجی بسته شد.")
+
+        if action == "strip":
+            await callback.message.answer("🧹 پاک کردن دکمه‌ها در پس‌زمینه شروع شد...")
+            task = asyncio.create_task(strip_survey_buttons(survey, callback.message))
+            background_tasks.add(task)
+            task.add_done_callback(_background_done)
+
+    survey = await db.get_survey_results(ObjectId(oid))
+    try:
+        await callback.message.edit_text(format_survey_results(survey), reply_markup=kb_survey_admin(survey))
+    except Exception:
+        pass
+
+
+@survey_router.message(Command("close_survey", "reopen_survey"))
+async def cmd_survey_status(message: Message, command: CommandObject):
+    """
+    Usage: /close_survey <survey_id>  |  /reopen_survey <survey_id>
+    """
+    if not is_admin(message.from_user.id):
+        return
+
+    survey_id = (command.args or "").strip()
+    status = "closed" if command.command == "close_survey" else "open"
+    if not survey_id or not await db.set_survey_status(survey_id, status):
+        await message.answer(f"❌ نظرسنجی یافت نشد.\nUsage: `/{command.command} <survey_id>`")
+        return
+
+    await message.answer("🔒 نظرسنجی بسته شد." if status == "closed" else "🔓 نظرسنجی باز شد.")
 
 
 @survey_router.message(F.text == "لغو")
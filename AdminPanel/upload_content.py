@@ -1,6 +1,7 @@
 from aiogram.filters import Command
 from aiogram import Router, F, Bot
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import CommandStart
@@ -9,6 +10,7 @@ import datetime
 from config import CONF, is_admin
 from database import db
 from aiogram.utils.keyboard import InlineKeyboardBuilder  # <--- New
+from albums import album_collector
 import logging
 
 logger = logging.getLogger("admin_bot")
@@ -27,6 +29,7 @@ class AdminFlow(StatesGroup):
     # وضعیت‌های جدید برای سیستم پاسخ هوشمند
     waiting_for_trigger_keyword = State()  # منتظر کلمه کلیدی (مثلا 33)
     waiting_for_trigger_content = State()  # منتظر پیام‌های مربوط به آن
+    waiting_for_list_search = State()  # منتظر پیشوند جستجو در لیست‌ها
 
 # --- اضافه کردن به بخش KEYBOARDS ---
 
@@ -39,7 +42,8 @@ def kb_main_menu():
             [KeyboardButton(text="🧠 تنظیم پاسخ هوشمند"),
              KeyboardButton(text="❌ حذف کلمه هوشمند")],
             [KeyboardButton(text="📢 ارسال همگانی"),
-             KeyboardButton(text="📊 ایجاد نظرسنجی")]
+             KeyboardButton(text="📊 ایجاد نظرسنجی")],
+            [KeyboardButton(text="📈 نتایج نظرسنجی")]
         ],
         resize_keyboard=True
     )
@@ -94,31 +98,150 @@ async def cmd_server_time(message: Message):
     await message.answer(f"🕒 Server Time: `{time_str}`")
 
 
+@router.message(Command("set_category"))
+async def cmd_set_category(message: Message):
+    """
+    /set_category <نام کست> | <دسته>
+    کست‌های هم‌دسته در منوی کاربران کنار هم (در صفحات جدا) نمایش داده می‌شوند.
+    بدون دسته: /set_category <نام کست> |
+    """
+    if not is_admin(message.from_user.id):
+        return
+
+    args = (message.text or "").split(maxsplit=1)
+    if len(args) < 2 or "|" not in args[1]:
+        await message.answer("⚠️ فرمت: `/set_category نام کست | دسته`")
+        return
+
+    name, category = (part.strip() for part in args[1].split("|", 1))
+    if await db.set_cast_category(name, category):
+        await message.answer(f"✅ دسته کست «{name}»: {category or 'بدون دسته'}\n"
+                             "(منوی کاربران حداکثر تا یک دقیقه دیگر به‌روز می‌شود)")
+    else:
+        await message.answer(f"❌ کستی با نام «{name}» پیدا نشد.")
+
+
+@router.message(Command("set_drip"))
+async def cmd_set_drip(message: Message):
+    """
+    /set_drip <نام کست> | <ساعت> | <نام کست قبلی (اختیاری)>
+    کست برای هر کاربر چند ساعت بعد از عضویت (یا بعد از باز کردن کست قبلی) باز و ارسال می‌شود.
+    حذف زمان‌بندی: /set_drip <نام کست> | off
+    """
+    if not is_admin(message.from_user.id):
+        return
+
+    args = (message.text or "").split(maxsplit=1)
+    parts = [part.strip() for part in args[1].split("|")] if len(args) == 2 else []
+    if len(parts) < 2:
+        await message.answer("⚠️ فرمت: `/set_drip نام کست | ساعت | کست قبلی`")
+        return
+
+    name, hours_text = parts[0], parts[1]
+    after = parts[2] if len(parts) > 2 and parts[2] else None
+
+    if hours_text.lower() == "off":
+        hours = None
+    else:
+        try:
+            hours = float(hours_text)
+        except ValueError:
+            await message.answer("⚠️ تعداد ساعت باید عدد باشد.")
+            return
+
+    if after and not await db.casts.find_one({"name": after}, {"_id": 1}):
+        await message.answer(f"❌ کستی با نام «{after}» پیدا نشد.")
+        return
+
+    if not await db.set_cast_drip(name, hours, after):
+        await message.answer(f"❌ کستی با نام «{name}» پیدا نشد.")
+        return
+
+    if hours is None:
+        await message.answer(f"✅ زمان‌بندی کست «{name}» حذف شد.")
+    else:
+        base = f"باز کردن «{after}»" if after else "عضویت کاربر"
+        await message.answer(f"✅ کست «{name}» {hours:g} ساعت بعد از {base} باز می‌شود.\n"
+                             "(فقط برای کاربرانی که از این به بعد به این مرحله برسند)")
+
+
 @router.message(F.text == "❌ انصراف")
 async def cancel_action(message: Message, state: FSMContext):
     await state.clear()
     await message.answer("عملیات لغو شد. به منوی اصلی برگشتید.", reply_markup=kb_main_menu())
 
 
-def kb_delete_list(casts_list):
+# ---------------------------------------------------------
+# LISTS: لیست صفحه‌بندی شده کست‌ها و کلمات کلیدی (حذف و جستجو)
+# ---------------------------------------------------------
+
+
+class ListCallback(CallbackData, prefix="ls"):
+    kind: str        # c = casts, k = keywords
+    action: str      # n = next, p = prev, d = delete, s = search, a = all
+    ref: str = ""    # ObjectId هدف (۲۴ کاراکتر؛ زیر سقف ۶۴ بایتی callback_data)
+    start: str = ""  # اولین _id صفحه فعلی (برای رفرش همان صفحه بعد از حذف)
+
+
+LIST_TITLES = {
+    "c": "👇 برای حذف هر محتوا، روی دکمه آن کلیک کنید:",
+    "k": "👇 برای حذف هر کلمه هوشمند، روی آن کلیک کنید:",
+}
+LIST_EMPTY = {
+    "c": "📭 لیست خالی است. هیچ محتوایی برای حذف وجود ندارد.",
+    "k": "📭 لیست پاسخ‌های هوشمند خالی است.",
+}
+
+
+def kb_list_page(kind: str, docs: list, has_prev: bool, has_next: bool):
     """
-    Creates an inline keyboard with a delete button for each item.
+    Creates an inline keyboard for one page, with compact ID-based callback data.
     """
+    field = "keyword" if kind == "k" else "name"
+    start = str(docs[0]["_id"]) if docs else ""
+
     builder = InlineKeyboardBuilder()
+    for doc in docs:
+        builder.button(text=f"❌ {doc.get(field)}",
+                       callback_data=ListCallback(kind=kind, action="d", ref=str(doc["_id"]), start=start).pack())
+    # کست‌ها یک دکمه در هر ردیف، کلمات کلیدی دو دکمه
+    builder.adjust(2 if kind == "k" else 1)
+
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(
+            text="⬅️ قبلی", callback_data=ListCallback(kind=kind, action="p", ref=start).pack()))
+    if has_next:
+        nav.append(InlineKeyboardButton(
+            text="بعدی ➡️", callback_data=ListCallback(kind=kind, action="n", ref=str(docs[-1]["_id"])).pack()))
+    if nav:
+        builder.row(*nav)
+
+    builder.row(
+        InlineKeyboardButton(text="🔎 جستجو", callback_data=ListCallback(kind=kind, action="s").pack()),
+        InlineKeyboardButton(text="📋 همه", callback_data=ListCallback(kind=kind, action="a").pack())
+    )
+    builder.row(InlineKeyboardButton(text="🔙 بستن منو", callback_data="close_menu"))
+    return builder.as_markup()
 
-    for cast in casts_list:
-        # callback_data format: "del:<name>"
-        # Note: Telegram callback_data has a 64-byte limit.
-        # If names are very long, it's better to use IDs from the database.
-        builder.button(text=f"❌ {cast['name']}",
-                       callback_data=f"del:{cast['name']}")
 
-    # Add a cancel/close button at the bottom
-    builder.button(text="🔙 بستن منو", callback_data="close_menu")
+async def render_list_page(kind: str, state: FSMContext, **cursor):
+    """Loads one page (honouring the saved search prefix) and returns (docs, text, markup)."""
+    prefix = (await state.get_data()).get(f"list_prefix_{kind}")
+    docs, has_prev, has_next = await db.get_list_page(kind, prefix=prefix, **cursor)
 
-    # Adjust layout: 1 button per row
-    builder.adjust(1)
-    return builder.as_markup()
+    text = LIST_TITLES[kind]
+    if prefix:
+        text += f"\n🔎 جستجو: `{prefix}`"
+    return docs, text, kb_list_page(kind, docs, has_prev, has_next)
+
+
+async def send_list(message: Message, state: FSMContext, kind: str):
+    docs, text, markup = await render_list_page(kind, state)
+    if not docs:
+        await message.answer(LIST_EMPTY[kind])
+        return
+    await message.answer(text, reply_markup=markup)
 
 
 # --- Delete Flow (Updated) ---
@@ -130,44 +253,76 @@ async def start_delete(message: Message, state: FSMContext):
 
     # Clear any previous states just in case
     await state.clear()
+    await send_list(message, state, "c")
 
-    casts = await db.get_all_cast_names()
-    if not casts:
-        await message.answer("📭 لیست خالی است. هیچ محتوایی برای حذف وجود ندارد.")
-        return
 
-    await message.answer(
-        "👇 برای حذف هر محتوا، روی دکمه آن کلیک کنید:",
-        reply_markup=kb_delete_list(casts)
-    )
-
-
-@router.callback_query(F.data.startswith("del:"))
-async def process_delete_callback(callback):
+@router.callback_query(ListCallback.filter())
+async def process_list_callback(callback: CallbackQuery, callback_data: ListCallback, state: FSMContext):
     """
-    Handles the click on a delete button.
+    Handles navigation, search and delete buttons of the paginated lists.
     """
-    # Extract name from callback_data (remove "del:" prefix)
-    cast_name = callback.data.split(":", 1)[1]
+    kind = callback_data.kind
+    action = callback_data.action
+
+    if action == "s":
+        await state.set_state(AdminFlow.waiting_for_list_search)
+        await state.update_data(list_kind=kind)
+        await callback.message.answer("🔎 ابتدای نام مورد نظر را بفرستید:", reply_markup=kb_cancel())
+        await callback.answer()
+        return
 
-    # Delete from database
-    deleted = await db.delete_cast(cast_name)
+    cursor = {}
+    if action == "n":
+        cursor = {"after": callback_data.ref}
+    elif action == "p":
+        cursor = {"before": callback_data.ref}
+    elif action == "a":
+        await state.update_data(**{f"list_prefix_{kind}": None})
+    elif action == "d":
+        deleted_name = await db.delete_list_item(kind, callback_data.ref)
+        if deleted_name is not None:
+            # Show a small popup notification
+            await callback.answer(f"✅ '{deleted_name}' حذف شد.", show_alert=False)
+        else:
+            await callback.answer("❌ خطا: این آیتم یافت نشد یا قبلاً حذف شده است.", show_alert=True)
+        # Refresh the same page
+        cursor = {"start": callback_data.start} if callback_data.start else {}
 
-    if deleted:
-        # Show a small popup notification
-        await callback.answer(f"✅ '{cast_name}' حذف شد.", show_alert=False)
+    docs, text, markup = await render_list_page(kind, state, **cursor)
+    if not docs and cursor:
+        # صفحه خالی شد؛ برگشت به صفحه اول
+        docs, text, markup = await render_list_page(kind, state)
 
-        # Refresh the list in the message
-        casts = await db.get_all_cast_names()
-        if casts:
-            await callback.message.edit_reply_markup(reply_markup=kb_delete_list(casts))
-        else:
-            await callback.message.edit_text("🗑 تمام محتواها حذف شدند.")
+    if not docs:
+        await callback.message.edit_text("🗑 تمام آیتم‌ها حذف شدند." if action == "d" else LIST_EMPTY[kind])
     else:
-        await callback.answer("❌ خطا: این آیتم یافت نشد یا قبلاً حذف شده است.", show_alert=True)
-        # Refresh the list anyway to remove the bad button
-        casts = await db.get_all_cast_names()
-        await callback.message.edit_reply_markup(reply_markup=kb_delete_list(casts))
+        try:
+            await callback.message.edit_text(text, reply_markup=markup)
+        except Exception:
+            # محتوا تغییری نکرده است
+            pass
+
+    if action != "d":
+        await callback.answer()
+
+
+@router.message(AdminFlow.waiting_for_list_search)
+async def process_list_search(message: Message, state: FSMContext):
+    data = await state.get_data()
+    kind = data.get("list_kind", "c")
+    prefix = (message.text or "").strip()
+    if kind == "k":
+        prefix = convert_to_english_digits(prefix)
+
+    await state.set_state(None)
+    await state.update_data(**{f"list_prefix_{kind}": prefix})
+
+    docs, text, markup = await render_list_page(kind, state)
+    if not docs:
+        await message.answer(f"🔎 موردی با پیشوند `{prefix}` یافت نشد.", reply_markup=kb_main_menu())
+        return
+    await message.answer("✅", reply_markup=kb_main_menu())
+    await message.answer(text, reply_markup=markup)
 
 
 @router.callback_query(F.data == "close_menu")
@@ -202,9 +357,53 @@ async def start_upload(message: Message, state: FSMContext):
     await state.set_state(AdminFlow.waiting_for_content)
 
 
+async def append_media(state: FSMContext, chat_id: int, items: list) -> int:
+    """اضافه کردن آیتم‌ها به media_list زیر قفل چت؛ تعداد کل را برمی‌گرداند."""
+    async with album_collector.lock(chat_id):
+        data = await state.get_data()
+        media_list = data.get("media_list", [])
+        media_list.extend(items)
+        await state.update_data(media_list=media_list)
+        return len(media_list)
+
+
+def collect_album_item(message: Message, state: FSMContext, bot: Bot):
+    """
+    آیتم‌های آلبوم را بافر می‌کند؛ بعد از رسیدن آخرین آیتم، کل آلبوم با یک copy_messages
+    به کانال آرشیو کپی، با یک نوشتن به media_list اضافه و با یک پیام تایید می‌شود.
+    گروه‌بندی آلبوم (کلید album) ذخیره می‌شود تا کاربر هم آن را به صورت آلبوم دریافت کند.
+    """
+    async def store_album(messages):
+        copied = await bot.copy_messages(
+            chat_id=CONF["STORAGE_CHANNEL_ID"],
+            from_chat_id=message.chat.id,
+            message_ids=[m.message_id for m in messages]
+        )
+
+        # اگر ادمین در این فاصله انصراف داده باشد، چیزی ذخیره نمی‌شود
+        if await state.get_state() is None:
+            return
+
+        total = await append_media(state, message.chat.id, [{
+            'message_id': item.message_id,
+            'chat_id': CONF["STORAGE_CHANNEL_ID"],
+            'album': message.media_group_id
+        } for item in copied])
+
+        await messages[-1].answer(
+            f"➕ آلبوم {len(copied)} تایی اضافه شد (مجموع: {total}).\n"
+            "فایل بعدی را بفرستید یا روی 'اتمام' کلیک کنید.",
+            reply_markup=kb_uploading()
+        )
+
+    album_collector.add(message, store_album)
+
+
 # هندلر برای دکمه اتمام
 @router.message(AdminFlow.waiting_for_content, F.text == "✅ اتمام و ثبت")
 async def finish_upload_process(message: Message, state: FSMContext):
+    # آلبوم‌هایی که هنوز در حال جمع‌آوری هستند باید اول ذخیره شوند
+    await album_collector.drain(message.chat.id)
     data = await state.get_data()
     media_list = data.get("media_list", [])
 
@@ -222,33 +421,33 @@ async def finish_upload_process(message: Message, state: FSMContext):
 
 # هندلر دریافت فایل‌ها (عکس، ویدیو، متن و ...)
 @router.message(AdminFlow.waiting_for_content)
-async def process_content_step(message: Message, state: FSMContext):
+async def process_content_step(message: Message, state: FSMContext, bot: Bot):
     # اگر کاربر دکمه انصراف را زد (چون هندلر متن عمومی است باید چک شود)
     if message.text == "❌ انصراف":
         await state.clear()
         await message.answer("عملیات لغو شد.", reply_markup=kb_main_menu())
         return
 
+    if message.media_group_id:
+        collect_album_item(message, state, bot)
+        return
+
+    # آلبوم‌هایی که قبل از این پیام رسیده‌اند اول ذخیره شوند (حفظ ترتیب)
+    await album_collector.drain(message.chat.id)
+
     try:
         # کپی کردن فایل به کانال آرشیو
         sent_message = await message.copy_to(chat_id=CONF["STORAGE_CHANNEL_ID"])
 
-        # دریافت لیست فعلی از حافظه
-        data = await state.get_data()
-        media_list = data.get("media_list", [])
-
         # اضافه کردن مشخصات پیام جدید به لیست
         # ما هم چت آیدی و هم مسیج آیدی را نگه می‌داریم
-        media_list.append({
+        total = await append_media(state, message.chat.id, [{
             'message_id': sent_message.message_id,
             'chat_id': CONF["STORAGE_CHANNEL_ID"]
-        })
-
-        # بروزرسانی حافظه
-        await state.update_data(media_list=media_list)
+        }])
 
         await message.answer(
-            f"➕ فایل شماره {len(media_list)} اضافه شد.\n"
+            f"➕ فایل شماره {total} اضافه شد.\n"
             "فایل بعدی را بفرستید یا روی 'اتمام' کلیک کنید.",
             reply_markup=kb_uploading()
         )
@@ -337,9 +536,10 @@ async def process_keyword_input(message: Message, state: FSMContext):
 
 
 @router.message(AdminFlow.waiting_for_trigger_content)
-async def process_smart_content(message: Message, state: FSMContext):
+async def process_smart_content(message: Message, state: FSMContext, bot: Bot):
     # اگر کاربر دکمه اتمام را زد
     if message.text == "✅ اتمام و ثبت":
+        await album_collector.drain(message.chat.id)
         data = await state.get_data()
         keyword = data.get("target_keyword")
         media_list = data.get("media_list", [])
@@ -365,43 +565,29 @@ async def process_smart_content(message: Message, state: FSMContext):
         await message.answer("لغو شد.", reply_markup=kb_main_menu())
         return
 
+    if message.media_group_id:
+        collect_album_item(message, state, bot)
+        return
+
+    # آلبوم‌هایی که قبل از این پیام رسیده‌اند اول ذخیره شوند (حفظ ترتیب)
+    await album_collector.drain(message.chat.id)
+
     # دریافت پیام و کپی به کانال آرشیو (مشابه سیستم قبلی)
     try:
         sent_msg = await message.copy_to(chat_id=CONF["STORAGE_CHANNEL_ID"])
 
-        data = await state.get_data()
-        media_list = data.get("media_list", [])
-
-        media_list.append({
+        total = await append_media(state, message.chat.id, [{
             'message_id': sent_msg.message_id,
             'chat_id': CONF["STORAGE_CHANNEL_ID"]
-        })
-
-        await state.update_data(media_list=media_list)
+        }])
 
-        await message.answer(f"➕ پیام #{len(media_list)} دریافت شد.", reply_markup=kb_uploading())
+        await message.answer(f"➕ پیام #{total} دریافت شد.", reply_markup=kb_uploading())
 
     except Exception as e:
         logger.error(f"Error copying msg: {e}")
         await message.answer("خطا در ذخیره پیام.")
 
 
-def kb_delete_keywords_list(keywords_list):
-    """
-    لیستی از کلمات کلیدی را به صورت دکمه‌های حذف نمایش می‌دهد.
-    """
-    builder = InlineKeyboardBuilder()
-
-    for item in keywords_list:
-        kw = item['keyword']
-        # فرمت کال‌بک: "del_kw:keyword"
-        builder.button(text=f"❌ {kw}", callback_data=f"del_kw:{kw}")
-
-    builder.button(text="🔙 بستن منو", callback_data="close_menu")
-    builder.adjust(2)  # نمایش دو دکمه در هر ردیف
-    return builder.as_markup()
-
-
 # ---------------------------------------------------------
 # FLOW: حذف کلمات کلیدی هوشمند
 # ---------------------------------------------------------
@@ -413,47 +599,4 @@ async def start_delete_keywords(message: Message, state: FSMContext):
 
     # پاک کردن وضعیت‌های قبلی
     await state.clear()
-
-    # دریافت تمام کلمات از دیتابیس
-    keywords = await db.get_all_keywords()
-
-    if not keywords:
-        await message.answer("📭 لیست پاسخ‌های هوشمند خالی است.")
-        return
-
-    await message.answer(
-        "👇 برای حذف هر کلمه هوشمند، روی آن کلیک کنید:",
-        reply_markup=kb_delete_keywords_list(keywords)
-    )
-
-
-@router.callback_query(F.data.startswith("del_kw:"))
-async def process_delete_keyword_callback(callback):
-    """
-    هندلر کلیک روی دکمه حذف کلمه کلیدی
-    """
-    # استخراج کلمه کلیدی از دیتای کال‌بک
-    target_keyword = callback.data.split(":", 1)[1]
-
-    # حذف از دیتابیس
-    deleted = await db.delete_keyword_reply(target_keyword)
-
-    if deleted:
-        await callback.answer(f"✅ کلمه '{target_keyword}' حذف شد.", show_alert=False)
-
-        # بروزرسانی لیست دکمه‌ها (رفرش کردن لیست)
-        remaining_keywords = await db.get_all_keywords()
-
-        if remaining_keywords:
-            await callback.message.edit_reply_markup(
-                reply_markup=kb_delete_keywords_list(remaining_keywords)
-            )
-        else:
-            await callback.message.edit_text("🗑 تمام کلمات کلیدی حذف شدند.")
-    else:
-        await callback.answer("❌ خطا: این کلمه یافت نشد یا قبلاً حذف شده است.", show_alert=True)
-        # رفرش لیست برای حذف دکمه خراب
-        remaining_keywords = await db.get_all_keywords()
-        await callback.message.edit_reply_markup(
-            reply_markup=kb_delete_keywords_list(remaining_keywords)
-        )
+    await send_list(message, state, "k")
@@ -2,14 +2,14 @@ import asyncio
 import logging
 import os
 from datetime import datetime
-import pandas as pd
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 from aiogram import Bot
-from aiogram.types import FSInputFile
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 import re
+
+from export_pool import ExportPool, LoopLagMonitor
 # ---------------------------------------------------------
 # 1. CONFIGURATION & LOGGING
 # ---------------------------------------------------------
@@ -29,7 +29,11 @@ CONF = {
     # Example: "-1001234567890"
     "BACKUP_CHANNEL_ID": os.getenv("BACKUP_CHANNEL_ID"),
     # Default 1 hour (3600s)
-    "BACKUP_INTERVAL": int(os.getenv("BACKUP_INTERVAL", 3600))
+    "BACKUP_INTERVAL": int(os.getenv("BACKUP_INTERVAL", 3600)),
+    # تعداد پروسس‌های ساخت اکسل (و حداکثر خروجی همزمان)
+    "EXPORT_WORKERS": int(os.getenv("EXPORT_WORKERS", 1)),
+    # فایل‌های بزرگ‌تر از این (مگابایت) به جای حافظه در فایل موقت سیستم ساخته می‌شوند
+    "EXPORT_MEMORY_MB": int(os.getenv("EXPORT_MEMORY_MB", 32))
 }
 
 # Validation
@@ -91,16 +95,23 @@ def standardize_phone_number(phone):
     return phone
 
 
-async def fetch_users_data():
-    """Fetches all user documents from MongoDB."""
-    client = AsyncIOMotorClient(CONF["MONGO_URL"])
-    db = client[CONF["DB_NAME"]]
-    users_collection = db["users"]
+# ستون‌هایی که اول فایل قرار می‌گیرند؛ بقیه فیلدها (به ترتیب حروف) بعد از آن‌ها
+PREFERRED_COLUMNS = ["_id", "user_id", "name", "username", "phone",
+                     "profile_completed", "created_at", "history"]
+
 
-    # Fetch all users
-    users = await users_collection.find().to_list(length=None)
-    client.close()
-    return users
+async def fetch_user_columns(users_collection):
+    """
+    اجتماع نام فیلدهای همه کاربران (مثل ستون‌های DataFrame قبلی)، بدون خواندن خود داده‌ها در پایتون.
+    """
+    pipeline = [
+        {"$project": {"keys": {"$map": {"input": {"$objectToArray": "$$ROOT"}, "in": "$$this.k"}}}},
+        {"$unwind": "$keys"},
+        {"$group": {"_id": "$keys"}}
+    ]
+    keys = {row["_id"] async for row in users_collection.aggregate(pipeline)}
+    return ([column for column in PREFERRED_COLUMNS if column in keys]
+            + sorted(keys - set(PREFERRED_COLUMNS)))
 
 
 def format_history_list(history_data):
@@ -118,42 +129,58 @@ def format_history_list(history_data):
     return ""
 
 
-def generate_excel(users_data, filename):
-    """Converts user data list to an Excel file using Pandas."""
-    if not users_data:
-        return False
+def normalize_user(user):
+    """یک سند کاربر را به سطر اکسل تبدیل می‌کند (همان پاکسازی‌های نسخه pandas، سطر به سطر)"""
+    row = {}
+    for key, value in user.items():
+        if key == "_id":
+            value = str(value)
+        elif key == "created_at" and isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        elif key == "phone":
+            value = standardize_phone_number(value)
+        elif key == "history":
+            value = format_history_list(value)
+        elif isinstance(value, (dict, list)):
+            value = str(value)
+        row[key] = value
+    return row
 
-    df = pd.DataFrame(users_data)
 
-    # Optional: Clean up data (e.g., convert ObjectIds to string)
-    if '_id' in df.columns:
-        df['_id'] = df['_id'].astype(str)
+export_pool = ExportPool(CONF["EXPORT_WORKERS"])
+loop_lag = LoopLagMonitor()
 
-    # Optional: Format datetime columns if they exist
-    if 'created_at' in df.columns:
-        df['created_at'] = pd.to_datetime(
-            df['created_at']).dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    if 'phone' in df.columns:
-        df['phone'] = df['phone'].apply(standardize_phone_number)
-
-    if 'history' in df.columns:
-        df['history'] = df['history'].apply(format_history_list)
-
-    # Save to Excel
-    df.to_excel(filename, index=False, engine='openpyxl')
-    return True
+async def generate_excel():
+    """
+    کاربران را مستقیماً از cursor خوانده و به صورت تکه‌تکه به پروسس خروجی می‌دهد؛
+    پاکسازی سطرها (normalize_user) و نوشتن اکسل در آن پروسس انجام می‌شود.
+    Returns ExportResult (None = no users).
+    """
+    client = AsyncIOMotorClient(CONF["MONGO_URL"])
+    users_collection = client[CONF["DB_NAME"]]["users"]
+    try:
+        columns = await fetch_user_columns(users_collection)
+        if not columns:
+            return None
+
+        cursor = users_collection.find({}, batch_size=2000)
+        return await export_pool.export(columns, cursor, sheet_title="users",
+                                        normalize=normalize_user,
+                                        memory_max=CONF["EXPORT_MEMORY_MB"] * 1024 * 1024)
+    finally:
+        client.close()
 
 
-async def send_backup(filename):
-    """Sends the generated file to the Telegram channel."""
+async def send_backup(exported, filename):
+    """Sends the generated file (from memory) to the Telegram channel."""
     bot = Bot(
         token=CONF["ADMIN_BOT_TOKEN"],
         default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
     )
 
     try:
-        file = FSInputFile(filename)
+        file = exported.input_file(filename)
         caption = f"📊 **User Database Backup**\n📅 Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
 
         await bot.send_document(
@@ -174,43 +201,43 @@ async def send_backup(filename):
 
 async def run_scheduler():
     logger.info("Backup Service Started. Waiting for the first interval...")
+    lag_task = asyncio.create_task(loop_lag.run())
 
-    # Loop forever
-    while True:
-        try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"users_backup_{timestamp}.xlsx"
-
-            logger.info("Starting backup process...")
-
-            # 1. Fetch Data
-            users = await fetch_users_data()
-            if users:
-                logger.info(f"Fetched {len(users)} users.")
-
-                # 2. Generate Excel
-                success = generate_excel(users, filename)
-
-                if success:
-                    # 3. Send to Telegram
-                    await send_backup(filename)
-
-                    # 4. Cleanup local file
-                    if os.path.exists(filename):
-                        os.remove(filename)
-                        logger.info("Local backup file cleaned up.")
+    try:
+        # Loop forever
+        while True:
+            try:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                filename = f"users_backup_{timestamp}.xlsx"
+
+                logger.info("Starting backup process...")
+
+                # 1-2. Fetch Data & Generate Excel (streamed)
+                loop_lag.take_max()
+                exported = await generate_excel()
+                if exported:
+                    logger.info(f"Exported {exported.rows} users "
+                                f"(max event loop lag: {loop_lag.take_max() * 1000:.0f} ms).")
+
+                    # 3. Send to Telegram (buffer is released even if sending fails)
+                    try:
+                        await send_backup(exported, filename)
+                    finally:
+                        exported.cleanup()
                 else:
-                    logger.warning(
-                        "Could not generate Excel file (Empty data?).")
-            else:
-                logger.info("No users found in database. Skipping backup.")
+                    logger.info("No users found in database. Skipping backup.")
 
-        except Exception as e:
-            logger.error(f"An error occurred during backup cycle: {e}")
+            except Exception as e:
+                logger.error(f"An error occurred during backup cycle: {e}")
+
+            # Wait for the next interval
+            logger.info(f"Sleeping for {CONF['BACKUP_INTERVAL']} seconds...")
+            await asyncio.sleep(CONF["BACKUP_INTERVAL"])
+    finally:
+        lag_task.cancel()
+        # توقف پروسس‌های خروجی و پروسس Manager
+        export_pool.shutdown()
 
-        # Wait for the next interval
-        logger.info(f"Sleeping for {CONF['BACKUP_INTERVAL']} seconds...")
-        await asyncio.sleep(CONF["BACKUP_INTERVAL"])
 
 if __name__ == "__main__":
     try:
@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import logging
 import os
 from datetime import datetime
@@ -8,6 +9,9 @@ from motor.motor_asyncio import AsyncIOMotorClient
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
+
+from retention import build_cohort_matrix, create_retention_text
 
 # ---------------------------------------------------------
 # 1. CONFIGURATION & SETUP
@@ -26,9 +30,18 @@ CONF = {
     "DB_NAME": os.getenv("DB_NAME", "act_cast_db"),
     "REPORT_CHANNEL_ID": os.getenv("REPORT_CHANNEL_ID"),  # یا متغیر جداگانه
     "INTERVAL": 3600,  # 1 Hour in seconds
-    "TIMEZONE": "Asia/Tehran"  # برای نمایش ساعت در گزارش
+    "RECONCILE_INTERVAL": 24 * 3600,  # بازسازی شمارنده‌های history از روی users (روزانه)
+    "DIGEST_HOUR": int(os.getenv("DIGEST_HOUR", 9)),  # ساعت ارسال گزارش روزانه (به وقت TIMEZONE)
+    "RETENTION_WEEKS": int(os.getenv("RETENTION_WEEKS", 12)),
+    "TIMEZONE": "Asia/Tehran",  # برای نمایش ساعت در گزارش
+    # مراحل قیف به ترتیب (با کاما): start=عضویت، profile=ثبت شماره، بقیه = مقادیر history
+    # خالی = start, profile, تست و سپس کست‌ها به ترتیب ساخت
+    "FUNNEL_STEPS": os.getenv("FUNNEL_STEPS", "")
 }
 
+# برچسب مراحلی که در history نیستند
+STEP_LABELS = {"start": "شروع (عضویت)", "profile": "ثبت شماره"}
+
 # Validation
 if not CONF["ADMIN_BOT_TOKEN"] or not CONF["REPORT_CHANNEL_ID"]:
     raise ValueError("Token or Channel ID is missing in .env")
@@ -43,16 +56,102 @@ class StatsManager:
         self.client = AsyncIOMotorClient(CONF["MONGO_URL"])
         self.db = self.client[CONF["DB_NAME"]]
         self.users = self.db["users"]
+        self.history_stats = self.db["history_stats"]
+        self.history_daily = self.db["history_daily"]
+        self.funnel_stats = self.db["funnel_stats"]
+        self.casts = self.db["casts"]
+        self.report_state = self.db["report_state"]
 
     async def get_total_users(self):
-        """تعداد کل کاربرانی که در دیتابیس هستند"""
-        return await self.users.count_documents({})
+        """تعداد کل کاربرانی که در دیتابیس هستند (از metadata کالکشن، بدون پیمایش)"""
+        return await self.users.estimated_document_count()
+
+    async def get_dashboard(self):
+        """پیام داشبورد پین شده: {"message_id": int, "hash": str}"""
+        return await self.report_state.find_one({"_id": "dashboard"}) or {}
+
+    async def save_dashboard(self, message_id: int, content_hash: str):
+        await self.report_state.update_one(
+            {"_id": "dashboard"},
+            {"$set": {"message_id": message_id, "hash": content_hash, "updated_at": datetime.now()}},
+            upsert=True
+        )
+
+    async def get_watermark(self):
+        """وضعیت آخرین گزارش روزانه: {"total_users": int, "counts": {value: count}, "digest_date": str}"""
+        state = await self.report_state.find_one({"_id": "stats"}) or {}
+        if state:
+            state["counts"] = dict(state.get("counts", []))
+        return state
+
+    async def save_watermark(self, total_users: int, counts: dict, digest_date: str):
+        await self.report_state.update_one(
+            {"_id": "stats"},
+            # مقادیر history ممکن است نقطه داشته باشند؛ به صورت لیست جفت‌ها ذخیره می‌شوند
+            {"$set": {"total_users": total_users, "counts": [[k, v] for k, v in counts.items()],
+                      "digest_date": digest_date, "reported_at": datetime.now()}},
+            upsert=True
+        )
 
     async def get_history_breakdown(self):
         """
-        با استفاده از Aggregation تعداد افراد در هر مرحله از history را می‌شمارد.
-        فرض بر این است که history یک لیست از آبجکت‌هاست که کلید value دارد.
+        تعداد افراد در هر مرحله از history را از شمارنده‌های history_stats می‌خواند
+        (ربات اصلی در اولین تعامل هر کاربر آن‌ها را افزایش می‌دهد).
+        """
+        cursor = self.history_stats.find({}, {"count": 1}).sort("count", -1)
+        return await cursor.to_list(length=None)
+
+    async def get_daily_breakdown(self, day: datetime):
+        """تعداد کاربرانی که در یک روز برای اولین بار به هر مرحله رسیده‌اند"""
+        cursor = self.history_daily.find({"day": day}, {"value": 1, "count": 1}).sort("count", -1)
+        return await cursor.to_list(length=None)
+
+    async def get_funnel_steps(self):
+        """
+        مراحل قیف را از تنظیمات (یا پیش‌فرض) می‌سازد و در funnel_stats/config ذخیره می‌کند
+        تا ربات اصلی زمان بین همین مراحل را ثبت کند.
+        """
+        steps = [step.strip() for step in CONF["FUNNEL_STEPS"].split(",") if step.strip()]
+        if not steps:
+            casts = await self.casts.find({}, {"name": 1}).sort("_id", 1).to_list(length=None)
+            steps = ["start", "profile", "تست"] + [cast["name"] for cast in casts]
+
+        await self.funnel_stats.update_one({"_id": "config"}, {"$set": {"steps": steps}}, upsert=True)
+        return steps
+
+    async def get_funnel(self, steps):
+        """
+        تعداد رسیده به هر مرحله و میانه زمان از مرحله قبل، فقط از روی شمارنده‌ها:
+        start از تعداد کاربران، profile از funnel_stats و بقیه از history_stats.
+        Output: [{"step", "reached", "median"}, ...]
+        """
+        reached = {"start": await self.users.estimated_document_count()}
+        async for doc in self.history_stats.find({"_id": {"$in": steps}}, {"count": 1}):
+            reached[doc["_id"]] = doc.get("count", 0)
+
+        latency = {}
+        async for doc in self.funnel_stats.find({"_id": {"$in": steps}}, {"reached": 1, "latency": 1}):
+            latency[doc["_id"]] = doc.get("latency") or {}
+            if doc["_id"] == "profile":
+                reached["profile"] = doc.get("reached", 0)
+
+        return [
+            {
+                "step": step,
+                "reached": reached.get(step, 0),
+                "median": histogram_median(latency.get(step) or {})
+            }
+            for step in steps
+        ]
+
+    async def reconcile_history_stats(self):
+        """
+        بازسازی کامل history_stats و history_daily از روی users
+        (جبران شمارش‌های از دست رفته، مثلاً آپدیت‌های ناموفق یا کاربران حذف شده).
+        $out کالکشن مقصد را به صورت اتمیک جایگزین می‌کند و ایندکس‌ها حفظ می‌شوند.
         """
+        await self.history_daily.create_index("day")
+
         pipeline = [
             # 1. آرایه history را باز می‌کند (هر آیتم تبدیل به یک داکیومنت می‌شود)
             {"$unwind": "$history"},
@@ -61,32 +160,124 @@ class StatsManager:
             {
                 "$group": {
                     "_id": "$history.value",
-                    "count": {"$sum": 1}
+                    "count": {"$sum": 1},
+                    "type": {"$first": "$history.type"}
                 }
             },
 
-            # 3. مرتب‌سازی از بیشترین به کمترین
-            {"$sort": {"count": -1}}
+            {"$out": "history_stats"}
         ]
+        await self.users.aggregate(pipeline).to_list(length=None)
 
-        cursor = self.users.aggregate(pipeline)
-        return await cursor.to_list(length=None)
+        daily_pipeline = [
+            {"$unwind": "$history"},
+            {"$match": {"history.created_at": {"$type": "date"}}},
+            {
+                "$group": {
+                    "_id": {
+                        "value": "$history.value",
+                        "day": {"$dateTrunc": {"date": "$history.created_at", "unit": "day"}}
+                    },
+                    "count": {"$sum": 1}
+                }
+            },
+            {
+                "$project": {
+                    "_id": {"$concat": [
+                        {"$toString": "$_id.value"}, "|",
+                        {"$dateToString": {"date": "$_id.day", "format": "%Y-%m-%d"}}
+                    ]},
+                    "value": "$_id.value",
+                    "day": "$_id.day",
+                    "count": 1
+                }
+            },
+            {"$out": "history_daily"}
+        ]
+        await self.users.aggregate(daily_pipeline).to_list(length=None)
+
+        # شمارنده مرحله profile قیف
+        profile_count = await self.users.count_documents({"profile_completed": True})
+        await self.funnel_stats.update_one({"_id": "profile"}, {"$set": {"reached": profile_count}}, upsert=True)
+
+
+def histogram_median(buckets: dict):
+    """
+    میانه تقریبی از هیستوگرام لگاریتمی ربات اصلی (bucket = floor(2 * log2(ثانیه))).
+    Output: seconds (وسط هندسی bucket میانه) یا None
+    """
+    total = sum(buckets.values())
+    if not total:
+        return None
+
+    seen = 0
+    for bucket in sorted(buckets, key=int):
+        seen += buckets[bucket]
+        if seen * 2 >= total:
+            return 2 ** ((int(bucket) + 0.5) / 2)
 
 # ---------------------------------------------------------
 # 3. REPORT GENERATOR
 # ---------------------------------------------------------
 
 
-def create_report_text(total_users, history_stats):
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    if seconds >= 86400:
+        return f"{seconds / 86400:.1f} روز"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f} ساعت"
+    return f"{max(seconds / 60, 1):.0f} دقیقه"
+
+
+def create_funnel_text(funnel):
+    text = (
+        "🔻 **قیف ورود کاربران**\n"
+        "──────────────────\n"
+    )
+
+    first = funnel[0]["reached"] if funnel else 0
+    prev = None
+    for row in funnel:
+        label = STEP_LABELS.get(row["step"], row["step"])
+        reached = row["reached"]
+        overall = (reached / first * 100) if first else 0
+        text += f"🔹 **{label}**: `{reached:,}` نفر ({overall:.1f}%)\n"
+
+        if prev is not None:
+            # نرخ تبدیل نسبت به مرحله قبل و میانه زمان رسیدن از مرحله قبل
+            conversion = (reached / prev * 100) if prev else 0
+            text += f"    ↳ تبدیل: `{conversion:.1f}%` | میانه زمان: `{format_duration(row['median'])}`\n"
+        prev = reached
+
+    return text
+
+
+def now_str():
     tz = pytz.timezone(CONF["TIMEZONE"])
-    now = datetime.now(tz).strftime("%Y-%m-%d | %H:%M")
+    return datetime.now(tz).strftime("%Y-%m-%d | %H:%M")
 
+
+def create_report_text(total_users, history_stats, today_stats=None, watermark=None, title="📊 **گزارش آماری ربات**"):
+    """
+    متن گزارش بدون زمان ساخت (زمان جداگانه اضافه می‌شود تا hash داشبورد فقط به داده‌ها وابسته باشد).
+    watermark: وضعیت آخرین گزارش روزانه برای نمایش تغییرات
+    """
     text = (
-        f"📊 **گزارش آماری ربات**\n"
-        f"📅 تاریخ: `{now}`\n"
+        f"{title}\n"
         f"👥 **کل کاربران:** `{total_users:,}` نفر\n"
-        f"──────────────────\n"
-        f"📌 **آمار تفکیکی:**\n"
+    )
+
+    # تغییرات نسبت به آخرین گزارش روزانه
+    last_counts = None
+    if watermark:
+        last_counts = watermark.get("counts", {})
+        text += f"🆕 از گزارش روزانه قبل: `{total_users - watermark.get('total_users', 0):+,}` کاربر\n"
+
+    text += (
+        "──────────────────\n"
+        "📌 **آمار تفکیکی:**\n"
     )
 
     if not history_stats:
@@ -98,7 +289,16 @@ def create_report_text(total_users, history_stats):
             # محاسبه درصد (اختیاری)
             percent = (count / total_users * 100) if total_users > 0 else 0
 
-            text += f"🔹 **{step_name}**: `{count}` نفر ({percent:.1f}%)\n"
+            delta = ""
+            if last_counts is not None and count != last_counts.get(step_name, 0):
+                delta = f" `{count - last_counts.get(step_name, 0):+}`"
+
+            text += f"🔹 **{step_name}**: `{count}` نفر ({percent:.1f}%){delta}\n"
+
+    if today_stats:
+        text += "──────────────────\n📆 **امروز (اولین بار):**\n"
+        for item in today_stats:
+            text += f"▫️ {item.get('value', 'نامشخص')}: `{item.get('count', 0)}` نفر\n"
 
     return text
 
@@ -107,47 +307,140 @@ def create_report_text(total_users, history_stats):
 # ---------------------------------------------------------
 
 
-async def send_to_telegram(text):
-    bot = Bot(
-        token=CONF["ADMIN_BOT_TOKEN"],
-        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
-    )
+# حداکثر طول پیام تلگرام
+MAX_MESSAGE_LENGTH = 4096
+
+
+async def send_to_telegram(bot: Bot, text: str):
     try:
-        await bot.send_message(
+        sent = await bot.send_message(
             chat_id=CONF["REPORT_CHANNEL_ID"],
-            text=text
+            text=text[:MAX_MESSAGE_LENGTH]
         )
         logger.info("Report sent to Telegram successfully.")
+        return sent
     except Exception as e:
         logger.error(f"Telegram Error: {e}")
-    finally:
-        await bot.session.close()
+
+
+async def update_dashboard(bot: Bot, db_manager: StatsManager, body: str):
+    """
+    پیام پین شده داشبورد را در جا ویرایش می‌کند.
+    اگر محتوا (بدون زمان) با hash قبلی یکی باشد ویرایشی انجام نمی‌شود.
+    اگر پیام وجود نداشته باشد (اولین اجرا یا حذف شده) پیام جدید ارسال و پین می‌شود.
+    """
+    content_hash = hashlib.sha256(body.encode()).hexdigest()
+    dashboard = await db_manager.get_dashboard()
+    if dashboard.get("hash") == content_hash:
+        logger.info("Dashboard unchanged, skipping edit.")
+        return
+
+    text = (body + f"\n🕒 آخرین به‌روزرسانی: `{now_str()}`")[:MAX_MESSAGE_LENGTH]
+    message_id = dashboard.get("message_id")
+    if message_id:
+        try:
+            await bot.edit_message_text(text=text, chat_id=CONF["REPORT_CHANNEL_ID"],
+                                        message_id=message_id)
+            await db_manager.save_dashboard(message_id, content_hash)
+            logger.info("Dashboard updated.")
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                await db_manager.save_dashboard(message_id, content_hash)
+                return
+            logger.warning(f"Dashboard edit failed, posting a new one: {e}")
+
+    sent = await send_to_telegram(bot, text)
+    if not sent:
+        return
+    try:
+        await bot.pin_chat_message(chat_id=CONF["REPORT_CHANNEL_ID"], message_id=sent.message_id,
+                                   disable_notification=True)
+    except Exception as e:
+        logger.error(f"Pin Error: {e}")
+    await db_manager.save_dashboard(sent.message_id, content_hash)
+
+
+async def send_daily_digest(bot: Bot, db_manager: StatsManager, total, breakdown, counts, funnel, today_key):
+    """گزارش روزانه: تغییرات از گزارش روزانه قبل + قیف + جدول ماندگاری (یک بار در روز)"""
+    watermark = await db_manager.get_watermark()
+    text = create_report_text(total, breakdown, watermark=watermark,
+                              title="🗓 **گزارش روزانه ربات**")
+    await send_to_telegram(bot, text + f"📅 تاریخ: `{now_str()}`")
+    await send_to_telegram(bot, create_funnel_text(funnel))
+
+    try:
+        cohorts = await build_cohort_matrix(db_manager.users, CONF["RETENTION_WEEKS"])
+        await send_to_telegram(bot, create_retention_text(*cohorts))
+    except Exception as e:
+        logger.error(f"Retention Error: {e}")
+
+    await db_manager.save_watermark(total, counts, today_key)
 
 
 async def run_scheduler():
     db_manager = StatsManager()
+    # یک نشست ثابت برای کل عمر سرویس
+    bot = Bot(
+        token=CONF["ADMIN_BOT_TOKEN"],
+        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
+    )
+    tz = pytz.timezone(CONF["TIMEZONE"])
     logger.info("Stats Service Started...")
+    last_reconcile = None
+    last_snapshot = None
 
-    while True:
-        try:
-            logger.info("Generating report...")
+    try:
+        while True:
+            # بازسازی دوره‌ای شمارنده‌ها (اولین بار هنگام شروع سرویس)
+            now = asyncio.get_event_loop().time()
+            if last_reconcile is None or now - last_reconcile >= CONF["RECONCILE_INTERVAL"]:
+                try:
+                    logger.info("Reconciling history counters...")
+                    await db_manager.reconcile_history_stats()
+                    last_reconcile = now
+                except Exception as e:
+                    logger.error(f"Reconcile Error: {e}")
 
-            # 1. Fetch Data
-            total = await db_manager.get_total_users()
-            breakdown = await db_manager.get_history_breakdown()
+            try:
+                logger.info("Generating report...")
 
-            # 2. Format Message
-            message = create_report_text(total, breakdown)
+                # 1. Fetch Data (فقط شمارنده‌ها؛ O(تعداد مقادیر history))
+                total = await db_manager.get_total_users()
+                breakdown = await db_manager.get_history_breakdown()
+                counts = {str(item["_id"]): item.get("count", 0) for item in breakdown}
 
-            # 3. Send
-            await send_to_telegram(message)
+                local_now = datetime.now(tz)
+                today_key = local_now.strftime("%Y-%m-%d")
+                watermark = await db_manager.get_watermark()
+                digest_due = (local_now.hour >= CONF["DIGEST_HOUR"]
+                              and watermark.get("digest_date") != today_key)
 
-        except Exception as e:
-            logger.error(f"Critical Error in loop: {e}")
+                # اگر از سیکل قبلی هیچ چیزی تغییر نکرده و گزارش روزانه هم موعدش نیست، رد می‌شود
+                if (total, counts) == last_snapshot and not digest_due:
+                    logger.info("Nothing changed since last cycle, skipping.")
+                else:
+                    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+                    today_breakdown = await db_manager.get_daily_breakdown(today)
+                    funnel = await db_manager.get_funnel(await db_manager.get_funnel_steps())
 
-        # Wait for next hour
-        logger.info(f"Sleeping for {CONF['INTERVAL']} seconds...")
-        await asyncio.sleep(CONF['INTERVAL'])
+                    # 2. داشبورد پین شده (ویرایش در جا)
+                    body = create_report_text(total, breakdown, today_breakdown, watermark)
+                    await update_dashboard(bot, db_manager, body + "\n" + create_funnel_text(funnel))
+                    last_snapshot = (total, counts)
+
+                    # 3. گزارش روزانه (فقط طبق زمان‌بندی)
+                    if digest_due:
+                        await send_daily_digest(bot, db_manager, total, breakdown, counts, funnel, today_key)
+
+            except Exception as e:
+                logger.error(f"Critical Error in loop: {e}")
+
+            # Wait for next hour
+            logger.info(f"Sleeping for {CONF['INTERVAL']} seconds...")
+            await asyncio.sleep(CONF['INTERVAL'])
+    finally:
+        await bot.session.close()
 
 if __name__ == "__main__":
     try:
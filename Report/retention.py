@@ -0,0 +1,121 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+logger = logging.getLogger("stats_service")
+
+WEEK_MS = 7 * 24 * 3600 * 1000
+# تعداد کاربرانی که هر بار از cursor به آرایه NumPy تبدیل می‌شوند
+CHUNK_USERS = 50_000
+# انواع history که «فعالیت» حساب می‌شوند (باز کردن کست)
+ACTIVITY_TYPES = ["cast_button", "drip"]
+# سایه‌های جدول (از کم به زیاد)
+SHADES = " ░▒▓█"
+
+
+def week_start(day: datetime) -> datetime:
+    """شروع هفته (دوشنبه ساعت 00:00) برای یک تاریخ"""
+    day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday())
+
+
+def add_chunk(active, sizes, origin_ms, created, owners, events):
+    """
+    یک chunk از کاربران را به صورت برداری در ماتریس cohort اضافه می‌کند.
+    created: زمان عضویت هر کاربر (ms) | owners/events: اندیس کاربر و زمان هر رویداد (ms)
+    active[c, k]: تعداد کاربران یکتای cohort c که در هفته k بعد از عضویت فعال بوده‌اند
+    """
+    n_weeks = active.shape[0]
+    cohort = (created - origin_ms) // WEEK_MS
+    sizes += np.bincount(cohort, minlength=n_weeks)[:n_weeks]
+
+    if not len(events):
+        return
+
+    event_cohort = cohort[owners]
+    offset = (events - origin_ms) // WEEK_MS - event_cohort
+    valid = (offset >= 0) & (event_cohort + offset < n_weeks)
+
+    # هر کاربر در هر هفته فقط یک بار شمرده می‌شود
+    keys = np.unique(owners[valid] * n_weeks + offset[valid])
+    users, weeks = np.divmod(keys, n_weeks)
+    cells = np.bincount(cohort[users] * n_weeks + weeks, minlength=n_weeks * n_weeks)
+    active += cells[:n_weeks * n_weeks].reshape(n_weeks, n_weeks)
+
+
+async def build_cohort_matrix(users_collection, n_weeks: int = 12, now: datetime = None):
+    """
+    ماتریس ماندگاری هفتگی n_weeks cohort آخر.
+    کاربران با پروجکشن (فقط زمان عضویت و زمان فعالیت‌ها، به میلی‌ثانیه) خوانده
+    و هر CHUNK_USERS کاربر به صورت برداری پردازش می‌شوند؛ حافظه مستقل از تعداد کل کاربران است.
+    Output: (cohort_starts, sizes, active)
+    """
+    origin = week_start(now or datetime.now()) - timedelta(weeks=n_weeks - 1)
+    # تاریخ‌های naive در Mongo به عنوان UTC ذخیره می‌شوند و $toLong هم همان را برمی‌گرداند
+    origin_ms = int(origin.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+    sizes = np.zeros(n_weeks, dtype=np.int64)
+    active = np.zeros((n_weeks, n_weeks), dtype=np.int64)
+
+    pipeline = [
+        # index: created_at
+        {"$match": {"created_at": {"$gte": origin}}},
+        {"$project": {
+            "_id": 0,
+            "c": {"$toLong": "$created_at"},
+            "e": {"$map": {
+                "input": {"$filter": {
+                    "input": {"$ifNull": ["$history", []]},
+                    "cond": {"$and": [
+                        {"$in": ["$$this.type", ACTIVITY_TYPES]},
+                        {"$eq": [{"$type": "$$this.created_at"}, "date"]}
+                    ]}
+                }},
+                "in": {"$toLong": "$$this.created_at"}
+            }}
+        }}
+    ]
+
+    created, owners, events = [], [], []
+    async for doc in users_collection.aggregate(pipeline, batchSize=10_000):
+        index = len(created)
+        created.append(doc["c"])
+        for ts in doc["e"]:
+            owners.append(index)
+            events.append(ts)
+
+        if len(created) >= CHUNK_USERS:
+            add_chunk(active, sizes, origin_ms, np.array(created, dtype=np.int64),
+                      np.array(owners, dtype=np.int64), np.array(events, dtype=np.int64))
+            created, owners, events = [], [], []
+
+    if created:
+        add_chunk(active, sizes, origin_ms, np.array(created, dtype=np.int64),
+                  np.array(owners, dtype=np.int64), np.array(events, dtype=np.int64))
+
+    cohort_starts = [origin + timedelta(weeks=i) for i in range(n_weeks)]
+    return cohort_starts, sizes, active
+
+
+def create_retention_text(cohort_starts, sizes, active):
+    """جدول حرارتی ماندگاری: هر خانه = درصد کاربران cohort که در هفته k فعال بوده‌اند"""
+    n_weeks = len(sizes)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np.where(sizes[:, None] > 0, active * 100 / sizes[:, None], 0)
+
+    header = "هفته  |  نفر   | " + " ".join(f"W{k:<3}" for k in range(n_weeks))
+    lines = [header]
+    for c in range(n_weeks):
+        cells = []
+        for k in range(n_weeks - c):
+            rate = rates[c, k]
+            shade = SHADES[min(int(rate / 100 * (len(SHADES) - 1) + 0.5), len(SHADES) - 1)]
+            cells.append(f"{shade}{rate:>3.0f}")
+        lines.append(f"{cohort_starts[c].strftime('%m-%d')} | {sizes[c]:>6} | " + " ".join(cells))
+
+    return (
+        "📈 **ماندگاری هفتگی کاربران (Cohort)**\n"
+        "درصد کاربران هر هفته عضویت که در هفته k بعد از آن کستی باز کرده‌اند:\n"
+        "```\n" + "\n".join(lines) + "\n```"
+    )
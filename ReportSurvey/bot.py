@@ -1,16 +1,18 @@
 import asyncio
 import logging
 import os
-import pandas as pd
 from datetime import datetime
 import pytz
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 from aiogram import Bot
-from aiogram.types import FSInputFile
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 import re
+
+from functools import partial
+
+from export_pool import ExportPool, LoopLagMonitor
 # ---------------------------------------------------------
 # 1. CONFIGURATION
 # ---------------------------------------------------------
@@ -28,6 +30,10 @@ CONF = {
     "DB_NAME": os.getenv("DB_NAME", "act_cast_db"),
     "REPORT_CHANNEL_ID": os.getenv("REPORT_CHANNEL_ID"),
     "INTERVAL": 3600,  # 1 Hour
+    # تعداد پروسس‌های ساخت اکسل (و حداکثر خروجی همزمان)
+    "EXPORT_WORKERS": int(os.getenv("EXPORT_WORKERS", 1)),
+    # فایل‌های بزرگ‌تر از این (مگابایت) به جای حافظه در فایل موقت سیستم ساخته می‌شوند
+    "EXPORT_MEMORY_MB": int(os.getenv("EXPORT_MEMORY_MB", 32)),
     "TIMEZONE": "Asia/Tehran"
 }
 
@@ -38,6 +44,10 @@ if not CONF["ADMIN_BOT_TOKEN"] or not CONF["REPORT_CHANNEL_ID"]:
 # 2. REPORTER LOGIC
 # ---------------------------------------------------------
 
+# تعداد رای (همراه با اطلاعات کاربر) که در هر صفحه از Mongo خوانده می‌شود
+VOTER_PAGE_SIZE = 5000
+EXCEL_COLUMNS = ["User ID", "Phone", "Name", "Username", "Selected Option", "Time"]
+
 
 def convert_to_english_digits(text):
     """Convert Persian digits in the input text to English digits."""
@@ -86,86 +96,140 @@ def standardize_phone_number(phone):
     return phone
 
 
+def is_survey_open(survey):
+    """نظرسنجی بسته نشده و زمان انقضای آن هم نرسیده باشد."""
+    if survey.get("status") == "closed":
+        return False
+    closes_at = survey.get("closes_at")
+    return closes_at is None or closes_at > datetime.now()
+
+
+def build_vote_row(row, opt_id_to_text, now_str):
+    """سطر اکسل یک رای (در پروسس خروجی اجرا می‌شود)"""
+    return {
+        "User ID": row["user_id"],
+        "Phone": standardize_phone_number(row.get("phone", "")),
+        "Name": row.get("name") or "Unknown",
+        "Username": f"@{row['username']}" if row.get("username") else "No Username",
+        "Selected Option": opt_id_to_text.get(row.get("option_id"), "Unknown Option"),
+        "Time": now_str
+    }
+
+
+export_pool = ExportPool(CONF["EXPORT_WORKERS"])
+loop_lag = LoopLagMonitor()
+
+
 class SurveyStatsReporter:
     def __init__(self):
         self.client = AsyncIOMotorClient(CONF["MONGODB_URL"])
         self.db = self.client[CONF["DB_NAME"]]
         self.surveys = self.db["surveys"]
+        self.survey_votes = self.db["survey_votes"]
         self.users = self.db["users"]
 
-    async def get_user_info_map(self, user_ids):
+    async def get_vote_counts(self, survey_id):
         """
-        اطلاعات یوزرنیم و نام کاربران را دریافت می‌کند.
+        شمارش آرای هر گزینه در خود Mongo
+        index: survey_votes (survey_id, option_id)
+        خروجی: {option_id: count}
         """
-        user_map = {}
-        if not user_ids:
-            return user_map
-
-        unique_ids = list(set(user_ids))
-        cursor = self.users.find({"user_id": {"$in": unique_ids}})
-
-        async for user in cursor:
-            uid = user.get("user_id")
-            name = (user.get("name", "") + " " +
-                    user.get("name", "")).strip() or "Unknown"
-
-            username = f"@{user.get('username')}" if user.get(
-                "username") else "No Username"
+        pipeline = [
+            {"$match": {"survey_id": survey_id}},
+            {"$group": {"_id": "$option_id", "count": {"$sum": 1}}}
+        ]
+        return {row["_id"]: row["count"] async for row in self.survey_votes.aggregate(pipeline)}
 
-            phone = user.get("phone", "")
-
-            user_map[uid] = {
-                "name": name,
-                "phone": phone,
-                "username": username
-            }
-        return user_map
+    async def iter_voter_rows(self, survey_id, page_size: int = VOTER_PAGE_SIZE):
+        """
+        آرای یک نظرسنجی همراه با اطلاعات کاربر ($lookup) به صورت صفحه به صفحه.
+        صفحه‌بندی روی user_id (ایندکس یکتای survey_id + user_id)؛ در هر لحظه فقط یک صفحه در حافظه است.
+        خروجی: سطرهای {user_id, option_id, name, username, phone} (async iterator)
+        """
+        last_user_id = None
+        while True:
+            match = {"survey_id": survey_id}
+            if last_user_id is not None:
+                match["user_id"] = {"$gt": last_user_id}
+
+            pipeline = [
+                {"$match": match},
+                {"$sort": {"user_id": 1}},
+                {"$limit": page_size},
+                {"$lookup": {
+                    "from": "users",
+                    "localField": "user_id",
+                    "foreignField": "user_id",
+                    "pipeline": [{"$project": {"_id": 0, "name": 1, "username": 1, "phone": 1}}],
+                    "as": "user"
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "user_id": 1,
+                    "option_id": 1,
+                    "name": {"$first": "$user.name"},
+                    "username": {"$first": "$user.username"},
+                    "phone": {"$first": "$user.phone"}
+                }}
+            ]
+            page = await self.survey_votes.aggregate(pipeline).to_list(length=page_size)
+            if not page:
+                return
+
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            last_user_id = page[-1]["user_id"]
 
     async def generate_individual_reports(self):
         """
-        برای هر نظرسنجی یک دیکشنری شامل متن و مسیر فایل اکسل برمی‌گرداند.
-        خروجی: لیستی از گزارش‌ها
+        برای هر نظرسنجی یک دیکشنری شامل متن و مسیر فایل اکسل می‌سازد (yield).
+        نظرسنجی‌ها یکی‌یکی از cursor خوانده و گزارش می‌شوند.
         """
-        all_surveys = await self.surveys.find({}).to_list(length=None)
-
-        if not all_surveys:
-            return []
+        # فقط نظرسنجی‌های فعال، به‌علاوه نظرسنجی‌های تازه بسته شده (برای گزارش نهایی)
+        cursor = self.surveys.find(
+            {"final_reported": {"$ne": True}},
+            {"survey_id": 1, "question": 1, "options": 1, "status": 1, "closes_at": 1,
+             "option_counts": 1, "reported_counts": 1, "reported_total": 1})
 
         tz = pytz.timezone(CONF["TIMEZONE"])
         now_str = datetime.now(tz).strftime("%Y-%m-%d | %H:%M")
 
-        reports_list = []
-
-        for survey in all_surveys:
+        async for survey in cursor:
             try:
                 survey_id = survey.get("survey_id")
                 question = survey.get("question", "بدون سوال")
+                is_closed = not is_survey_open(survey)
                 options = survey.get("options", [])
-                votes = survey.get("votes", {})
+
+                # watermark: شمارنده‌های زنده نظرسنجی در زمان آخرین گزارش
+                # اگر از آن زمان رایی ثبت یا عوض نشده، گزارش (و اکسل) دوباره ساخته نمی‌شود
+                counts = survey.get("option_counts")
+                reported = survey.get("reported_counts")
+                if counts is not None and counts == reported and not is_closed:
+                    continue
 
                 # 1. آماده‌سازی متن گزارش تکی
-                total_votes = len(votes)
+                vote_counts = await self.get_vote_counts(survey_id)
+                total_votes = sum(vote_counts.values())
+                new_votes = total_votes - survey.get("reported_total", 0)
 
                 # خلاصه متن سوال
                 short_q = (question[:100] +
                            '...') if len(question) > 100 else question
 
                 text_report = (
-                    f"📊 **گزارش نظرسنجی**\n"
+                    f"📊 **{'گزارش نهایی نظرسنجی (بسته شد)' if is_closed else 'گزارش نظرسنجی'}**\n"
                     f"📅 زمان: `{now_str}`\n"
                     f"❓ **سوال:** {short_q}\n"
-                    f"👥 **تعداد کل آرا:** `{total_votes}`\n"
+                    f"👥 **تعداد کل آرا:** `{total_votes}`"
+                    f"{f' (`{new_votes:+}` از گزارش قبل)' if new_votes else ''}\n"
                     f"──────────────────\n"
                 )
 
-                # شمارش آرا
-                vote_counts = {opt['id']: 0 for opt in options}
                 opt_id_to_text = {opt['id']: opt['text'] for opt in options}
 
-                for uid, opt_id in votes.items():
-                    if opt_id in vote_counts:
-                        vote_counts[opt_id] += 1
-
                 # افزودن جزئیات گزینه‌ها به متن
                 for opt in options:
                     count = vote_counts.get(opt['id'], 0)
@@ -174,50 +238,37 @@ class SurveyStatsReporter:
                     text_report += f"🔹 **{opt['text']}**: {count} ({percent:.1f}%)\n"
 
                 # 2. آماده‌سازی فایل اکسل تکی (فقط اگر رای وجود داشته باشد)
-                excel_path = None
+                excel_file = None
                 if total_votes > 0:
-                    user_ids_in_survey = [int(uid) for uid in votes.keys()]
-                    user_map = await self.get_user_info_map(user_ids_in_survey)
-
-                    excel_data = []
-                    for uid_str, opt_id in votes.items():
-                        uid = int(uid_str)
-                        u_info = user_map.get(
-                            uid, {"name": "Unknown", "username": "-"})
-                        selected_text = opt_id_to_text.get(
-                            opt_id, "Unknown Option")
-
-                        excel_data.append({
-                            "User ID": uid,
-                            "Phone": standardize_phone_number(u_info["phone"]),
-                            "Name": u_info["name"],
-                            "Username": u_info["username"],
-                            "Selected Option": selected_text,
-                            "Time": now_str
-                        })
-
-                    # ساخت فایل اکسل اختصاصی برای این نظرسنجی
-                    df = pd.DataFrame(excel_data)
-                    # استفاده از 8 کاراکتر اول ID برای نام فایل
-                    safe_filename = f"report_{survey_id[:8]}_{datetime.now().strftime('%M%S')}.xlsx"
-                    df.to_excel(safe_filename, index=False)
-                    excel_path = safe_filename
-
-                # افزودن به لیست گزارش‌ها
-                reports_list.append({
+                    # ساخت فایل اکسل اختصاصی برای این نظرسنجی در پروسس خروجی (صفحه به صفحه، در حافظه)
+                    loop_lag.take_max()
+                    excel_file = await export_pool.export(
+                        EXCEL_COLUMNS, self.iter_voter_rows(survey_id),
+                        sheet_title="votes",
+                        normalize=partial(build_vote_row, opt_id_to_text=opt_id_to_text, now_str=now_str),
+                        memory_max=CONF["EXPORT_MEMORY_MB"] * 1024 * 1024)
+                    logger.info(f"Survey {survey_id} exported "
+                                f"(max event loop lag: {loop_lag.take_max() * 1000:.0f} ms).")
+
+                # ذخیره watermark؛ نظرسنجی بسته شده فقط یک بار گزارش نهایی می‌گیرد
+                watermark = {"reported_counts": counts, "reported_total": total_votes,
+                             "reported_at": datetime.now()}
+                if is_closed:
+                    watermark["final_reported"] = True
+                await self.surveys.update_one({"_id": survey["_id"]}, {"$set": watermark})
+
+                yield {
                     "text": text_report,
-                    "excel_file": excel_path,
+                    "excel_file": excel_file,
                     "survey_id": survey_id,
                     "short_q": short_q,
-                })
+                }
 
             except Exception as e:
                 logger.error(
                     f"Error processing survey {survey.get('survey_id')}: {e}")
                 continue
 
-        return reports_list
-
 # ---------------------------------------------------------
 # 3. MAIN SCHEDULER
 # ---------------------------------------------------------
@@ -231,50 +282,59 @@ async def main():
     reporter = SurveyStatsReporter()
 
     logger.info("✅ Survey Reporter Service Started (Individual Mode)...")
+    lag_task = asyncio.create_task(loop_lag.run())
 
-    while True:
-        try:
-            logger.info("⏳ Starting report generation cycle...")
-
-            # دریافت لیست گزارش‌ها
-            reports = await reporter.generate_individual_reports()
-
-            if reports:
-                logger.info(f"📤 Sending {len(reports)} survey reports...")
-
-                for rep in reports:
-                    # 1. ارسال متن
-                    await bot.send_message(
-                        chat_id=CONF["REPORT_CHANNEL_ID"],
-                        text=rep["text"]
-                    )
-
-                    # 2. ارسال فایل اکسل (اگر وجود داشت)
-                    excel_path = rep["excel_file"]
-                    if excel_path and os.path.exists(excel_path):
-                        file_input = FSInputFile(excel_path)
-                        await bot.send_document(
+    try:
+        while True:
+            try:
+                logger.info("⏳ Starting report generation cycle...")
+
+                # گزارش‌ها یکی‌یکی ساخته و ارسال می‌شوند
+                sent_count = 0
+                async for rep in reporter.generate_individual_reports():
+                    excel_file = rep["excel_file"]
+                    try:
+                        # 1. ارسال متن
+                        await bot.send_message(
                             chat_id=CONF["REPORT_CHANNEL_ID"],
-                            document=file_input,
-                            caption=f"📂 فایل اکسل جزئیات نظرسنجی:\n {rep['short_q'][:100]}"
+                            text=rep["text"]
                         )
 
-                        # حذف فایل
-                        os.remove(excel_path)
-
+                        # 2. ارسال فایل اکسل از حافظه (اگر وجود داشت)
+                        if excel_file:
+                            # استفاده از 8 کاراکتر اول ID برای نام فایل
+                            filename = f"report_{rep['survey_id'][:8]}_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
+                            await bot.send_document(
+                                chat_id=CONF["REPORT_CHANNEL_ID"],
+                                document=excel_file.input_file(filename),
+                                caption=f"📂 فایل اکسل جزئیات نظرسنجی:\n {rep['short_q'][:100]}"
+                            )
+                    finally:
+                        # آزاد کردن بافر (و حذف فایل موقت برای خروجی‌های بزرگ) حتی در صورت خطا
+                        if excel_file:
+                            excel_file.cleanup()
+
+                    sent_count += 1
                     # تاخیر کوتاه بین هر نظرسنجی برای جلوگیری از اسپم شدن
                     await asyncio.sleep(2)
 
-                logger.info("✅ All reports sent successfully.")
-            else:
-                logger.info("No surveys found.")
+                if sent_count:
+                    logger.info(f"✅ {sent_count} survey reports sent successfully.")
+                else:
+                    logger.info("No survey changed since last report.")
+
+            except Exception as e:
+                logger.error(f"❌ Critical Error: {e}")
 
-        except Exception as e:
-            logger.error(f"❌ Critical Error: {e}")
+            # انتظار برای سیکل بعدی (۱ ساعت)
+            logger.info(f"💤 Sleeping for {CONF['INTERVAL']} seconds...")
+            await asyncio.sleep(CONF['INTERVAL'])
+    finally:
+        lag_task.cancel()
+        # توقف پروسس‌های خروجی و پروسس Manager
+        export_pool.shutdown()
+        await bot.session.close()
 
-        # انتظار برای سیکل بعدی (۱ ساعت)
-        logger.info(f"💤 Sleeping for {CONF['INTERVAL']} seconds...")
-        await asyncio.sleep(CONF['INTERVAL'])
 
 if __name__ == "__main__":
     try:
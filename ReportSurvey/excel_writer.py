@@ -0,0 +1,41 @@
+from openpyxl import Workbook
+
+# حداکثر سطر یک شیت اکسل (بدون سطر عنوان)
+MAX_SHEET_ROWS = 1_048_575
+
+
+class StreamingExcelWriter:
+    """
+    نوشتن اکسل به صورت سطر به سطر با حالت write-only کتابخانه openpyxl.
+    سطرها بلافاصله سریال می‌شوند و در حافظه نگه داشته نمی‌شوند؛
+    مصرف حافظه مستقل از تعداد سطرهاست. با پر شدن یک شیت، شیت بعدی ساخته می‌شود.
+    """
+
+    def __init__(self, columns, sheet_title: str = "Sheet"):
+        self.columns = list(columns)
+        self.sheet_title = sheet_title
+        self.workbook = Workbook(write_only=True)
+        self.sheet = None
+        self.sheet_rows = 0
+        self.sheet_count = 0
+        self.rows = 0
+
+    def _new_sheet(self):
+        self.sheet_count += 1
+        title = self.sheet_title if self.sheet_count == 1 else f"{self.sheet_title} {self.sheet_count}"
+        self.sheet = self.workbook.create_sheet(title=title)
+        self.sheet.append(self.columns)
+        self.sheet_rows = 0
+
+    def append(self, row: dict):
+        if self.sheet is None or self.sheet_rows >= MAX_SHEET_ROWS:
+            self._new_sheet()
+        self.sheet.append([row.get(column) for column in self.columns])
+        self.sheet_rows += 1
+        self.rows += 1
+
+    def save(self, target):
+        """target: مسیر فایل یا یک شیء file-like"""
+        if self.sheet is None:
+            self._new_sheet()
+        self.workbook.save(target)
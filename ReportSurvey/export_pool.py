@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Optional
+
+from aiogram.types import BufferedInputFile, FSInputFile
+
+from excel_writer import StreamingExcelWriter
+
+logger = logging.getLogger("export_pool")
+
+# تعداد سطر در هر تکه‌ای که به پروسس خروجی فرستاده می‌شود
+CHUNK_ROWS = 1000
+# حداکثر تکه‌های در صف (اگر پروسس عقب بماند، خواندن از Mongo صبر می‌کند)
+QUEUE_CHUNKS = 4
+# فایل‌های بزرگ‌تر از این اندازه (بایت) به جای حافظه در فایل موقت سیستم نگه داشته می‌شوند
+MEMORY_MAX_BYTES = 32 * 1024 * 1024
+
+
+class ExportResult:
+    """
+    خروجی آماده ارسال: محتوای فایل در حافظه (data) یا، برای فایل‌های بزرگ، مسیر فایل موقت (path).
+    بعد از ارسال حتماً cleanup صدا زده شود.
+    """
+
+    def __init__(self, rows: int, data: Optional[bytes] = None, path: Optional[str] = None):
+        self.rows = rows
+        self.data = data
+        self.path = path
+
+    def input_file(self, filename: str):
+        if self.data is not None:
+            return BufferedInputFile(self.data, filename=filename)
+        return FSInputFile(self.path, filename=filename)
+
+    def cleanup(self):
+        self.data = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+
+def _write_excel(columns: list, sheet_title: str, chunks, normalize: Optional[Callable],
+                 memory_max: int):
+    """
+    داخل پروسس جدا اجرا می‌شود: تکه‌ها را از صف می‌خواند و سطر به سطر در اکسل می‌نویسد.
+    None در صف یعنی پایان داده‌ها.
+    Returns (rows, data, path): فایل تا memory_max بایت به صورت bytes، بزرگ‌تر در فایل موقت.
+    """
+    writer = StreamingExcelWriter(columns, sheet_title=sheet_title)
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        for row in chunk:
+            writer.append(normalize(row) if normalize else row)
+
+    # تا memory_max بایت در حافظه؛ بیشتر از آن خود SpooledTemporaryFile روی دیسک می‌رود
+    with tempfile.SpooledTemporaryFile(max_size=memory_max) as spool:
+        writer.save(spool)
+        # rollover فقط وقتی رخ می‌دهد که اندازه فایل از max_size بیشتر شود
+        in_memory = spool.tell() <= memory_max
+        spool.seek(0)
+        if in_memory:
+            return writer.rows, spool.read(), None
+
+        # فایل rolled بی‌نام است؛ برای ارسال در پروسس اصلی به یک مسیر موقت کپی می‌شود
+        fd, path = tempfile.mkstemp(suffix=".xlsx")
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(spool, f)
+    return writer.rows, None, path
+
+
+class ExportPool:
+    """
+    اجرای ساخت فایل‌های اکسل (پاکسازی سطرها + سریال‌سازی openpyxl) در ProcessPoolExecutor،
+    تا event loop در طول خروجی‌های بزرگ آزاد بماند.
+    تعداد خروجی‌های همزمان به اندازه تعداد پروسس‌ها محدود است.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self.semaphore = asyncio.Semaphore(workers)
+        self.executor = None
+        self.manager = None
+
+    def _start(self):
+        if self.executor is None:
+            self.manager = multiprocessing.Manager()
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def _put(self, chunks, item, future):
+        """put با backpressure؛ اگر پروسس خروجی از کار افتاده باشد منتظر نمی‌ماند."""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, chunks.put, item, True, 1.0)
+                return True
+            except queue.Full:
+                if future.done():
+                    return False
+
+    async def export(self, columns: list, rows: AsyncIterator, sheet_title: str = "Sheet",
+                     normalize: Optional[Callable] = None,
+                     memory_max: int = MEMORY_MAX_BYTES) -> ExportResult:
+        """
+        rows: async iterator از سطرها (مثلاً cursor موتور)
+        normalize: تابع top-level (قابل pickle) که در پروسس خروجی روی هر سطر اجرا می‌شود
+        """
+        async with self.semaphore:
+            self._start()
+            loop = asyncio.get_running_loop()
+            chunks = self.manager.Queue(maxsize=QUEUE_CHUNKS)
+            future = loop.run_in_executor(self.executor, _write_excel,
+                                          columns, sheet_title, chunks, normalize, memory_max)
+            try:
+                chunk = []
+                async for row in rows:
+                    chunk.append(row)
+                    if len(chunk) >= CHUNK_ROWS:
+                        if not await self._put(chunks, chunk, future):
+                            break
+                        chunk = []
+                if chunk:
+                    await self._put(chunks, chunk, future)
+            except BaseException:
+                # خواندن سطرها شکست خورد: پروسس خروجی تمام شود و فایل موقت احتمالی آن حذف شود
+                await self._put(chunks, None, future)
+                try:
+                    ExportResult(*await future).cleanup()
+                except Exception as e:
+                    logger.error(f"export worker failed after a read error: {e}")
+                raise
+
+            await self._put(chunks, None, future)
+            return ExportResult(*await future)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+            self.manager.shutdown()
+
+
+class LoopLagMonitor:
+    """
+    تاخیر event loop را اندازه می‌گیرد: هر interval ثانیه یک sleep کوتاه
+    و اختلاف زمان بیدار شدن با زمان مورد انتظار.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.max_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - started - self.interval
+            self.max_lag = max(self.max_lag, lag)
+
+    def take_max(self) -> float:
+        """حداکثر تاخیر از آخرین فراخوانی (و صفر کردن آن)"""
+        max_lag, self.max_lag = self.max_lag, 0.0
+        return max_lag
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import logging
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+# تنظیمات لاگ
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger("cast_ordinals")
+
+# بارگذاری متغیرها
+load_dotenv()
+
+MONGO_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "act_cast_db")
+
+BATCH_SIZE = 1000
+# باید با OPENED_BITS_PER_WORD ربات اصلی و پنل ادمین یکسان باشد
+OPENED_BITS_PER_WORD = 63
+
+
+async def assign_cast_ordinals():
+    """
+    1. به کست‌هایی که ordinal ندارند (به ترتیب ساخت) یک ordinal ثابت می‌دهد.
+    2. بیت‌مپ users.opened را از روی history کاربران بازسازی می‌کند.
+    بعد از این، ربات اصلی بیت‌ها را در اولین باز کردن هر کست روشن نگه می‌دارد.
+    """
+    client = AsyncIOMotorClient(MONGO_URL)
+    db = client[DB_NAME]
+    casts = db["casts"]
+    users = db["users"]
+    counters = db["counters"]
+
+    logger.info("⏳ در حال تخصیص ordinal به کست‌ها...")
+
+    last = await casts.find_one({"ordinal": {"$exists": True}}, sort=[("ordinal", -1)])
+    next_ordinal = last["ordinal"] + 1 if last else 0
+
+    async for cast in casts.find({"ordinal": {"$exists": False}}, {"name": 1}).sort("_id", 1):
+        await casts.update_one({"_id": cast["_id"]}, {"$set": {"ordinal": next_ordinal}})
+        logger.info(f"✅ {cast['name']} -> {next_ordinal}")
+        next_ordinal += 1
+
+    # شمارنده پنل ادمین از بعد از بزرگ‌ترین ordinal ادامه می‌دهد
+    await counters.update_one({"_id": "cast_ordinal"},
+                              {"$max": {"seq": next_ordinal}}, upsert=True)
+
+    ordinals = {}
+    async for cast in casts.find({}, {"name": 1, "ordinal": 1}):
+        ordinals[cast["name"]] = cast["ordinal"]
+
+    logger.info("⏳ در حال ساخت بیت‌مپ کست‌های باز شده کاربران...")
+
+    ops = []
+    users_count = 0
+    async for user in users.find({"history": {"$exists": True}}, {"history.value": 1}):
+        opened = {}
+        for item in user.get("history") or []:
+            ordinal = ordinals.get(item.get("value"))
+            if ordinal is None:
+                continue
+            word, bit = divmod(ordinal, OPENED_BITS_PER_WORD)
+            opened[str(word)] = opened.get(str(word), 0) | (1 << bit)
+
+        if not opened:
+            continue
+        ops.append(UpdateOne(
+            {"_id": user["_id"]},
+            {"$bit": {f"opened.{word}": {"or": mask} for word, mask in opened.items()}}
+        ))
+        users_count += 1
+        if len(ops) >= BATCH_SIZE:
+            await users.bulk_write(ops, ordered=False)
+            ops = []
+
+    if ops:
+        await users.bulk_write(ops, ordered=False)
+
+    logger.info("------------------------------------------------")
+    logger.info("🎉 عملیات تمام شد.")
+    logger.info(f"🔢 تعداد کست‌ها: {len(ordinals)}")
+    logger.info(f"👥 کاربران به‌روز شده: {users_count}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(assign_cast_ordinals())
+    except KeyboardInterrupt:
+        pass
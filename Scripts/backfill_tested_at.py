@@ -0,0 +1,51 @@
+import asyncio
+import os
+import logging
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# تنظیمات لاگ
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger("tested_at")
+
+# بارگذاری متغیرها
+load_dotenv()
+
+MONGO_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "act_cast_db")
+
+
+async def backfill_tested_at():
+    """
+    فیلد tested_at را برای کاربرانی که قبلاً تست را شروع کرده‌اند (history.type = start_test)
+    از روی زمان همان رکورد history پر می‌کند.
+    بعد از این، ربات اصلی tested_at را در اولین شروع تست ثبت می‌کند.
+    """
+    client = AsyncIOMotorClient(MONGO_URL)
+    users = client[DB_NAME]["users"]
+
+    logger.info("⏳ در حال ثبت tested_at برای کاربرانی که تست را شروع کرده‌اند...")
+
+    result = await users.update_many(
+        {"history.type": "start_test", "tested_at": {"$exists": False}},
+        [{"$set": {"tested_at": {"$ifNull": [
+            {"$first": {"$map": {
+                "input": {"$filter": {
+                    "input": "$history",
+                    "cond": {"$eq": ["$$this.type", "start_test"]}
+                }},
+                "in": "$$this.created_at"
+            }}},
+            "$$NOW"
+        ]}}}]
+    )
+
+    logger.info("------------------------------------------------")
+    logger.info("🎉 عملیات تمام شد.")
+    logger.info(f"👥 کاربران به‌روز شده: {result.modified_count}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(backfill_tested_at())
+    except KeyboardInterrupt:
+        pass
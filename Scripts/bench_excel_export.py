@@ -0,0 +1,97 @@
+"""
+مقایسه زمان و حداکثر حافظه (RSS) خروجی اکسل:
+  pandas: همه کاربران در یک DataFrame و سپس to_excel (روش قبلی Backup/ReportSurvey)
+  stream: سطر به سطر با StreamingExcelWriter (حالت write-only کتابخانه openpyxl)
+هر روش در یک پروسس جدا اجرا می‌شود تا حداکثر RSS آن جدا اندازه‌گیری شود.
+
+python Scripts/bench_excel_export.py --rows 100000 200000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# نویسنده اکسل سرویس بکاپ
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Backup"))
+
+
+def fake_users(rows: int):
+    """سند کاربر شبیه کالکشن users (بدون نیاز به Mongo)"""
+    start = datetime(2025, 1, 1)
+    for i in range(rows):
+        yield {
+            "_id": f"{i:024x}",
+            "user_id": 100000000 + i,
+            "name": f"User {i}",
+            "username": f"user_{i}",
+            "phone": f"98912{i:07d}",
+            "profile_completed": True,
+            "created_at": start + timedelta(seconds=i * 37),
+            "history": [{"value": f"Cast {k}", "type": "cast_button"} for k in range(i % 5)],
+        }
+
+
+def format_history_list(history):
+    return ", ".join(str(item.get("value", "")) for item in history)
+
+
+def run_pandas(rows: int, path: str):
+    import pandas as pd
+
+    df = pd.DataFrame(list(fake_users(rows)))
+    df['created_at'] = pd.to_datetime(df['created_at']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    df['history'] = df['history'].apply(format_history_list)
+    df.to_excel(path, index=False, engine='openpyxl')
+
+
+def run_stream(rows: int, path: str):
+    from excel_writer import StreamingExcelWriter
+
+    writer = None
+    for user in fake_users(rows):
+        if writer is None:
+            writer = StreamingExcelWriter(list(user), sheet_title="users")
+        user["created_at"] = user["created_at"].strftime('%Y-%m-%d %H:%M:%S')
+        user["history"] = format_history_list(user["history"])
+        writer.append(user)
+    writer.save(path)
+
+
+def child(mode: str, rows: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.xlsx")
+        started = time.perf_counter()
+        (run_pandas if mode == "pandas" else run_stream)(rows, path)
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(path)
+
+    # ru_maxrss در لینوکس بر حسب کیلوبایت است
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode},{rows},{elapsed:.2f},{peak_mb:.0f},{size / 1024 / 1024:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[50_000, 100_000, 200_000])
+    parser.add_argument("--child", choices=["pandas", "stream"])
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.rows[0])
+        return
+
+    print(f"{'mode':<8}{'rows':>10}{'seconds':>10}{'peak MB':>10}{'file MB':>10}")
+    for rows in args.rows:
+        for mode in ("pandas", "stream"):
+            out = subprocess.run([sys.executable, __file__, "--child", mode, "--rows", str(rows)],
+                                 capture_output=True, text=True, check=True).stdout.strip()
+            mode, rows_, seconds, peak, size = out.split(",")
+            print(f"{mode:<8}{rows_:>10}{seconds:>10}{peak:>10}{size:>10}")
+
+
+if __name__ == "__main__":
+    main()
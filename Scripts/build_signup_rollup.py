@@ -0,0 +1,55 @@
+import asyncio
+import os
+import logging
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# تنظیمات لاگ
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger("signup_rollup")
+
+# بارگذاری متغیرها
+load_dotenv()
+
+MONGO_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "act_cast_db")
+
+
+async def build_signup_rollup():
+    """
+    ساخت (یا بازسازی) کالکشن signup_rollup از روی created_at کاربران موجود.
+    بعد از این، ربات اصلی شمارنده‌ها را برای کاربران جدید به‌روز نگه می‌دارد.
+    """
+    client = AsyncIOMotorClient(MONGO_URL)
+    db = client[DB_NAME]
+
+    logger.info("⏳ در حال ساخت شمارنده ساعتی عضویت‌ها...")
+
+    pipeline = [
+        {"$match": {"created_at": {"$type": "date"}}},
+        {"$group": {
+            "_id": {"$dateTrunc": {"date": "$created_at", "unit": "hour"}},
+            "count": {"$sum": 1}
+        }},
+        {"$project": {
+            "_id": {"$dateToString": {"date": "$_id", "format": "%Y-%m-%dT%H"}},
+            "hour": "$_id",
+            "year": {"$year": "$_id"},
+            "month": {"$month": "$_id"},
+            "day": {"$dayOfMonth": "$_id"},
+            "h": {"$hour": "$_id"},
+            "count": 1
+        }},
+        {"$merge": {"into": "signup_rollup", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+    await db["users"].aggregate(pipeline).to_list(length=None)
+
+    buckets = await db["signup_rollup"].count_documents({})
+    logger.info("------------------------------------------------")
+    logger.info(f"🎉 عملیات تمام شد. تعداد بازه‌های ساعتی: {buckets}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(build_signup_rollup())
+    except KeyboardInterrupt:
+        pass
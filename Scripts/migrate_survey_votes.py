@@ -0,0 +1,103 @@
+import asyncio
+import os
+import logging
+from datetime import datetime
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+# تنظیمات لاگ
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logger = logging.getLogger("migrate_votes")
+
+# بارگذاری متغیرها
+load_dotenv()
+
+MONGO_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+DB_NAME = os.getenv("DB_NAME", "act_cast_db")
+
+BATCH_SIZE = 1000
+
+
+async def migrate_survey_votes():
+    """
+    انتقال آرای ذخیره شده در فیلد votes هر نظرسنجی به کالکشن survey_votes.
+    آرایی که قبلاً در survey_votes ثبت شده‌اند (رای‌های جدیدتر) بازنویسی نمی‌شوند.
+    در پایان شمارنده‌های option_counts و total_votes از روی survey_votes بازسازی می‌شوند.
+    """
+    client = AsyncIOMotorClient(MONGO_URL)
+    db = client[DB_NAME]
+    surveys = db["surveys"]
+    survey_votes = db["survey_votes"]
+
+    await survey_votes.create_index([("survey_id", 1), ("user_id", 1)], unique=True)
+    await survey_votes.create_index([("survey_id", 1), ("option_id", 1)])
+
+    logger.info("⏳ در حال انتقال آرای نظرسنجی‌ها...")
+
+    cursor = surveys.find({"votes": {"$exists": True}}, {"survey_id": 1, "votes": 1})
+
+    surveys_count = 0
+    votes_count = 0
+
+    async for survey in cursor:
+        survey_id = survey.get("survey_id")
+        votes = survey.get("votes") or {}
+        now = datetime.now()
+
+        ops = []
+        for uid, option_id in votes.items():
+            ops.append(UpdateOne(
+                {"survey_id": survey_id, "user_id": int(uid)},
+                {"$setOnInsert": {
+                    "option_id": option_id,
+                    "created_at": now,
+                    "updated_at": now
+                }},
+                upsert=True
+            ))
+            if len(ops) >= BATCH_SIZE:
+                await survey_votes.bulk_write(ops, ordered=False)
+                ops = []
+
+        if ops:
+            await survey_votes.bulk_write(ops, ordered=False)
+
+        # حذف map قدیمی از داکیومنت نظرسنجی
+        await surveys.update_one({"_id": survey["_id"]}, {"$unset": {"votes": ""}})
+
+        surveys_count += 1
+        votes_count += len(votes)
+        logger.info(f"✅ Survey {survey_id}: {len(votes)} votes migrated")
+
+    # بازسازی شمارنده‌های زنده هر گزینه از روی survey_votes
+    logger.info("⏳ در حال بازسازی شمارنده‌های آرا...")
+    async for survey in surveys.find({}, {"survey_id": 1, "options": 1}):
+        survey_id = survey.get("survey_id")
+        option_counts = {opt['id']: 0 for opt in survey.get("options", [])}
+
+        pipeline = [
+            {"$match": {"survey_id": survey_id}},
+            {"$group": {"_id": "$option_id", "count": {"$sum": 1}}}
+        ]
+        async for row in survey_votes.aggregate(pipeline):
+            option_counts[row["_id"]] = row["count"]
+
+        await surveys.update_one(
+            {"_id": survey["_id"]},
+            {"$set": {
+                "option_counts": option_counts,
+                "total_votes": sum(option_counts.values())
+            }}
+        )
+
+    logger.info("------------------------------------------------")
+    logger.info("🎉 عملیات تمام شد.")
+    logger.info(f"📊 نظرسنجی‌های منتقل شده: {surveys_count}")
+    logger.info(f"🗳 کل آرا: {votes_count}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(migrate_survey_votes())
+    except KeyboardInterrupt:
+        pass
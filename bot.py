@@ -3,12 +3,16 @@ from aiogram import Router, types
 import asyncio
 import logging
 import os
-from typing import Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 import json
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+import math
 
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -18,9 +22,10 @@ from aiogram.enums import ParseMode
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 )
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, TelegramObject
 from aiogram import F
-from datetime import datetime
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from datetime import datetime, timedelta
 # ---------------------------------------------------------
 # 1. CONFIGURATION & LOGGING
 # ---------------------------------------------------------
@@ -36,6 +41,11 @@ CONF = {
     "BOT_TOKEN": os.getenv("BOT_TOKEN"),
     "MONGO_URL": os.getenv("MONGODB_URL", "mongodb://localhost:27017"),
     "DB_NAME": os.getenv("DB_NAME", "act_cast_db"),
+    # حداکثر تعداد پیام در ثانیه برای ارسال محتوای زمان‌بندی شده (drip)
+    "DRIP_RATE": float(os.getenv("DRIP_RATE", 20)),
+    # محدودیت پیام‌های ورودی هر کاربر (پیام در ثانیه و حداکثر پیام پشت سر هم)
+    "FLOOD_RATE": float(os.getenv("FLOOD_RATE", 1)),
+    "FLOOD_BURST": int(os.getenv("FLOOD_BURST", 5)),
 }
 
 if not CONF["BOT_TOKEN"]:
@@ -45,6 +55,31 @@ if not CONF["BOT_TOKEN"]:
 # 2. DATABASE SERVICE
 # ---------------------------------------------------------
 
+# هر کست یک ordinal ثابت دارد و بیت متناظر آن در users.opened.<word> روشن می‌شود.
+# هر word یک عدد 64 بیتی است؛ بیت علامت استفاده نمی‌شود.
+OPENED_BITS_PER_WORD = 63
+
+
+def opened_mask(ordinal: int):
+    """ordinal -> (field, mask)  مثال: 65 -> ("opened.1", 4)
+    (برای $bit؛ نسخه پنل ادمین opened_bit_index شماره بیت را برمی‌گرداند)"""
+    word, bit = divmod(ordinal, OPENED_BITS_PER_WORD)
+    return f"opened.{word}", 1 << bit
+
+
+# هیستوگرام زمان بین مراحل قیف: bucket = floor(2 * log2(ثانیه))  (هر bucket ≈ ×1.41)
+def latency_bucket(seconds: float) -> int:
+    return int(2 * math.log2(max(seconds, 1)))
+
+
+def has_opened(opened: Optional[Dict], ordinal: Optional[int]) -> bool:
+    """opened: زیرسند users.opened | بدون ordinal = نامشخص (False)"""
+    if ordinal is None or not opened:
+        return False
+    word, bit = divmod(ordinal, OPENED_BITS_PER_WORD)
+    return bool(opened.get(str(word), 0) & (1 << bit))
+
+
 
 def convert_to_english_digits(text):
     """Convert Persian digits in the input text to English digits."""
@@ -63,6 +98,25 @@ class DatabaseService:
         self.users = self.db["users"]
         self.casts = self.db["casts"]
         self.keyword_replies = self.db["keyword_replies"]
+        self.signup_rollup = self.db["signup_rollup"]
+        self.survey_votes = self.db["survey_votes"]
+        self.drip_queue = self.db["drip_queue"]
+        self.history_stats = self.db["history_stats"]
+        self.history_daily = self.db["history_daily"]
+        self.funnel_stats = self.db["funnel_stats"]
+        # مراحل قیف (توسط سرویس گزارش در funnel_stats/config نوشته می‌شود)
+        self.funnel_steps = []
+        self.funnel_steps_expires = 0.0
+        # نظرسنجی‌هایی که نوشتن آرایشان نیمه‌کاره ماند و شمارنده‌هایشان باید بازسازی شود
+        self.dirty_vote_surveys = set()
+
+    async def ensure_indexes(self):
+        """Creates the indexes the bot's hot paths rely on (idempotent)."""
+        await self.survey_votes.create_index(
+            [("survey_id", 1), ("user_id", 1)], unique=True)
+        await self.survey_votes.create_index([("survey_id", 1), ("option_id", 1)])
+        await self.drip_queue.create_index("due_at")
+        await self.history_daily.create_index("day")
 
     async def get_user(self, user_id: int) -> Dict:
         user = await self.users.find_one({"user_id": user_id})
@@ -73,8 +127,31 @@ class DatabaseService:
                 "profile_completed": False
             }
             await self.users.insert_one(user)
+            await self.count_signup(user["created_at"])
+            # کست‌هایی که نسبت به زمان عضویت باز می‌شوند
+            await self.schedule_drips(user_id, after=None, since=user["created_at"])
         return user
 
+    async def count_signup(self, created_at: datetime):
+        """
+        شمارنده ساعتی عضویت‌ها (برای شمارش سریع بازه‌های زمانی در پنل ادمین)
+        """
+        hour = created_at.replace(minute=0, second=0, microsecond=0)
+        await self.signup_rollup.update_one(
+            {"_id": hour.strftime("%Y-%m-%dT%H")},
+            {
+                "$inc": {"count": 1},
+                "$setOnInsert": {
+                    "hour": hour,
+                    "year": hour.year,
+                    "month": hour.month,
+                    "day": hour.day,
+                    "h": hour.hour
+                }
+            },
+            upsert=True
+        )
+
     async def update_user(self, user_id: int, data: Dict):
         await self.users.update_one(
             {"user_id": user_id},
@@ -83,8 +160,8 @@ class DatabaseService:
         )
 
     async def get_all_casts(self):
-        """Fetches all casts to generate buttons."""
-        cursor = self.casts.find()
+        """Fetches the name and category of all casts (in creation order) to generate buttons."""
+        cursor = self.casts.find({}, {"name": 1, "category": 1, "ordinal": 1}).sort("_id", 1)
         return await cursor.to_list(length=None)
 
     async def get_cast_by_name(self, cast_name: str) -> Optional[Dict]:
@@ -136,38 +213,403 @@ class DatabaseService:
     #         upsert=False
     #     )
 
-    async def add_user_history(self, user_id: int, value: str, type: str):
+    async def get_opened(self, user_id: int) -> Dict:
+        """بیت‌مپ کست‌های باز شده کاربر: {"0": int, "1": int, ...}"""
+        user = await self.users.find_one({"user_id": user_id}, {"opened": 1})
+        return (user or {}).get("opened") or {}
+
+    async def add_user_history(self, user_id: int, value: str, type: str, ordinal: Optional[int] = None):
         """
         اضافه کردن به تاریخچه فقط در صورتی که قبلاً این مقدار ثبت نشده باشد.
+        برای کست‌ها (ordinal) بیت متناظر در users.opened هم در همان آپدیت روشن می‌شود.
         """
+        now = datetime.now()
         new_entry = {
             "value": value,
             "type": type,
-            "created_at": datetime.now()
+            "created_at": now
         }
 
+        update = {"$push": {"history": new_entry}}
+        if type == "start_test":
+            # نشانگر مثبت و ایندکس شده برای سگمنت «تست نداده‌اند» در پنل ادمین
+            update["$set"] = {"tested_at": now}
+        if ordinal is not None:
+            field, mask = opened_mask(ordinal)
+            update["$bit"] = {field: {"or": mask}}
+
         # شرط آپدیت:
         # 1. user_id پیدا شود
         # 2. در آرایه history، هیچ آیتمی نباشد که value آن برابر با مقدار جدید باشد ($ne)
-        await self.users.update_one(
+        # نسخه قبل از آپدیت (فقط زمان‌ها) برای محاسبه فاصله از مرحله قبلی قیف
+        before = await self.users.find_one_and_update(
             {
                 "user_id": user_id,
                 "history.value": {"$ne": value}
             },
-            {"$push": {"history": new_entry}}
+            update,
+            projection={"created_at": 1, "profile_completed_at": 1,
+                        "history.value": 1, "history.created_at": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        # True = اولین باری است که کاربر این مقدار را باز کرده
+        if before is None:
+            return False
+
+        await self.count_history(value, type, now)
+        await self.record_funnel_step(value, before, now)
+        return True
+
+    async def complete_profile(self, user_id: int, data: Dict):
+        """ثبت اطلاعات تماس کاربر؛ اولین تکمیل پروفایل در قیف (مرحله profile) شمرده می‌شود."""
+        now = datetime.now()
+        before = await self.users.find_one_and_update(
+            {"user_id": user_id},
+            {"$set": dict(data, profile_completed=True, profile_completed_at=now)},
+            projection={"created_at": 1, "profile_completed": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        if before and before.get("profile_completed"):
+            return
+
+        await self.funnel_stats.update_one({"_id": "profile"}, {"$inc": {"reached": 1}}, upsert=True)
+        await self.record_funnel_step("profile", before or {}, now)
+
+    async def get_funnel_steps(self) -> list:
+        if time.monotonic() >= self.funnel_steps_expires:
+            config = await self.funnel_stats.find_one({"_id": "config"})
+            self.funnel_steps = (config or {}).get("steps", [])
+            self.funnel_steps_expires = time.monotonic() + 300
+        return self.funnel_steps
+
+    async def record_funnel_step(self, step: str, user_before: Dict, at: datetime):
+        """
+        اگر step یکی از مراحل قیف باشد، فاصله زمانی آن از مرحله قبلی
+        در هیستوگرام funnel_stats.<step>.latency ثبت می‌شود (برای میانه بدون پیمایش کاربران).
+        """
+        steps = await self.get_funnel_steps()
+        if step not in steps or steps.index(step) == 0:
+            return
+
+        prev = steps[steps.index(step) - 1]
+        if prev == "start":
+            prev_at = user_before.get("created_at")
+        elif prev == "profile":
+            prev_at = user_before.get("profile_completed_at")
+        else:
+            prev_at = next((item.get("created_at") for item in user_before.get("history") or []
+                            if item.get("value") == prev), None)
+        if not isinstance(prev_at, datetime):
+            return
+
+        bucket = latency_bucket((at - prev_at).total_seconds())
+        await self.funnel_stats.update_one(
+            {"_id": step},
+            {"$inc": {f"latency.{bucket}": 1}},
+            upsert=True
         )
 
+    async def count_history(self, value: str, type: str, at: datetime):
+        """
+        شمارنده‌های افزایشی آمار history (کل + روزانه) برای سرویس گزارش.
+        فقط در اولین تعامل کاربر با هر مقدار صدا زده می‌شود؛ سرویس گزارش دوره‌ای آن‌ها را بازسازی می‌کند.
+        """
+        day = at.replace(hour=0, minute=0, second=0, microsecond=0)
+        await self.history_stats.update_one(
+            {"_id": value},
+            {"$inc": {"count": 1}, "$set": {"type": type}},
+            upsert=True
+        )
+        await self.history_daily.update_one(
+            {"_id": f"{value}|{day.strftime('%Y-%m-%d')}"},
+            {"$inc": {"count": 1}, "$setOnInsert": {"value": value, "day": day}},
+            upsert=True
+        )
+
+    # --- محتوای تدریجی (drip) ---
+    # کست با فیلد unlock_hours زمان‌بندی می‌شود:
+    # unlock_after خالی = نسبت به عضویت کاربر | unlock_after = نام کست = نسبت به زمان باز کردن آن کست
+    # هر سطر drip_queue یک جفت (کاربر، کست) است با _id = "user_id:cast" و due_at ایندکس شده
+    # کست تدریجی بدون سطر در صف هم قفل است، مگر کاربر قبلاً آن را باز کرده باشد.
+
+    async def get_opened_names(self, user_id: int, casts: List[Dict]) -> set:
+        """نام کست‌هایی از casts که کاربر قبلاً باز کرده است (بیت‌مپ opened یا history)"""
+        user = await self.users.find_one({"user_id": user_id}, {"opened": 1, "history.value": 1}) or {}
+        history = {item.get("value") for item in user.get("history") or []}
+        return {
+            cast["name"] for cast in casts
+            if cast["name"] in history or has_opened(user.get("opened"), cast.get("ordinal"))
+        }
+
+    async def schedule_drips(self, user_id: int, after: Optional[str], since: datetime):
+        casts = await self.casts.find(
+            {"unlock_hours": {"$exists": True}, "unlock_after": after},
+            {"name": 1, "unlock_hours": 1, "ordinal": 1}
+        ).to_list(length=None)
+        if not casts:
+            return
+
+        # کستی که کاربر قبلاً (مثلاً پیش از تنظیم زمان‌بندی) دریافت کرده دوباره صف نمی‌شود
+        opened = await self.get_opened_names(user_id, casts)
+        casts = [cast for cast in casts if cast["name"] not in opened]
+        if not casts:
+            return
+
+        ops = [
+            UpdateOne(
+                {"_id": f"{user_id}:{cast['name']}"},
+                {"$setOnInsert": {
+                    "user_id": user_id,
+                    "cast": cast["name"],
+                    "due_at": since + timedelta(hours=float(cast["unlock_hours"]))
+                }},
+                upsert=True
+            )
+            for cast in casts
+        ]
+        await self.drip_queue.bulk_write(ops, ordered=False)
+
+    async def get_drip_entry(self, user_id: int, cast_name: str):
+        return await self.drip_queue.find_one({"_id": f"{user_id}:{cast_name}"})
+
+    async def get_drip_due(self, user_id: int, cast_data: Dict) -> Optional[datetime]:
+        """
+        زمان باز شدن یک کست تدریجی برای کاربر:
+        None = کاربر قبلاً آن را باز کرده | datetime.max = کست پیش‌نیاز هنوز باز نشده
+        کاربرانی که قبل از تنظیم زمان‌بندی (/set_drip) عضو شده یا کست پیش‌نیاز را باز کرده‌اند
+        سطری در صف ندارند؛ زمان آن‌ها از همان زمان عضویت/باز کردن پیش‌نیاز حساب می‌شود
+        (برای کاربران قدیمی معمولاً گذشته است و کست باز است) و در صورت نیاز صف می‌شود.
+        """
+        name = cast_data["name"]
+        entry = await self.get_drip_entry(user_id, name)
+        if entry:
+            return entry["due_at"]
+
+        user = await self.users.find_one(
+            {"user_id": user_id},
+            {"created_at": 1, "opened": 1, "history.value": 1, "history.created_at": 1}
+        ) or {}
+        history = {item.get("value"): item.get("created_at") for item in user.get("history") or []}
+        if name in history or has_opened(user.get("opened"), cast_data.get("ordinal")):
+            return None
+
+        after = cast_data.get("unlock_after")
+        since = history.get(after) if after else user.get("created_at")
+        if since is None:
+            return datetime.max
+
+        due_at = since + timedelta(hours=float(cast_data["unlock_hours"]))
+        if due_at > datetime.now():
+            await self.drip_queue.update_one(
+                {"_id": f"{user_id}:{name}"},
+                {"$setOnInsert": {"user_id": user_id, "cast": name, "due_at": due_at}},
+                upsert=True
+            )
+        return due_at
+
+    async def cancel_drip(self, user_id: int, cast_name: str):
+        """کاربر خودش کست را باز کرد؛ زمان‌بند دیگر آن را نمی‌فرستد"""
+        await self.drip_queue.delete_one({"_id": f"{user_id}:{cast_name}"})
+
+    async def get_due_drips(self, now: datetime, limit: int = 100):
+        """index: due_at (فقط سطرهای سررسید شده خوانده می‌شوند)"""
+        cursor = self.drip_queue.find({"due_at": {"$lte": now}}).sort("due_at", 1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def claim_drip(self, entry_id: str) -> bool:
+        """حذف سطر قبل از ارسال؛ فقط کسی که حذف کرده ارسال می‌کند (بدون ارسال تکراری)"""
+        result = await self.drip_queue.delete_one({"_id": entry_id})
+        return result.deleted_count > 0
+
+    async def requeue_drip(self, entry: Dict, due_at: datetime):
+        entry = dict(entry, due_at=due_at)
+        await self.drip_queue.replace_one({"_id": entry["_id"]}, entry, upsert=True)
+
     async def get_survey(self, survey_id: str):
-        """دریافت اطلاعات کامل یک نظرسنجی"""
-        return await self.db["surveys"].find_one({"survey_id": survey_id})
+        """دریافت تعریف یک نظرسنجی (سوال، گزینه‌ها و وضعیت؛ بدون آرا و شمارنده‌ها)"""
+        return await self.db["surveys"].find_one(
+            {"survey_id": survey_id},
+            {"question": 1, "options": 1, "status": 1, "closes_at": 1})
+
+    async def save_votes(self, votes: Dict):
+        """
+        ثبت دسته‌ای آرا در survey_votes و به‌روزرسانی شمارنده‌های هر گزینه با $inc.
+        votes: {(survey_id, user_id): option_id}
+        تغییر رای به صورت کم کردن از گزینه قبلی و اضافه کردن به گزینه جدید اعمال می‌شود.
+        اگر نوشتن یک نظرسنجی نیمه‌کاره بماند، شمارنده‌های آن قبل از دسته بعدی از روی
+        survey_votes بازسازی می‌شوند و خطا به فراخوان برمی‌گردد (تا دسته دوباره ارسال شود).
+        """
+        for survey_id in list(self.dirty_vote_surveys):
+            await self.recount_votes(survey_id)
+            self.dirty_vote_surveys.discard(survey_id)
+
+        by_survey = {}
+        for (survey_id, user_id), option_id in votes.items():
+            by_survey.setdefault(survey_id, {})[user_id] = option_id
+
+        now = datetime.now()
+        for survey_id, user_votes in by_survey.items():
+            # آرای قبلی همین کاربران (یک کوئری برای کل دسته)
+            cursor = self.survey_votes.find(
+                {"survey_id": survey_id, "user_id": {"$in": list(user_votes)}},
+                {"user_id": 1, "option_id": 1, "_id": 0}
+            )
+            previous = {v["user_id"]: v.get("option_id") async for v in cursor}
+
+            ops = []
+            inc = {}
+            for user_id, option_id in user_votes.items():
+                old_option = previous.get(user_id)
+                if old_option == option_id:
+                    continue
+
+                ops.append(UpdateOne(
+                    {"survey_id": survey_id, "user_id": user_id},
+                    {
+                        "$set": {"option_id": option_id, "updated_at": now},
+                        "$setOnInsert": {"created_at": now}
+                    },
+                    upsert=True
+                ))
+
+                new_key = f"option_counts.{option_id}"
+                inc[new_key] = inc.get(new_key, 0) + 1
+                if old_option is None:
+                    # رای جدید
+                    inc["total_votes"] = inc.get("total_votes", 0) + 1
+                else:
+                    # تغییر رای
+                    old_key = f"option_counts.{old_option}"
+                    inc[old_key] = inc.get(old_key, 0) - 1
+
+            if not ops:
+                continue
+
+            inc = {k: v for k, v in inc.items() if v}
+            try:
+                await self.survey_votes.bulk_write(ops, ordered=False)
+                if inc:
+                    await self.db["surveys"].update_one({"survey_id": survey_id}, {"$inc": inc})
+            except Exception:
+                # معلوم نیست کدام upsertها نوشته شده‌اند؛ $inc قابل اعتماد نیست
+                self.dirty_vote_surveys.add(survey_id)
+                raise
+
+    async def recount_votes(self, survey_id: str):
+        """بازسازی option_counts و total_votes یک نظرسنجی از روی survey_votes"""
+        survey = await self.db["surveys"].find_one({"survey_id": survey_id}, {"options": 1})
+        if not survey:
+            return
+        option_counts = {opt['id']: 0 for opt in survey.get("options", [])}
+
+        pipeline = [
+            {"$match": {"survey_id": survey_id}},
+            {"$group": {"_id": "$option_id", "count": {"$sum": 1}}}
+        ]
+        async for row in self.survey_votes.aggregate(pipeline):
+            option_counts[row["_id"]] = row["count"]
 
-    async def save_vote(self, survey_id: str, user_id: int, option_id: str):
-        """ثبت رای کاربر (اختیاری: برای جلوگیری از رای تکراری یا آمارگیری)"""
-        # اگر می‌خواهید کاربر بتواند رای خود را تغییر دهد از update_one استفاده کنید
         await self.db["surveys"].update_one(
-            {"survey_id": survey_id},
-            {"$set": {f"votes.{user_id}": option_id}}
+            {"_id": survey["_id"]},
+            {"$set": {
+                "option_counts": option_counts,
+                "total_votes": sum(option_counts.values())
+            }}
         )
+        logger.warning(f"Vote counters of survey {survey_id} rebuilt after a failed write")
+
+
+class SurveyCache:
+    """
+    کش درون‌پردازشی تعریف نظرسنجی‌ها برای مسیر پرترافیک callback.
+    نظرسنجی‌های حذف شده هم (به صورت None) کش می‌شوند. پنل ادمین پروسس جداست و
+    راهی برای باطل کردن کش ندارد؛ انقضا فقط با TTL است:
+    نظرسنجی باز حداکثر open_ttl ثانیه بعد از بستن/حذف دستی ادمین رای می‌پذیرد
+    (بسته شدن زمان‌دار با closes_at در هر کلیک دقیق چک می‌شود).
+    نظرسنجی بسته یا حذف شده دیگر تغییر نمی‌کند و ttl ثانیه کش می‌ماند.
+    """
+
+    def __init__(self, db_service: DatabaseService, ttl: float = 60, open_ttl: float = 5,
+                 max_size: int = 500):
+        self.db = db_service
+        self.ttl = ttl
+        self.open_ttl = open_ttl
+        self.max_size = max_size
+        self.items: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def get(self, survey_id: str) -> Optional[Dict]:
+        now = time.monotonic()
+        entry = self.items.get(survey_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        survey = await self.db.get_survey(survey_id)
+        is_open = survey is not None and survey.get("status") != "closed"
+        self.items[survey_id] = (now + (self.open_ttl if is_open else self.ttl), survey)
+        self.items.move_to_end(survey_id)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        return survey
+
+
+class VoteBuffer:
+    """
+    آرا را در حافظه جمع می‌کند و هر چند ثانیه یک بار به صورت دسته‌ای ذخیره می‌کند،
+    تا کلیک روی نظرسنجی هیچ خواندن/نوشتن همزمانی روی دیتابیس نداشته باشد.
+    """
+
+    def __init__(self, db_service: DatabaseService, flush_interval: float = 1.0, max_pending: int = 500):
+        self.db = db_service
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending: Dict = {}
+        self.wakeup = asyncio.Event()
+
+    def add(self, survey_id: str, user_id: int, option_id: str):
+        # اگر کاربر در همین بازه چند بار کلیک کند، فقط آخرین رای حساب می‌شود
+        self.pending[(survey_id, user_id)] = option_id
+        if len(self.pending) >= self.max_pending:
+            self.wakeup.set()
+
+    async def flush(self) -> bool:
+        """False = ذخیره ناموفق بود و آرا به pending برگشتند"""
+        if not self.pending:
+            return True
+        batch, self.pending = self.pending, {}
+        try:
+            await self.db.save_votes(batch)
+            return True
+        except Exception as e:
+            logger.error(f"vote flush error ({len(batch)} votes): {e}")
+            # رای جدیدتری که در این فاصله برای همان کاربر رسیده باشد حفظ می‌شود
+            for key, option_id in batch.items():
+                self.pending.setdefault(key, option_id)
+            return False
+
+    async def run(self, max_backoff: float = 30):
+        backoff = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if await self.flush():
+                backoff = self.flush_interval
+            else:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+
+    async def drain(self, attempts: int = 5):
+        """ذخیره آرای باقیمانده هنگام خاموش شدن (با چند بار تلاش مجدد)"""
+        backoff = self.flush_interval
+        for _ in range(attempts):
+            if await self.flush():
+                return
+            await asyncio.sleep(backoff)
+            backoff *= 2
+        logger.error(f"{len(self.pending)} buffered votes could not be saved on shutdown")
 
 
 # ---------------------------------------------------------
@@ -202,36 +644,308 @@ def kb_phone_request():
     )
 
 
-async def kb_dynamic_casts(db_service):
+# دکمه‌های جابه‌جایی بین صفحات منوی کست‌ها
+BTN_NEXT_PAGE = "صفحه بعد ⬅️"
+BTN_PREV_PAGE = "➡️ صفحه قبل"
+MENU_PAGE_SIZE = 6
+# پیشوند دکمه کست‌هایی که کاربر قبلاً باز کرده است
+OPENED_MARK = "✅ "
+
+
+def build_menu_pages(casts, page_size: int = MENU_PAGE_SIZE):
     """
-    Dynamically creates a ReplyKeyboard based on 'casts' collection in DB.
+    کست‌ها را به ترتیب ساخت (و گروه‌بندی بر اساس category در صورت وجود) صفحه‌بندی می‌کند.
+    هر صفحه فقط کست‌های یک دسته را دارد.
+    Output: list of pages, each a list of cast names
     """
-    casts = await db_service.get_all_casts()
-
-    buttons = []
+    categories = {}
     for cast in casts:
-        buttons.append(KeyboardButton(text=cast.get("name", "Cast")))
+        categories.setdefault(cast.get("category") or "", []).append(
+            cast.get("name", "Cast"))
 
+    pages = []
+    for names in categories.values():
+        for i in range(0, len(names), page_size):
+            pages.append(names[i:i + page_size])
+    return pages or [[]]
+
+
+def build_menu_keyboard(names, has_prev: bool, has_next: bool):
     keyboard = []
     row = []
-    for btn in buttons:
-        row.append(btn)
+    for name in names:
+        row.append(KeyboardButton(text=name))
         if len(row) == 2:
             keyboard.append(row)
             row = []
     if row:
         keyboard.append(row)
 
+    nav = []
+    if has_next:
+        nav.append(KeyboardButton(text=BTN_NEXT_PAGE))
+    if has_prev:
+        nav.append(KeyboardButton(text=BTN_PREV_PAGE))
+    if nav:
+        keyboard.append(nav)
+
     return ReplyKeyboardMarkup(keyboard=keyboard,
                                resize_keyboard=True,
                                one_time_keyboard=False,
                                selective=False)
+
+
+class CastMenu:
+    """
+    کیبوردهای صفحه‌بندی شده منوی کست‌ها از قبل ساخته و برای مدت کوتاهی کش می‌شوند،
+    تا هر پیام فقط یک صفحه کوچک (و از پیش ساخته) را همراه داشته باشد.
+    """
+
+    def __init__(self, db_service: DatabaseService, ttl: float = 60):
+        self.db = db_service
+        self.ttl = ttl
+        self.expires_at = 0.0
+        self.keyboards = []
+        self.pages = []
+        self.page_by_name = {}
+        self.ordinals = {}
+
+    async def refresh(self):
+        if time.monotonic() < self.expires_at:
+            return
+        casts = await self.db.get_all_casts()
+        pages = build_menu_pages(casts)
+        self.keyboards = [
+            build_menu_keyboard(names, has_prev=i > 0, has_next=i < len(pages) - 1)
+            for i, names in enumerate(pages)
+        ]
+        self.pages = pages
+        self.page_by_name = {name: i for i, names in enumerate(pages) for name in names}
+        self.ordinals = {cast["name"]: cast["ordinal"] for cast in casts if "ordinal" in cast}
+        self.expires_at = time.monotonic() + self.ttl
+
+    async def keyboard(self, page: int = 0, opened: Optional[Dict] = None) -> ReplyKeyboardMarkup:
+        await self.refresh()
+        page = max(0, min(page, len(self.keyboards) - 1))
+        if not opened:
+            return self.keyboards[page]
+
+        # نسخه شخصی صفحه: کست‌های باز شده علامت ✅ می‌گیرند
+        names = [f"{OPENED_MARK}{name}" if has_opened(opened, self.ordinals.get(name)) else name
+                 for name in self.pages[page]]
+        return build_menu_keyboard(names, has_prev=page > 0,
+                                   has_next=page < len(self.keyboards) - 1)
+
+    async def page_count(self) -> int:
+        await self.refresh()
+        return len(self.keyboards)
+
+    async def page_of(self, cast_name: str) -> int:
+        await self.refresh()
+        return self.page_by_name.get(cast_name, 0)
+
+
+async def kb_dynamic_casts(db_service, page: int = 0, opened: Optional[Dict] = None):
+    """
+    Returns the (cached) ReplyKeyboard of one page of the casts menu.
+    opened: بیت‌مپ کاربر برای علامت‌گذاری کست‌های دیده شده
+    """
+    return await cast_menu.keyboard(page, opened)
+
+
+# ---------------------------------------------------------
+# CONTENT DELIVERY
+# ---------------------------------------------------------
+
+
+def parse_cast_content(cast_data: Dict) -> list:
+    """
+    source_message_id یا یک شناسه تکی است یا لیست JSON از پیام‌ها.
+    Output: [{"message_id": ..., "chat_id": ..., "album": ...}, ...]
+    """
+    raw_msg_id = cast_data.get("source_message_id")
+    raw_chat_id = cast_data.get("source_chat_id")
+
+    try:
+        if isinstance(raw_msg_id, str) and raw_msg_id.startswith("["):
+            return json.loads(raw_msg_id)
+    except:
+        pass
+    return [{"message_id": raw_msg_id, "chat_id": raw_chat_id}]
+
+
+def group_albums(content_list):
+    """
+    آیتم‌های پشت سر هم که کلید album یکسان دارند در یک گروه قرار می‌گیرند.
+    Output: [[item], [album_item, album_item, ...], ...]
+    """
+    groups = []
+    for item in content_list:
+        album = item.get('album')
+        if album and groups and groups[-1][0].get('album') == album:
+            groups[-1].append(item)
+        else:
+            groups.append([item])
+    return groups
+
+
+async def send_content_group(bot: Bot, user_id: int, group: list, reply_markup=None):
+    """
+    آلبوم‌ها با یک copy_messages (و با حفظ گروه‌بندی) ارسال می‌شوند.
+    نکته: copy_messages کیبورد نمی‌پذیرد؛ اگر کیبورد داده شده باشد با یک پیام کوتاه بعد از آلبوم فرستاده می‌شود.
+    """
+    if len(group) > 1:
+        await bot.copy_messages(
+            chat_id=user_id,
+            from_chat_id=group[0]['chat_id'],
+            message_ids=[item['message_id'] for item in group]
+        )
+        if reply_markup is not None:
+            await bot.send_message(user_id, "👇 منوی کست‌ها", reply_markup=reply_markup)
+        return
+
+    item = group[0]
+    await bot.copy_message(
+        chat_id=user_id,
+        from_chat_id=item['chat_id'],
+        message_id=item['message_id'],
+        reply_markup=reply_markup
+    )
+
+
+class DeliveryGuard:
+    """
+    جلوگیری از ارسال تکراری یک کست به یک کاربر (دابل‌کلیک یا تکرار نام کست).
+    تا وقتی ارسال در جریان است و تا cooldown ثانیه بعد از آن، درخواست تکراری نادیده گرفته می‌شود.
+    """
+
+    def __init__(self, cooldown: float = 5, max_size: int = 10000):
+        self.cooldown = cooldown
+        self.max_size = max_size
+        self.in_flight = set()
+        self.recent: "OrderedDict[tuple, float]" = OrderedDict()
+        self.suppressed = 0
+
+    def is_in_flight(self, key: tuple) -> bool:
+        return key in self.in_flight
+
+    def try_start(self, key: tuple) -> bool:
+        if key in self.in_flight or self.recent.get(key, 0) > time.monotonic():
+            self.suppressed += 1
+            if self.suppressed % 100 == 0:
+                logger.info(f"Suppressed duplicate deliveries: {self.suppressed}")
+            return False
+        self.in_flight.add(key)
+        return True
+
+    def finish(self, key: tuple):
+        self.in_flight.discard(key)
+        self.recent[key] = time.monotonic() + self.cooldown
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.max_size:
+            self.recent.popitem(last=False)
+
+
+delivery_guard = DeliveryGuard()
+
+
+class DripScheduler:
+    """
+    سطرهای سررسید شده drip_queue را (به ترتیب due_at و بدون پیمایش کاربران) برمی‌دارد
+    و محتوای آن‌ها را با سرعت محدود (DRIP_RATE پیام در ثانیه) برای کاربر می‌فرستد.
+    """
+
+    def __init__(self, db_service: DatabaseService, rate: float, poll_interval: float = 30,
+                 max_attempts: int = 8):
+        self.db = db_service
+        self.interval = 1 / rate
+        self.poll_interval = poll_interval
+        # بعد از این تعداد خطای پیاپی، سطر کنار گذاشته می‌شود
+        self.max_attempts = max_attempts
+
+    async def deliver(self, bot: Bot, entry: Dict):
+        user_id, name = entry["user_id"], entry["cast"]
+        cast_data = await self.db.get_cast_by_name(name)
+        if not cast_data:
+            return
+        # سطر قدیمی برای کستی که کاربر قبلاً دریافت کرده است
+        if await self.db.get_opened_names(user_id, [cast_data]):
+            return
+
+        # کاربر همین الان در حال دریافت این کست است
+        key = (user_id, name)
+        if not delivery_guard.try_start(key):
+            return
+        try:
+            keyboard = await kb_dynamic_casts(self.db, await cast_menu.page_of(name),
+                                              await self.db.get_opened(user_id))
+            await bot.send_message(user_id, f"🔓 محتوای جدید برای شما باز شد: «{name}»")
+            groups = group_albums(parse_cast_content(cast_data))
+            for index, group in enumerate(groups):
+                await asyncio.sleep(self.interval)
+                is_last = (index == len(groups) - 1)
+                await send_content_group(bot, user_id, group,
+                                         reply_markup=keyboard if is_last else None)
+        finally:
+            delivery_guard.finish(key)
+
+        # زمان دریافت = زمان باز شدن؛ کست‌های وابسته به این کست زمان‌بندی می‌شوند
+        if await self.db.add_user_history(user_id, name, "drip", cast_data.get("ordinal")):
+            await self.db.schedule_drips(user_id, after=name, since=datetime.now())
+
+    async def retry_later(self, entry: Dict, error: Exception):
+        """خطای موقت (شبکه، تلگرام، دیتابیس): سطر با تاخیر نمایی و شمارنده تلاش به صف برمی‌گردد"""
+        attempts = entry.get("attempts", 0) + 1
+        if attempts >= self.max_attempts:
+            logger.error(f"drip delivery dropped after {attempts} attempts ({entry['_id']}): {error}")
+            return
+        delay = timedelta(minutes=2 ** attempts)
+        logger.warning(f"drip delivery error ({entry['_id']}), retry #{attempts} in {delay}: {error}")
+        try:
+            await self.db.requeue_drip(dict(entry, attempts=attempts), datetime.now() + delay)
+        except Exception as e:
+            logger.error(f"drip requeue error ({entry['_id']}): {e}")
+
+    async def tick(self, bot: Bot) -> int:
+        entries = await self.db.get_due_drips(datetime.now())
+        for entry in entries:
+            if not await self.db.claim_drip(entry["_id"]):
+                continue
+            try:
+                await self.deliver(bot, entry)
+            except TelegramForbiddenError:
+                # کاربر ربات را بلاک کرده است
+                pass
+            except TelegramRetryAfter as e:
+                logger.warning(f"Drip flood wait {e.retry_after}s")
+                await self.db.requeue_drip(entry, datetime.now())
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                await self.retry_later(entry, e)
+            await asyncio.sleep(self.interval)
+        return len(entries)
+
+    async def run(self, bot: Bot):
+        while True:
+            try:
+                # تا وقتی سطر سررسید شده باقی است بدون وقفه ادامه می‌دهد
+                if await self.tick(bot):
+                    continue
+            except Exception as e:
+                logger.error(f"drip scheduler error: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+
 # ---------------------------------------------------------
 # 5. HANDLERS
 # ---------------------------------------------------------
 router = Router()
 router.message.filter(F.chat.type == "private")
 db = DatabaseService()
+survey_cache = SurveyCache(db)
+cast_menu = CastMenu(db)
+vote_buffer = VoteBuffer(db)
+drip_scheduler = DripScheduler(db, rate=CONF["DRIP_RATE"])
 
 
 @router.message(CommandStart())
@@ -242,7 +956,8 @@ async def cmd_start(message: Message, state: FSMContext):
     # Check if user already exists and is completed
     user = await db.get_user(user_id)
     if user.get("profile_completed"):
-        keyboard = await kb_dynamic_casts(db)
+        page = (await state.get_data()).get("menu_page", 0)
+        keyboard = await kb_dynamic_casts(db, page, user.get("opened"))
         await message.answer(
             "به خانه برگشتید 🌿\n\nاز لیست زیر انتخاب کنید:",
             reply_markup=keyboard
@@ -283,11 +998,10 @@ async def process_phone(message: Message, state: FSMContext):
     user_id = message.from_user.id
 
     # Update DB
-    await db.update_user(user_id, {
+    await db.complete_profile(user_id, {
         "name": message.from_user.full_name,
         "username": message.from_user.username,
-        "phone": phone,
-        "profile_completed": True
+        "phone": phone
     })
 
     # Generate Dynamic Keyboard
@@ -352,6 +1066,21 @@ async def cmd_reset(message: types.Message, state: FSMContext):
     await message.answer("Account Reset -> use /start ")
 
 
+@router.message(F.text.in_({BTN_NEXT_PAGE, BTN_PREV_PAGE}))
+async def change_menu_page(message: Message, state: FSMContext):
+    """جابه‌جایی بین صفحات منوی کست‌ها (صفحه فعلی در state کاربر نگه داشته می‌شود)"""
+    data = await state.get_data()
+    page = data.get("menu_page", 0)
+    page += 1 if message.text == BTN_NEXT_PAGE else -1
+
+    total = await cast_menu.page_count()
+    page = max(0, min(page, total - 1))
+    await state.update_data(menu_page=page)
+
+    await message.answer(f"📄 صفحه {page + 1} از {total}",
+                         reply_markup=await kb_dynamic_casts(db, page, await db.get_opened(message.from_user.id)))
+
+
 # ---------------------------------------------------------
 # HANDLERS: تعامل کاربر با نظرسنجی (CALLBACK)
 # ---------------------------------------------------------
@@ -371,8 +1100,8 @@ async def handle_survey_click(callback: CallbackQuery):
     option_id = parts[2]
     user_id = callback.from_user.id
 
-    # 1. دریافت اطلاعات نظرسنجی از دیتابیس
-    survey = await db.get_survey(survey_id)
+    # 1. دریافت اطلاعات نظرسنجی (از کش)
+    survey = await survey_cache.get(survey_id)
     if not survey:
         await callback.answer("❌ این نظرسنجی منقضی یا حذف شده است.", show_alert=True)
         # اگر دیتابیس پیدا نشد، پیام را حذف کن تا کاربر گیج نشود
@@ -382,6 +1111,16 @@ async def handle_survey_click(callback: CallbackQuery):
             pass
         return
 
+    # نظرسنجی بسته یا منقضی شده: دکمه‌ها را از پیام حذف کن
+    closes_at = survey.get("closes_at")
+    if survey.get("status") == "closed" or (closes_at and closes_at <= datetime.now()):
+        await callback.answer("⛔ این نظرسنجی بسته شده است.", show_alert=True)
+        try:
+            await callback.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        return
+
     # 2. پیدا کردن گزینه انتخاب شده و پیام پاسخ آن
     selected_option = next(
         (opt for opt in survey['options'] if opt['id'] == option_id), None)
@@ -389,7 +1128,7 @@ async def handle_survey_click(callback: CallbackQuery):
     if selected_option:
         response_text = selected_option.get("reply", "✅ نظر شما ثبت شد.")
 
-        await db.save_vote(survey_id, user_id, option_id)
+        vote_buffer.add(survey_id, user_id, option_id)
 
         try:
             await callback.message.delete()
@@ -402,6 +1141,54 @@ async def handle_survey_click(callback: CallbackQuery):
     else:
         await callback.answer("گزینه نامعتبر است.")
 
+
+# ---------------------------------------------------------
+# CAST DELIVERY (ارسال محتوای یک کست)
+# ---------------------------------------------------------
+
+
+async def deliver_cast(message: Message, state: FSMContext, bot: Bot, cast_data: Dict, cast_name: str):
+    """ارسال محتوای یک کست به کاربر همراه با صفحه‌ای از منو که این کست در آن است"""
+    user_id = message.from_user.id
+
+    # ✅ ثبت در تاریخچه کاربر (نوع: دکمه)
+    is_first_open = await db.add_user_history(
+        user_id=user_id,
+        value=cast_name,
+        type="cast_button",
+        ordinal=cast_data.get("ordinal")
+    )
+    if is_first_open:
+        await db.schedule_drips(user_id, after=cast_name, since=datetime.now())
+    if "unlock_hours" in cast_data:
+        await db.cancel_drip(user_id, cast_name)
+
+    content_list = parse_cast_content(cast_data)
+
+    if not content_list:
+        await message.answer("محتوایی یافت نشد.")
+        return
+
+    page = await cast_menu.page_of(cast_name)
+    keyboard = await kb_dynamic_casts(db, page, await db.get_opened(user_id))
+    await state.update_data(menu_page=page)
+    try:
+        groups = group_albums(content_list)
+        for index, group in enumerate(groups):
+            is_last = (index == len(groups) - 1)
+            await send_content_group(
+                bot, user_id, group,
+                reply_markup=keyboard if is_last else None
+            )
+
+            if not is_last:
+                await asyncio.sleep(0.1)
+
+        await state.set_state(UserFlow.main_menu)
+    except Exception as e:
+        logger.error(f"Error sending cast: {e}")
+
+
 # ---------------------------------------------------------
 # UNIFIED HANDLER (هندلر یکپارچه نهایی)
 # ---------------------------------------------------------
@@ -419,6 +1206,8 @@ async def final_message_handler(message: Message, state: FSMContext, bot: Bot):
         return
 
     user_input_clean = convert_to_english_digits(user_input.strip())
+    if user_input_clean.startswith(OPENED_MARK):
+        user_input_clean = user_input_clean[len(OPENED_MARK):]
     user_id = message.from_user.id
 
     # -----------------------------------------------------
@@ -427,51 +1216,32 @@ async def final_message_handler(message: Message, state: FSMContext, bot: Bot):
     cast_data = await db.get_cast_by_name(user_input_clean)
 
     if cast_data:
-        # ✅ ثبت در تاریخچه کاربر (نوع: دکمه)
-        await db.add_user_history(
-            user_id=user_id,
-            value=user_input_clean,
-            type="cast_button"
-        )
-
-        # ... (کدهای دریافت پیام و ارسال آن - بدون تغییر) ...
-        raw_msg_id = cast_data.get("source_message_id")
-        raw_chat_id = cast_data.get("source_chat_id")
-
-        # [بخش پردازش لیست و JSON را اینجا بگذارید...]
-        content_list = []
-        try:
-            if isinstance(raw_msg_id, str) and raw_msg_id.startswith("["):
-                content_list = json.loads(raw_msg_id)
-            else:
-                content_list = [
-                    {"message_id": raw_msg_id, "chat_id": raw_chat_id}]
-        except:
-            content_list = [{"message_id": raw_msg_id, "chat_id": raw_chat_id}]
-
-        if not content_list:
-            await message.answer("محتوایی یافت نشد.")
+        # 🔒 کست تدریجی که هنوز برای این کاربر باز نشده است
+        if "unlock_hours" in cast_data:
+            due_at = await db.get_drip_due(user_id, cast_data)
+            if due_at == datetime.max:
+                await message.answer(
+                    f"🔒 این محتوا بعد از دیدن «{cast_data['unlock_after']}» برای شما باز می‌شود.")
+                return
+            if due_at and due_at > datetime.now():
+                remaining = due_at - datetime.now()
+                hours, rem = divmod(int(remaining.total_seconds()), 3600)
+                await message.answer(
+                    f"🔒 این محتوا حدود {hours} ساعت و {rem // 60} دقیقه دیگر برای شما باز می‌شود.")
+                return
+
+        # ⏳ درخواست تکراری همان کست (در حین ارسال یا چند ثانیه بعد از آن)
+        delivery_key = (user_id, user_input_clean)
+        if not delivery_guard.try_start(delivery_key):
+            if delivery_guard.is_in_flight(delivery_key):
+                await message.answer("⏳ در حال ارسال همین محتوا هستیم، کمی صبر کنید...")
             return
 
-        keyboard = await kb_dynamic_casts(db)
         try:
-            for index, item in enumerate(content_list):
-                is_last = (index == len(content_list) - 1)
-                await bot.copy_message(
-                    chat_id=user_id,
-                    from_chat_id=item['chat_id'],
-                    message_id=item['message_id'],
-                    reply_markup=keyboard if is_last else None
-                )
-
-                if not is_last:
-                    await asyncio.sleep(0.1)
-
-            await state.set_state(UserFlow.main_menu)
-            return
-        except Exception as e:
-            logger.error(f"Error sending cast: {e}")
-            return
+            await deliver_cast(message, state, bot, cast_data, user_input_clean)
+        finally:
+            delivery_guard.finish(delivery_key)
+        return
 
     # -----------------------------------------------------
     # ۲. بررسی کلمات کلیدی (Smart Reply)
@@ -488,12 +1258,8 @@ async def final_message_handler(message: Message, state: FSMContext, bot: Bot):
         )
 
         try:
-            for item in reply_data:
-                await bot.copy_message(
-                    chat_id=user_id,
-                    from_chat_id=item['chat_id'],
-                    message_id=item['message_id']
-                )
+            for group in group_albums(reply_data):
+                await send_content_group(bot, user_id, group)
                 await asyncio.sleep(0.1)
             return
 
@@ -508,6 +1274,80 @@ async def final_message_handler(message: Message, state: FSMContext, bot: Bot):
     if current_state not in [UserFlow.waiting_phone, UserFlow.waiting_for_start_click]:
         await cmd_start(message, state)
 
+# ---------------------------------------------------------
+# MIDDLEWARE: محدودیت پیام‌های ورودی هر کاربر
+# ---------------------------------------------------------
+
+
+class FloodGuardMiddleware(BaseMiddleware):
+    """
+    Token bucket per user, checked before any handler touches the database.
+    Small overshoots are delayed; bigger bursts are dropped and the user is warned once.
+    The table is bounded: least recently seen users are evicted first.
+    """
+
+    def __init__(self, rate: float, burst: int, max_delay: float = 1.0, max_users: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.max_users = max_users
+        # user_id -> [tokens, updated_at, warned]
+        self.buckets: "OrderedDict[int, list]" = OrderedDict()
+        self.dropped = 0
+
+    def _take(self, user_id: int) -> float:
+        """Returns 0 if allowed now, otherwise seconds until a token is available."""
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = [float(self.burst), now, False]
+            self.buckets[user_id] = bucket
+            while len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(user_id)
+
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if not user:
+            return await handler(event, data)
+
+        wait = self._take(user.id)
+        if wait and wait <= self.max_delay:
+            # کمی بیش از حد مجاز: با تاخیر پردازش می‌شود
+            await asyncio.sleep(wait)
+            wait = self._take(user.id)
+
+        if wait:
+            self.dropped += 1
+            bucket = self.buckets.get(user.id)
+            if bucket and not bucket[2]:
+                bucket[2] = True
+                logger.warning(f"Flood from user {user.id}, dropping updates "
+                               f"(total dropped: {self.dropped})")
+                message = getattr(event, "message", None)
+                if message:
+                    try:
+                        await message.answer("⏳ لطفاً کمی آهسته‌تر پیام بفرستید.")
+                    except Exception:
+                        pass
+            return None
+
+        return await handler(event, data)
+
+
 # ---------------------------------------------------------
 # MAIN ENTRY POINT
 # ---------------------------------------------------------
@@ -519,15 +1359,24 @@ async def main():
         default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
     )
 
+    await db.ensure_indexes()
+
     storage = MongoStorage(client=db.client, db_name=CONF["DB_NAME"])
     dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(FloodGuardMiddleware(rate=CONF["FLOOD_RATE"],
+                                                    burst=CONF["FLOOD_BURST"]))
     dp.include_router(router)
 
     logger.info("🌿 ActCast Bot Started...")
 
+    vote_task = asyncio.create_task(vote_buffer.run())
+    drip_task = asyncio.create_task(drip_scheduler.run(bot))
     try:
         await dp.start_polling(bot)
     finally:
+        vote_task.cancel()
+        drip_task.cancel()
+        await vote_buffer.drain()
         await bot.session.close()
 
 if __name__ == "__main__":